@@ -30,5 +30,6 @@ class SampleBatchJob(Stack):
             job_def_name="sample-covid-sql-athena-mat",
             cmd=["python3", "materialize_athena_query.py", "some_project/sample-nyc-covid.sql", "<<<TARGET_BUCKET>>>", "covid-19","covid_state_data","aggregated covid data","<<<TMP_ATHENA_BUCKET>>>"],
             job_role_policies=policies,
-            schedule = "" # some cron syntax such as (0 10 * * *) for 10am everyday
+            schedule = "", # some cron syntax such as (0 10 * * *) for 10am everyday
+            run_stats_uri = "" # size from previous runs, eg s3://<<<TMP_ATHENA_BUCKET>>>/_materialize_state/covid-19/covid_state_data/stats.json
         )
\ No newline at end of file
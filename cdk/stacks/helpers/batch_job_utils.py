@@ -9,6 +9,8 @@ from aws_cdk import (
 from typing import List
 from constructs import Construct
 
+from . import fargate_sizing
+
 
 def _get_batch_job_exec_role(scope):
     exec_role = iam.Role(scope,"ExecRole",
@@ -38,17 +40,40 @@ def get_batch_job_definition(scope: Construct,
                              job_def_name:str, 
                              cmd:List[str],
                              job_role_policies:List[iam.PolicyStatement],
-                             schedule:str = ""
+                             schedule:str = "",
+                             vcpu:str = fargate_sizing.DEFAULT_VCPU,
+                             memory:str = fargate_sizing.DEFAULT_MEMORY,
+                             run_stats_uri:str = "",
+                             min_vcpu:str = fargate_sizing.MIN_VCPU,
+                             retry_attempts:int = 3,
+                             array_size:int = 0
     ) -> batch.CfnJobDefinition:
+    """run_stats_uri, eg s3://<tmp athena bucket>/_materialize_state/<db>/<table>/stats.json (or the stats/ prefix of an
+    array job's shards), sizes the job's vCPU and
+    memory from the peak memory of its previous runs, doubling the memory of runs killed for running out of it, instead of
+    vcpu/memory, which are kept until it has a history. Sized jobs get at least min_vcpu, eg "1" for CPU bound queries.
+    Failed jobs are retried up to retry_attempts times in all, resuming from the failed attempt's checkpoint when
+    the job has checkpoint on.
+    array_size runs the job as an array job of that many children, each materializing one shard of the query (see
+    MaterializeAthenaQuery.sharding). The size is passed to the children as MATERIALIZE_SHARD_COUNT, jobs submitted
+    outside the schedule need the same array size"""
+
+    if run_stats_uri:
+        sized = fargate_sizing.size_from_stats(fargate_sizing.load_run_stats(run_stats_uri), min_vcpu=min_vcpu)
+        if sized:
+            vcpu, memory = sized
 
     job_role=_get_batch_job_role_arn(scope,job_role_policies)
     
     base_env.tmp_athena_bucket.grant_read_write(job_role)
+    # a run looks up why earlier runs in its stats history were killed, DescribeJobs has no resource level permissions
+    job_role.add_to_policy(iam.PolicyStatement(actions=["batch:DescribeJobs"], resources=["*"]))
 
     sample_job_def = batch.CfnJobDefinition(scope,"CfnSampleJobDef",
         type="container",
         job_definition_name=job_def_name,
         platform_capabilities=["FARGATE"],
+        retry_strategy=batch.CfnJobDefinition.RetryStrategyProperty(attempts=retry_attempts),
         container_properties=batch.CfnJobDefinition.ContainerPropertiesProperty(
             image=base_env.ecr_repo_uri,
             command=cmd,
@@ -60,14 +85,17 @@ def get_batch_job_definition(scope: Construct,
             ),
             resource_requirements=[
                 batch.CfnJobDefinition.ResourceRequirementProperty(
-                type="VCPU",value="1"
+                type="VCPU",value=vcpu
                 ),
                 batch.CfnJobDefinition.ResourceRequirementProperty(
-                type="MEMORY",value="2048"
+                type="MEMORY",value=memory
                 )
             ],
             execution_role_arn=_get_batch_job_exec_role(scope).role_arn,
-            job_role_arn=job_role.role_arn
+            job_role_arn=job_role.role_arn,
+            environment=[
+                batch.CfnJobDefinition.EnvironmentProperty(name="MATERIALIZE_SHARD_COUNT", value=str(array_size))
+            ] if array_size > 1 else None
         )
     )
 
@@ -84,7 +112,8 @@ def get_batch_job_definition(scope: Construct,
                 job_queue_arn = base_env.batch_job_queue.attr_job_queue_arn,
                 job_queue_scope = base_env.batch_job_queue,
                 job_definition_arn = sample_job_def.ref,
-                job_definition_scope = sample_job_def
+                job_definition_scope = sample_job_def,
+                size = array_size if array_size > 1 else None
             )
         )
 
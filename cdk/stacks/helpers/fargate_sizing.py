@@ -0,0 +1,80 @@
+"""Sizes Fargate Batch jobs from the run history MaterializeAthenaQuery saves in its state store"""
+import json
+import logging
+import os
+from typing import Dict, Any, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import boto3
+
+LOGGER = logging.getLogger()
+
+# valid Fargate memory sizes (MiB) for each vCPU value: https://docs.aws.amazon.com/batch/latest/APIReference/API_ResourceRequirement.html
+FARGATE_MEMORY_BY_VCPU = {
+    "0.25": [512, 1024, 2048],
+    "0.5": list(range(1024, 4096 + 1, 1024)),
+    "1": list(range(2048, 8192 + 1, 1024)),
+    "2": list(range(4096, 16384 + 1, 1024)),
+    "4": list(range(8192, 30720 + 1, 1024)),
+    "8": list(range(16384, 61440 + 1, 4096)),
+    "16": list(range(32768, 122880 + 1, 8192)),
+}
+DEFAULT_VCPU = "1"
+DEFAULT_MEMORY = "2048"
+# jobs sized from their history can go down to the smallest Fargate size
+MIN_VCPU = "0.25"
+# runs whose peak memory was never recorded
+UNFINISHED_STATUSES = ("running", "killed", "oom_killed")
+
+
+def load_run_stats(stats_uri: str) -> List[Dict[str, Any]]:
+    """Loads a job's run history as saved by MaterializeAthenaQuery, from s3://<stg_athena_bucket>/_materialize_state/<db>/<table>/stats.json
+    or a local copy of it. A uri ending in / loads every history under it, eg the stats/ prefix the shards of an array job
+    each save theirs under. Returns [] when there's no history yet (or no access to it at synth time)"""
+    loc = urlparse(stats_uri)
+    try:
+        if stats_uri.endswith("/"):
+            if loc.scheme == "s3":
+                paginator = boto3.client("s3").get_paginator("list_objects_v2")
+                keys = [obj["Key"] for page in paginator.paginate(Bucket=loc.netloc, Prefix=loc.path.lstrip("/")) for obj in page.get("Contents", [])]
+                uris = [f"s3://{loc.netloc}/{key}" for key in keys if key.endswith(".json")]
+            else:
+                root = loc.path if loc.scheme == "file" else stats_uri
+                uris = [os.path.join(root, name) for name in sorted(os.listdir(root)) if name.endswith(".json")]
+            return [run for uri in uris for run in load_run_stats(uri)]
+        if loc.scheme == "s3":
+            body = boto3.client("s3").get_object(Bucket=loc.netloc, Key=loc.path.lstrip("/"))["Body"].read()
+        else:
+            with open(loc.path if loc.scheme == "file" else stats_uri) as f:
+                body = f.read()
+    except Exception as exc:
+        LOGGER.warning(f"No run stats at {stats_uri}, using default sizing: {exc}")
+        return []
+    return json.loads(body)["runs"]
+
+
+def get_fargate_resources(peak_rss_mb: float, headroom: float = 1.5, min_vcpu: str = MIN_VCPU) -> Tuple[str, str]:
+    """Returns the smallest valid (vCPU, memory MiB) Fargate combination with at least peak_rss_mb * headroom of memory.
+    Only memory is sized, so small jobs go down to a fraction of a vCPU, min_vcpu="1" keeps CPU bound jobs from it"""
+    needed = peak_rss_mb * headroom
+    for vcpu, memory_sizes in FARGATE_MEMORY_BY_VCPU.items():
+        if float(vcpu) < float(min_vcpu):
+            continue
+        for memory in memory_sizes:
+            if memory >= needed:
+                return vcpu, str(memory)
+    raise ValueError(f"No Fargate size has {needed:.0f} MiB of memory, the job needs a smaller chunksize or an EC2 compute environment")
+
+
+def size_from_stats(runs: List[Dict[str, Any]], headroom: float = 1.5, min_vcpu: str = MIN_VCPU) -> Optional[Tuple[str, str]]:
+    """Sizes a job for the largest peak memory in its run history, None without history. Failed runs count too.
+
+    A run that was killed never records its peak. When a later run found it was killed by ECS for its memory
+    usage (oom_killed, see resolve_killed_runs in materialize_athena_query.py) it gets twice the memory it was killed
+    with, or the default when that wasn't recorded. Runs killed for another reason, or still running, are left out.
+    """
+    needed = [run["peak_rss_mb"] * headroom for run in runs if run.get("status") not in UNFINISHED_STATUSES and run.get("peak_rss_mb")]
+    needed += [2 * float(run.get("memory_limit_mb") or DEFAULT_MEMORY) for run in runs if run.get("status") == "oom_killed"]
+    if not needed:
+        return None
+    return get_fargate_resources(max(needed), headroom=1.0, min_vcpu=min_vcpu)
@@ -0,0 +1,104 @@
+"""Shared Glue table metadata for synth time lookups
+
+Every GlueDataCatalogPermissions used to make its own client and one GetTable call per table, for every
+stack on every synth. Table locations are instead fetched a whole database at a time with paginated
+GetTables calls (100 tables per call) through one client, kept in memory for the rest of the synth and
+on disk for GLUE_CATALOG_CACHE_TTL seconds so the next synths don't call Glue at all.
+
+    GLUE_CATALOG_CACHE_DIR  where the cache files are kept, defaults to cdk.out/.glue_catalog_cache
+    GLUE_CATALOG_CACHE_TTL  seconds a cached database is used for, defaults to 3600, 0 disables the disk cache
+    GLUE_ENDPOINT_URL       Glue endpoint, eg a local moto server
+"""
+import json
+import logging
+import os
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, Optional
+
+import boto3
+
+LOGGER = logging.getLogger()
+
+CACHE_DIR = os.environ.get("GLUE_CATALOG_CACHE_DIR", os.path.join("cdk.out", ".glue_catalog_cache"))
+CACHE_TTL_SECONDS = int(os.environ.get("GLUE_CATALOG_CACHE_TTL", 3600))
+
+_tables: Dict[str, Dict[str, str]] = {}
+_refreshed = set()
+_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_glue_client():
+    return boto3.client("glue", endpoint_url=os.environ.get("GLUE_ENDPOINT_URL"))
+
+
+def _cache_path(database: str) -> str:
+    return os.path.join(CACHE_DIR, f"{database}.json")
+
+
+def _read_cache(database: str) -> Optional[Dict[str, str]]:
+    try:
+        with open(_cache_path(database)) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - cached["fetched_at"] > CACHE_TTL_SECONDS:
+        return None
+    return cached["tables"]
+
+
+def _write_cache(database: str, tables: Dict[str, str]):
+    path = _cache_path(database)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # write then rename so a concurrent synth never reads a partial file
+    with open(f"{path}.tmp", "w") as f:
+        json.dump({"fetched_at": time.time(), "tables": tables}, f, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
+def _fetch_tables(database: str) -> Dict[str, str]:
+    client = get_glue_client()
+    tables = {}
+    try:
+        for page in client.get_paginator("get_tables").paginate(DatabaseName=database):
+            for table in page["TableList"]:
+                tables[table["Name"]] = table.get("StorageDescriptor", {}).get("Location")
+    except client.exceptions.EntityNotFoundException:
+        LOGGER.warning(f"Glue database [{database}] was not found")
+    LOGGER.info(f"Fetched {len(tables)} table locations of Glue database [{database}]")
+    return tables
+
+
+def get_table_locations(database: str, refresh: bool = False) -> Dict[str, str]:
+    """Returns {table name: S3 location} for every table of a database"""
+    with _lock:
+        if refresh or database not in _tables:
+            tables = None if refresh or not CACHE_TTL_SECONDS else _read_cache(database)
+            if tables is None:
+                tables = _fetch_tables(database)
+                _refreshed.add(database)
+                if CACHE_TTL_SECONDS:
+                    _write_cache(database, tables)
+            _tables[database] = tables
+        return _tables[database]
+
+
+def get_table_location(database: str, table: str) -> Optional[str]:
+    """Returns a table's S3 location, None if it doesn't exist. A table missing from a cached copy of the
+    database refreshes it once per synth, in case the table was created since"""
+    location = get_table_locations(database).get(table)
+    if location is None and database not in _refreshed:
+        location = get_table_locations(database, refresh=True).get(table)
+    return location
+
+
+def clear_cache():
+    """Drops the in memory and on disk copies, the next lookups fetch from Glue"""
+    with _lock:
+        _tables.clear()
+        _refreshed.clear()
+        if os.path.isdir(CACHE_DIR):
+            for name in os.listdir(CACHE_DIR):
+                os.remove(os.path.join(CACHE_DIR, name))
@@ -1,10 +1,8 @@
 """Iam helpers for data resource permissioning"""
 import os
 from urllib.parse import urlparse
-import boto3
 from dataclasses import dataclass, field
 from typing import List
-from botocore.errorfactory import ClientError
 import logging
 
 from aws_cdk import (
@@ -12,6 +10,8 @@ from aws_cdk import (
     Environment
 )
 
+from . import glue_catalog_cache
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s.%(msecs)03d %(levelname)s %(module)s - %(funcName)s: %(message)s',
@@ -29,6 +29,8 @@ class GlueDataCatalogPermissions:
     tables: List[str] = field(default_factory=lambda: ["*"])  # default to all tables if unspecified
     #in case permissions are being requested for write access for a new table, this is the S3 bucket it will be stored in
     write_destination_bucket: str = field(default_factory=lambda: None)
+    # tables written with partition_projection only update their table, write access leaves out partition writes
+    partition_projection: bool = False
     region: str = field(init=False)
     account_id: str = field(init=False)
 
@@ -40,26 +42,31 @@ class GlueDataCatalogPermissions:
     def get_s3_policy(self, access_level: str) -> iam.PolicyStatement:
         """Generates S3 policy statement"""
         
-        client = boto3.client('glue')
         resources=[]
-        for t in self.tables:
-            try:
-                s3_path = client.get_table(DatabaseName=self.database,Name=t)['Table']['StorageDescriptor']['Location']
+        # table locations come from a per database cache shared by every stack, see glue_catalog_cache
+        tables = list(glue_catalog_cache.get_table_locations(self.database)) if "*" in self.tables else self.tables
+        for t in tables:
+            s3_path = glue_catalog_cache.get_table_location(self.database, t)
+            if s3_path is not None:
                 print(f'Found S3 Path:: {s3_path}')
-            except ClientError as exc: # table doesn't exist
-                if self.write_destination_bucket is not None and exc.response['Error']['Code']=='EntityNotFoundException':
-                    # check if permissions are being requested to create new table
-                    s3_path=f's3://{self.write_destination_bucket}/{self.database}/{t}'
-                    print(f'DIDNT FIND S3 Path:: {s3_path}')
-                else:
-                    LOGGER.error(f"TABLE:: [{t}] was not found in DB [{self.database}] and no write_destination_bucket was \
-                                 passed. Ensure the table already exists or pass in a write_destination_bucket where the table\
-                                 will store data.")
-                    LOGGER.exception(exc)
-            
+            elif self.write_destination_bucket is not None: # table doesn't exist
+                # check if permissions are being requested to create new table
+                s3_path=f's3://{self.write_destination_bucket}/{self.database}/{t}'
+                print(f'DIDNT FIND S3 Path:: {s3_path}')
+            else:
+                LOGGER.error(f"TABLE:: [{t}] was not found in DB [{self.database}] and no write_destination_bucket was \
+                             passed. Ensure the table already exists or pass in a write_destination_bucket where the table\
+                             will store data.")
+                continue
+
             loc = urlparse(s3_path)
             bucket=loc.netloc
-            path=loc.path[1:]
+            path=loc.path[1:].rstrip("/")
+            # versioned publishing points an unpartitioned table at <table>/v_<id>/, the next run writes a new version
+            # next to it, so the grant covers the table's root
+            parent, _, last = path.rpartition("/")
+            if last.startswith("v_") and os.path.basename(parent) == t:
+                path = parent
 
             db_arn=f'arn:aws:s3:::{bucket}'
             folder=os.path.join(db_arn,f"{path}_$folder$") # https://aws.amazon.com/premiumsupport/knowledge-center/emr-s3-empty-files/
@@ -69,6 +76,13 @@ class GlueDataCatalogPermissions:
             resources.append(folder)
             resources.append(star)
 
+        if "*" in self.tables and self.write_destination_bucket is not None:
+            # tables created after synth are written under the database's prefix, like the glue grant on table/<db>/*
+            db_arn=f'arn:aws:s3:::{self.write_destination_bucket}'
+            resources.append(db_arn)
+            resources.append(os.path.join(db_arn, f"{self.database}_$folder$"))
+            resources.append(os.path.join(db_arn, self.database, "*"))
+
         read_actions = ["s3:GetObject*", "s3:GetBucket*", "s3:List*", "s3:Head*"]
         write_actions = ["s3:PutObject*", "s3:Abort*", "s3:DeleteObject*"] + read_actions
 
@@ -78,16 +92,21 @@ class GlueDataCatalogPermissions:
     def get_glue_policy(self, access_level: str) -> iam.PolicyStatement:
         """Generates Glue database and table policy statement"""
         read_actions = ["glue:Get*", "glue:BatchGet*"]
-        write_actions = [
+        table_write_actions = [
             "glue:CreateTable",
-            "glue:CreatePartition",
-            "glue:UpdatePartition",
             "glue:UpdateTable",
             "glue:DeleteTable",
+            # overwriting a table clears partitions registered before it was projected
             "glue:DeletePartition",
-            "glue:BatchCreatePartition",
             "glue:BatchDeletePartition",
-        ] + read_actions
+        ]
+        partition_write_actions = [
+            "glue:CreatePartition",
+            "glue:UpdatePartition",
+            "glue:BatchCreatePartition",
+            "glue:BatchUpdatePartition",
+        ]
+        write_actions = table_write_actions + ([] if self.partition_projection else partition_write_actions) + read_actions
         base_arn = f"arn:aws:glue:{self.region}:{self.account_id}"
         table_resources = (
             [f"{base_arn}:table/{self.database}/*"]
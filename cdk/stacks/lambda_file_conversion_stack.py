@@ -1,6 +1,7 @@
 from aws_cdk import (
     Stack,
-    Environment
+    Environment,
+    Duration
 )
 from constructs import Construct
 from aws_cdk import (
@@ -9,13 +10,23 @@ from aws_cdk import (
     aws_glue as _glue,
     aws_lambda  as _lambda,
     aws_iam as _iam,
+    aws_sqs as _sqs,
+    aws_lambda_event_sources as lambda_event_sources,
 )
 from .helpers import s3_glue_iam
 
 
 class FileTypeConversionStack(Stack):
+    """Converts csv files uploaded to the input bucket to parquet tables
 
-    def __init__(self, scope: Construct, construct_id: str, cdk_env:Environment, **kwargs) -> None:
+    By default every upload invokes the function directly. With buffered=True uploads are queued in SQS and
+    the function gets them in batches of up to batch_size events or batch_window_seconds, converting each
+    table's files with one write and one catalog update instead of one per file. A batch holds up to a quarter
+    of the function's memory_size in memory and gets lambda's max 15 minute timeout.
+    """
+
+    def __init__(self, scope: Construct, construct_id: str, cdk_env:Environment, buffered: bool = False,
+                 batch_size: int = 100, batch_window_seconds: int = 60, memory_size: int = 2048, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
         # creating a s3 bucket for input file.
@@ -60,20 +71,46 @@ class FileTypeConversionStack(Stack):
 
         function = _lambda.Function(self, "lambda_function", 
             runtime=_lambda.Runtime.PYTHON_3_8,
-            handler="lambda_func.lambda_handler",
-            code=_lambda.Code.from_asset('../src/file_conversion_lambda'),
+            handler="file_conversion_lambda.lambda_func.lambda_handler",
+            # packaged from src so the function can import the shared instrumentation module
+            code=_lambda.Code.from_asset('../src', exclude=["*", "!file_conversion_lambda", "!file_conversion_lambda/*.py", "!instrumentation.py"]),
             layers=[lambda_wrangler_layer],
             environment={'OUTPUT_BUCKET_NAME': s3_output.bucket_name},
-            role=lambda_role
+            role=lambda_role,
+            # the queue's visibility timeout is this timeout, so a batch isn't redelivered while it's converted
+            timeout=Duration.minutes(15) if buffered else None,
+            memory_size=memory_size if buffered else None
         )
 
         # function s3 permissions
         s3_input.grant_read_write(function)
         s3_output.grant_read_write(function)
 
+        if buffered:
+            # messages that fail 3 batches in a row are parked instead of blocking their table's later files
+            dead_letter_queue = _sqs.Queue(self, "file_conversion_dlq",
+                retention_period=Duration.days(14),
+                encryption=_sqs.QueueEncryption.SQS_MANAGED
+            )
+            upload_queue = _sqs.Queue(self, "file_conversion_queue",
+                # has to be at least the function's timeout, lambda's max so a batch is never redelivered mid conversion
+                visibility_timeout=Duration.minutes(15),
+                encryption=_sqs.QueueEncryption.SQS_MANAGED,
+                dead_letter_queue=_sqs.DeadLetterQueue(max_receive_count=3, queue=dead_letter_queue)
+            )
+            notification_destination = s3n.SqsDestination(upload_queue)
+            function.add_event_source(lambda_event_sources.SqsEventSource(upload_queue,
+                batch_size=batch_size,
+                max_batching_window=Duration.seconds(batch_window_seconds),
+                # the function returns the messages of the tables it failed to convert, the rest are deleted
+                report_batch_item_failures=True
+            ))
+        else:
+            notification_destination = s3n.LambdaDestination(function)
+
         s3_input.add_event_notification(
             _s3.EventType.OBJECT_CREATED,
-            s3n.LambdaDestination(function),
+            notification_destination,
             _s3.NotificationKeyFilter(
                 prefix="s3_inputs/",
                 suffix=".csv"
@@ -114,6 +151,8 @@ class FileTypeConversionStack(Stack):
         crawler_s3 = _glue.CfnCrawler(self, "Crawler_Glue", role=glue_role.role_arn,
             database_name=target_db_name,
             targets={
-                's3Targets' :[{"path": path_name}]
+                # compacted versions are registered by the compaction job, not the crawler
+                # nor are batches the function stages before moving them into their table
+                's3Targets' :[{"path": path_name, "exclusions": ["**_compacted/**", "_staging/**"]}]
             }
         )
@@ -0,0 +1,170 @@
+"""Backfills a partitioned table by fanning one sql_jobs template out over a range of shards
+
+The range is split into shards and the template is rendered once per shard. Shards run concurrently
+up to max_concurrency, each one overwriting only the partitions its slice produces, and a failed
+shard is retried on its own up to max_attempts times.
+
+Spec format:
+{
+    "job": {<MaterializeAthenaQuery arguments, partition_cols is required>},
+    "shards": {"start": "2020-01-01", "end": "2022-01-01", "step_days": 30},
+    "max_concurrency": 4,
+    "max_attempts": 3
+}
+Date range shards render the template with `shard_start` (inclusive) and `shard_end` (exclusive) as
+yyyy-mm-dd strings. Shards can also be a list of values, eg {"values": ["New York", "Washington"]},
+which render the template with `shard_value`.
+"""
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from dataclasses import dataclass, replace
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Any, List, Optional
+import json
+import os
+import sys
+import time
+import uuid
+
+from instrumentation import memory_limit_mb, peak_rss_mb
+from materialize_athena_query import LOGGER, SQL_SCRIPTS_PATH, MaterializeAthenaQuery, load_lazy_modules, save_run_record
+
+# summed over the last attempt of every shard in the backfill's run record
+SUMMED_STATS = ("data_scanned_bytes", "result_rows", "result_bytes")
+
+
+def get_date_shards(start: str, end: str, step_days: int) -> List[Dict[str, Any]]:
+    """Splits [start, end) into consecutive shards of step_days"""
+    shards = []
+    shard_start, range_end = date.fromisoformat(start), date.fromisoformat(end)
+    while shard_start < range_end:
+        shard_end = min(shard_start + timedelta(days=step_days), range_end)
+        shards.append({"shard_start": shard_start.isoformat(), "shard_end": shard_end.isoformat()})
+        shard_start = shard_end
+    return shards
+
+
+@dataclass
+class Backfill:
+    """Backfill runs a MaterializeAthenaQuery job once per shard
+    Args:
+        job (MaterializeAthenaQuery): the job to backfill, its query_params are extended with each shard's params
+        shards (List[Dict]): params rendered into the template for each shard
+        max_concurrency (int, optional): max number of shards (and so Athena queries) running at once
+        max_attempts (int, optional): times a shard is tried before it's reported as failed
+    """
+    job: MaterializeAthenaQuery
+    shards: List[Dict[str, Any]]
+    max_concurrency: int = 4
+    max_attempts: int = 3
+
+    def __post_init__(self):
+        if not self.job.partition_cols:
+            raise ValueError("Backfills need partition_cols so each shard only overwrites its own partitions")
+
+    @classmethod
+    def from_spec(cls, spec_path: str) -> "Backfill":
+        if not os.path.isabs(spec_path):
+            spec_path = os.path.join(SQL_SCRIPTS_PATH, spec_path)
+        with open(spec_path) as f:
+            spec = json.load(f)
+
+        shards = spec["shards"]
+        if "values" in shards:
+            shard_params = [{"shard_value": value} for value in shards["values"]]
+        else:
+            shard_params = get_date_shards(shards["start"], shards["end"], shards.get("step_days", 1))
+        return cls(
+            job=MaterializeAthenaQuery(**spec["job"]),
+            shards=shard_params,
+            max_concurrency=spec.get("max_concurrency", 4),
+            max_attempts=spec.get("max_attempts", 3)
+        )
+
+    def _shard_job(self, shard: Dict[str, Any]) -> MaterializeAthenaQuery:
+        # shards share a target table, so per table state like watermarks and cache entries doesn't apply,
+        # and they'd overwrite each other's stats history, the backfill saves one run for all of them
+        return replace(
+            self.job,
+            query_params={**self.job.query_params, **shard},
+            watermark_column=None,
+            use_cache=False,
+            save_stats=False
+        )
+
+    def _save_run_stats(self, status: str, shard_jobs: Optional[List[MaterializeAthenaQuery]] = None, failed: int = 0):
+        """Records the backfill as one run in the table's backfill_stats history, kept apart from the job's own stats
+        since concurrent shards peak higher than a single run. Like a job's runs it's recorded as running first"""
+        now = datetime.now(timezone.utc).isoformat()
+        if status == "running":
+            self._run_id, self._started_at, self._start = uuid.uuid4().hex, now, time.perf_counter()
+        shard_runs = [job.run_record(status) for job in shard_jobs or []]
+        run = {
+            "run_id": self._run_id,
+            "status": status,
+            "started_at": self._started_at,
+            "completed_at": now,
+            "batch_job_id": os.environ.get("AWS_BATCH_JOB_ID"),
+            "engine": self.job.engine,
+            "chunksize": self.job.chunksize,
+            "shards": len(self.shards),
+            "failed_shards": failed,
+            "max_concurrency": self.max_concurrency,
+            **{name: sum(shard_run[name] for shard_run in shard_runs) for name in SUMMED_STATS},
+            # process wide, every shard runs in this process
+            "peak_rss_mb": peak_rss_mb(),
+            "seconds": round(time.perf_counter() - self._start, 3),
+            "memory_limit_mb": memory_limit_mb(),
+        }
+        # next to the job's own state
+        save_run_record(self.job.state_store, f"{self.job.target_database}/{self.job.target_table}/backfill_stats", run)
+
+    def run(self) -> List[Dict[str, Any]]:
+        """Runs every shard, returns the shards that still failed after max_attempts"""
+        attempts = [0] * len(self.shards)
+        # the latest attempt of each shard
+        shard_jobs: List[MaterializeAthenaQuery] = [None] * len(self.shards)
+        running: Dict[Future, int] = {}
+        failed = []
+
+        # shards first touch awswrangler and boto3 in the pool's threads
+        load_lazy_modules()
+        self._save_run_stats("running")
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            def submit(i: int):
+                attempts[i] += 1
+                LOGGER.info(f"Starting shard {self.shards[i]} (attempt {attempts[i]})")
+                shard_jobs[i] = self._shard_job(self.shards[i])
+                running[pool.submit(shard_jobs[i].process_query, raise_errors=True)] = i
+
+            for i in range(len(self.shards)):
+                submit(i)
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = running.pop(future)
+                    if future.exception() is None:
+                        LOGGER.info(f"Finished shard {self.shards[i]}")
+                    elif attempts[i] < self.max_attempts:
+                        LOGGER.warning(f"Shard {self.shards[i]} failed, retrying")
+                        submit(i)
+                    else:
+                        LOGGER.error(f"Shard {self.shards[i]} failed after {attempts[i]} attempts")
+                        failed.append(self.shards[i])
+
+        self._save_run_stats("failed" if failed else "succeeded", shard_jobs, len(failed))
+        LOGGER.info(f"*****BACKFILL RESULT*****\n\t{len(self.shards) - len(failed)} of {len(self.shards)} shards succeeded")
+        if failed:
+            LOGGER.info(f"*****FAILED SHARDS*****\n{json.dumps(failed, sort_keys=True, indent=2)}")
+        return failed
+
+
+def main(argv):
+    if len(argv) != 2:
+        LOGGER.info("Syntax: python backfill.py <<backfill_spec_path>>")
+        sys.exit(2)
+    if Backfill.from_spec(argv[1]).run():
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,122 @@
+"""Glue catalog calls and time spent registering a table with thousands of partitions
+
+A synthetic table partitioned by state and reporting_date is materialized with the duckdb engine and a chunksize
+into a local moto S3/Glue server, once registering its partitions and once with partition projection. Every Glue
+API call is counted, and the partitions Athena would look up for a query are what's left in the catalog. The
+"per_write" baseline writes the same batches with wr.s3.to_parquet registering each batch's partitions itself,
+as jobs did before partitions were registered in bulk.
+
+    pip install -r benchmarks/requirements.txt
+    python3 benchmarks/bench_catalog.py --days 90 --chunksize 5000 --output catalog.json
+"""
+import argparse
+import collections
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from bench_materialize import DATABASE, OUTPUT_BUCKET, RESULTS_BUCKET, STATES, SRC_PATH, start_stand_in  # noqa: E402
+
+sys.path.insert(0, SRC_PATH)
+
+PARTITION_COLS = ["state", "reporting_date"]
+
+
+def generate_csv(path: str, days: int, rows_per_partition: int):
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(42)
+    dates = pd.date_range("2021-01-01", periods=days).strftime("%Y-%m-%d")
+    rows = len(STATES) * days * rows_per_partition
+    pd.DataFrame({
+        "state": np.repeat(STATES, days * rows_per_partition),
+        "reporting_date": np.tile(np.repeat(dates, rows_per_partition), len(STATES)),
+        "cases": rng.integers(0, 10000, rows),
+    }).sample(frac=1, random_state=42).to_csv(path, index=False)
+
+
+def run(args):
+    import boto3
+    import awswrangler as wr
+    import materialize_athena_query as maq
+    from duckdb_engine import DuckDBEngine
+
+    server, _ = start_stand_in()
+    boto3.setup_default_session()
+    calls = collections.Counter()
+    # awswrangler uses the default session, so this sees every glue call of the writes and the catalog updates
+    boto3.DEFAULT_SESSION.events.register("before-call.glue", lambda model, **kwargs: calls.update([model.name]))
+    for bucket in (RESULTS_BUCKET, OUTPUT_BUCKET):
+        boto3.client("s3").create_bucket(Bucket=bucket)
+    wr.catalog.create_database(DATABASE)
+    source = os.path.join(tempfile.mkdtemp(), "source.csv")
+    generate_csv(source, args.days, args.rows_per_partition)
+    maq.get_query = lambda sql_script, params=None: f"SELECT * FROM {DATABASE}.source"
+
+    cases = {
+        "per_write": None,
+        "bulk": {},
+        "projection": {"partition_projection": {
+            "state": {"type": "enum", "values": STATES},
+            "reporting_date": {"type": "date", "range": "2021-01-01,NOW"},
+        }},
+    }
+    results = {}
+    for name, job_options in cases.items():
+        calls.clear()
+        start = time.perf_counter()
+        if job_options is None:
+            engine = DuckDBEngine(default_database=DATABASE, tables={f"{DATABASE}.source": source})
+            for i, chunk in enumerate(engine.query_chunks(maq.get_query(None), args.chunksize)):
+                wr.s3.to_parquet(df=chunk, path=f"s3://{OUTPUT_BUCKET}/{DATABASE}/{name}", dataset=True, database=DATABASE,
+                                 table=name, mode="overwrite_partitions" if i == 0 else "append", partition_cols=PARTITION_COLS)
+        else:
+            maq.MaterializeAthenaQuery(
+                sql_query_path="stubbed.sql",
+                target_bucket=OUTPUT_BUCKET,
+                target_database=DATABASE,
+                target_table=name,
+                table_description="benchmark output",
+                stg_athena_bucket=RESULTS_BUCKET,
+                partition_cols=PARTITION_COLS,
+                engine="duckdb",
+                local_tables={f"{DATABASE}.source": source},
+                chunksize=args.chunksize,
+                checkpoint=False,
+                **job_options
+            ).process_query(raise_errors=True)
+        seconds = time.perf_counter() - start
+        glue_calls = dict(calls)
+        results[name] = {
+            "seconds": round(seconds, 2),
+            "glue_calls": sum(glue_calls.values()),
+            "glue_calls_by_api": glue_calls,
+            "catalog_partitions": len(wr.catalog.get_partitions(database=DATABASE, table=name)),
+            "rows": int(DuckDBEngine(default_database=DATABASE).query(f"SELECT count(*) AS n FROM {name}")["n"].iloc[0]),
+        }
+    server.stop()
+
+    print(f"{'case':<12} {'seconds':>8} {'glue calls':>11} {'catalog partitions':>19} {'rows':>9}")
+    for name, result in results.items():
+        print(f"{name:<12} {result['seconds']:>8} {result['glue_calls']:>11} {result['catalog_partitions']:>19} {result['rows']:>9}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=int, default=90, help="reporting dates, the table has 50 states x days partitions")
+    parser.add_argument("--rows-per-partition", type=int, default=20, help="rows of every partition")
+    parser.add_argument("--chunksize", type=int, default=5000, help="rows per streamed batch")
+    parser.add_argument("--output", help="write the results as json")
+    run(parser.parse_args(argv[1:]))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
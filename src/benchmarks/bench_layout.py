@@ -0,0 +1,126 @@
+"""Bytes scanned by filtered queries against the default Parquet layout and tuned layouts
+
+A synthetic county level covid table is written with ParquetWriter to a local moto S3 once per layout. For
+each typical dashboard filter the benchmark reads the files' footers and counts what Athena would read: the
+column chunks of the referenced columns in every row group whose min/max statistics can't rule the filter
+out. Footers are left out, they're the same few KB for every layout.
+
+    pip install -r benchmarks/requirements.txt
+    python3 benchmarks/bench_layout.py --rows 1000000 --output layout.json
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from bench_materialize import SRC_PATH, OUTPUT_BUCKET, start_stand_in  # noqa: E402
+
+sys.path.insert(0, SRC_PATH)
+
+LAYOUTS = {
+    "default": {},
+    "zstd": {"compression": "zstd"},
+    "sorted": {"sort_by": ["reporting_date", "fips"], "row_group_rows": 100000},
+    "sorted_zstd_dict": {"sort_by": ["reporting_date", "fips"], "row_group_rows": 100000, "compression": "zstd",
+                         "dictionary_columns": ["state", "county", "reporting_date"]},
+}
+
+# (columns read, {column: (low, high)} filters), as in "SELECT sum(cases) ... WHERE reporting_date = '2021-06-01'"
+QUERIES = {
+    "one_day": (["cases"], {"reporting_date": ("2021-06-01", "2021-06-01")}),
+    "one_week": (["cases", "deaths"], {"reporting_date": ("2021-06-01", "2021-06-07")}),
+    "one_county": (["cases"], {"fips": (36061, 36061)}),
+    "county_last_month": (["cases", "deaths"], {"fips": (36061, 36061), "reporting_date": ("2021-12-01", "2021-12-31")}),
+}
+
+
+def generate_frame(rows: int):
+    """Rows arrive in no particular order, like an unsorted Athena result"""
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(42)
+    fips = rng.integers(1001, 56045, 3000)
+    county_fips = rng.choice(fips, rows)
+    return pd.DataFrame({
+        "reporting_date": (pd.Timestamp("2021-01-01") + pd.to_timedelta(rng.integers(0, 365, rows), unit="D")).strftime("%Y-%m-%d"),
+        "fips": county_fips,
+        "state": pd.Series(county_fips // 1000).map(lambda code: f"state_{code:02d}"),
+        "county": pd.Series(county_fips).map(lambda code: f"county_{code}"),
+        "cases": rng.integers(0, 10000, rows),
+        "deaths": rng.integers(0, 100, rows),
+    })
+
+
+def scanned_bytes(metadata, columns, filters) -> int:
+    """Compressed bytes of the referenced columns in the row groups the filters can't skip"""
+    names = [metadata.schema.column(i).name for i in range(metadata.num_columns)]
+    scanned = 0
+    for rg in range(metadata.num_row_groups):
+        row_group = metadata.row_group(rg)
+        chunks = {names[i]: row_group.column(i) for i in range(row_group.num_columns)}
+        skip = False
+        for col, (low, high) in filters.items():
+            stats = chunks[col].statistics
+            if stats is not None and stats.has_min_max and (stats.max < low or stats.min > high):
+                skip = True
+                break
+        if not skip:
+            scanned += sum(chunks[col].total_compressed_size for col in set(columns) | set(filters))
+    return scanned
+
+
+def run(args):
+    import boto3
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from parquet_writer import ParquetWriter
+
+    server, _ = start_stand_in()
+    s3 = boto3.client("s3")
+    s3.create_bucket(Bucket=OUTPUT_BUCKET)
+    df = generate_frame(args.rows)
+
+    results = {}
+    for name, layout in LAYOUTS.items():
+        path = f"s3://{OUTPUT_BUCKET}/layout/{name}/"
+        paths = ParquetWriter(path=path, database=None, table=name, target_file_mb=args.target_file_mb, **layout).write(df, "overwrite")["paths"]
+        footers = []
+        total = 0
+        for file_path in paths:
+            bucket, key = file_path[len("s3://"):].split("/", 1)
+            body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+            total += len(body)
+            footers.append(pq.ParquetFile(pa.BufferReader(body)).metadata)
+        results[name] = {
+            "files": len(paths),
+            "row_groups": sum(footer.num_row_groups for footer in footers),
+            "total_mb": round(total / 1024 ** 2, 2),
+            "scanned_mb": {
+                query: round(sum(scanned_bytes(footer, columns, filters) for footer in footers) / 1024 ** 2, 3)
+                for query, (columns, filters) in QUERIES.items()
+            },
+        }
+    server.stop()
+
+    print(f"{'layout':<18} {'files':>6} {'row groups':>11} {'size MB':>9} " + " ".join(f"{query:>18}" for query in QUERIES))
+    for name, result in results.items():
+        print(f"{name:<18} {result['files']:>6} {result['row_groups']:>11} {result['total_mb']:>9} "
+              + " ".join(f"{result['scanned_mb'][query]:>15} MB" for query in QUERIES))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000000, help="rows in the synthetic table")
+    parser.add_argument("--target-file-mb", type=int, default=32, help="file size every layout is written with")
+    parser.add_argument("--output", help="write the results as json")
+    run(parser.parse_args(argv[1:]))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,240 @@
+"""Offline benchmarks for MaterializeAthenaQuery.process_query and the file conversion lambda
+
+Both paths run against a local moto S3/Glue server. Athena is stubbed: the query "runs" instantly and
+its result is a pre-generated csv in the local S3, which is then downloaded, parsed and written exactly
+like a real result. With --job-options '{"engine": "duckdb"}' the query really runs, in DuckDB over the
+same csv. Each case runs in its own process so peak RSS isn't shared between cases.
+
+    pip install -r benchmarks/requirements.txt
+    python3 benchmarks/bench_materialize.py --rows 10000,1000000 --output before.json
+    python3 benchmarks/bench_materialize.py --rows 10000,1000000 --output after.json
+    python3 benchmarks/bench_materialize.py --compare before.json after.json
+"""
+import argparse
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+
+SRC_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path[:0] = [SRC_PATH, os.path.join(SRC_PATH, "file_conversion_lambda")]
+
+RESULTS_BUCKET = "bench-athena-results"
+OUTPUT_BUCKET = "bench-output"
+DATABASE = "bench"
+STATES = [f"state_{i:02d}" for i in range(50)]
+RESULT_MARKER = "BENCH_RESULT "
+
+
+def generate_csv(path: str, rows: int, schema: str, block_rows: int = 1000000):
+    """Writes a synthetic csv block by block so 100M row datasets don't need to fit in memory"""
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(42)
+    for start in range(0, rows, block_rows):
+        n = min(block_rows, rows - start)
+        df = pd.DataFrame({
+            "id": np.arange(start, start + n),
+            "state": rng.choice(STATES, n),
+            "reporting_date": (pd.Timestamp("2021-01-01") + pd.to_timedelta(rng.integers(0, 365, n), unit="D")).strftime("%Y-%m-%d"),
+            "cases": rng.integers(0, 10000, n),
+            "rate": rng.random(n),
+        })
+        if schema == "wide":
+            for i in range(45):
+                df[f"metric_{i:02d}"] = rng.random(n) if i % 2 else rng.choice(STATES, n)
+        df.to_csv(path, mode="a" if start else "w", header=not start, index=False)
+
+
+def dataset_key(rows: int, schema: str) -> str:
+    return f"results/{schema}-{rows}.csv"
+
+
+def run_materialize_case(case):
+    import awswrangler as wr
+    import materialize_athena_query as maq
+    from instrumentation import peak_rss_mb
+
+    result_path = f"s3://{RESULTS_BUCKET}/{dataset_key(case['rows'], case['schema'])}"
+
+    # stubbed athena: the "query" finishes instantly and its result is the pre-generated csv
+    def run_athena_statement(self, sql, checkpoint=None, **checkpoint_values):
+        if checkpoint:
+            self._save_checkpoint(checkpoint, query_execution_id=result_path, **checkpoint_values)
+        self._log_query_stats({"QueryQueueTimeInMillis": 0, "EngineExecutionTimeInMillis": 0, "DataScannedInBytes": 0})
+        self._result_location = result_path
+        return result_path
+
+    def get_query_results(query_execution_id, categories=None, chunksize=None, **kwargs):
+        dtype = {col: "category" for col in categories or []}
+        return wr.s3.read_csv(query_execution_id, chunksize=chunksize, parse_dates=["reporting_date"], dtype=dtype)
+
+    job_options = dict(case["job_options"])
+    if job_options.get("engine") == "duckdb":
+        # a real local engine instead of the stub, reading the result csv as a source table
+        job_options["local_tables"] = {f"{DATABASE}.source": result_path}
+        maq.get_query = lambda sql_script, params=None: f"SELECT * FROM {DATABASE}.source"
+    else:
+        maq.MaterializeAthenaQuery._run_athena_statement = run_athena_statement
+        maq.wr.athena.get_query_results = get_query_results
+        maq.get_query = lambda sql_script, params=None: "SELECT * FROM stubbed"
+
+    job = maq.MaterializeAthenaQuery(
+        sql_query_path="stubbed.sql",
+        target_bucket=OUTPUT_BUCKET,
+        target_database=DATABASE,
+        target_table=case["name"],
+        table_description="benchmark output",
+        stg_athena_bucket=RESULTS_BUCKET,
+        partition_cols=["state"] if case["partitioned"] else [],
+        **job_options
+    )
+    job.process_query(raise_errors=True)
+
+    stages = job.metrics.stages
+    seconds = sum(stages[stage]["seconds"] for stage in ("download_parse", "local_query", "write") if stage in stages)
+    input_bytes = wr.s3.size_objects(path=result_path)[result_path]
+    output_files = wr.s3.list_objects(path=f"{job.s3_dataset_output}/")
+    return {
+        "seconds": round(seconds, 3),
+        "rows_per_s": round(case["rows"] / seconds),
+        "mb_per_s": round(input_bytes / 1024 ** 2 / seconds, 2),
+        "peak_rss_mb": peak_rss_mb(),
+        "files": len(output_files),
+        "output_mb": round(sum(wr.s3.size_objects(path=output_files).values()) / 1024 ** 2, 2),
+        "stages": {stage: round(stats["seconds"], 3) for stage, stats in stages.items()},
+    }
+
+
+def run_lambda_case(case):
+    os.environ["OUTPUT_BUCKET_NAME"] = OUTPUT_BUCKET
+    # the lambda catalogs into the global config's glue db
+    os.environ["WR_DATABASE"] = DATABASE
+    import lambda_func
+
+    key = dataset_key(case["rows"], case["schema"])
+    event = {"Records": [{"s3": {"bucket": {"name": RESULTS_BUCKET}, "object": {"key": key}}}]}
+    stats = lambda_func.lambda_handler(event, None)["Files"][0]
+    return {
+        "seconds": stats["Seconds"],
+        "rows_per_s": round(stats["Rows"] / stats["Seconds"]),
+        "mb_per_s": stats["MBPerSecond"],
+        "peak_rss_mb": stats["PeakRssMB"],
+    }
+
+
+def run_case(case):
+    result = run_materialize_case(case) if case["path"] == "materialize" else run_lambda_case(case)
+    print(RESULT_MARKER + json.dumps({**case, **result}, sort_keys=True))
+
+
+def start_stand_in():
+    """Starts a moto S3/Glue server, returns the environment pointing every client at it"""
+    import logging
+    from moto.server import ThreadedMotoServer
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+    server.start()
+    endpoint = f"http://127.0.0.1:{port}"
+    env = {
+        "AWS_ACCESS_KEY_ID": "bench",
+        "AWS_SECRET_ACCESS_KEY": "bench",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "AWS_ENDPOINT_URL": endpoint,
+        "WR_S3_ENDPOINT_URL": endpoint,
+        "WR_GLUE_ENDPOINT_URL": endpoint,
+    }
+    os.environ.update(env)
+    return server, env
+
+
+def run(args):
+    import boto3
+    import awswrangler as wr
+
+    server, env = start_stand_in()
+    for bucket in (RESULTS_BUCKET, OUTPUT_BUCKET):
+        boto3.client("s3").create_bucket(Bucket=bucket)
+    wr.catalog.create_database(DATABASE, exist_ok=True)
+
+    sizes = [int(rows) for rows in args.rows.split(",")]
+    schemas = args.schemas.split(",")
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows, schema in itertools.product(sizes, schemas):
+            csv_path = os.path.join(tmp, "data.csv")
+            generate_csv(csv_path, rows, schema)
+            wr.s3.upload(local_file=csv_path, path=f"s3://{RESULTS_BUCKET}/{dataset_key(rows, schema)}")
+            os.remove(csv_path)
+
+    job_options = json.loads(args.job_options)
+    cases = []
+    for rows, schema, partitioned in itertools.product(sizes, schemas, (False, True)):
+        name = f"{schema}_{rows}_{'partitioned' if partitioned else 'flat'}"
+        cases.append({"path": "materialize", "name": name, "rows": rows, "schema": schema,
+                      "partitioned": partitioned, "job_options": job_options})
+    for rows, schema in itertools.product(sizes, schemas):
+        cases.append({"path": "lambda", "name": f"{schema}_{rows}", "rows": rows, "schema": schema,
+                      "partitioned": False, "job_options": {}})
+
+    results = []
+    for case in cases:
+        proc = subprocess.run(
+            [sys.executable, __file__, "--run-case", json.dumps(case)],
+            env={**os.environ, **env}, capture_output=True, text=True
+        )
+        lines = [line for line in proc.stdout.splitlines() if line.startswith(RESULT_MARKER)]
+        if proc.returncode or not lines:
+            print(f"{case['path']} {case['name']} failed:\n{proc.stderr[-2000:]}", file=sys.stderr)
+            continue
+        result = json.loads(lines[-1][len(RESULT_MARKER):])
+        print(f"{result['path']:<12} {result['name']:<32} {result['rows_per_s']:>12,} rows/s "
+              f"{result['mb_per_s']:>8} MB/s {result['peak_rss_mb']:>8} MB peak")
+        results.append(result)
+    server.stop()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+def compare(before_path: str, after_path: str):
+    with open(before_path) as f:
+        before = {(r["path"], r["name"]): r for r in json.load(f)}
+    with open(after_path) as f:
+        after = {(r["path"], r["name"]): r for r in json.load(f)}
+    print(f"{'case':<46} {'rows/s':>10} {'peak MB':>10} {'files':>8}")
+    for key in sorted(before.keys() & after.keys()):
+        b, a = before[key], after[key]
+        files = f"{b['files']}->{a['files']}" if "files" in b and "files" in a else "-"
+        print(f"{' '.join(key):<46} {(a['rows_per_s'] / b['rows_per_s'] - 1) * 100:>+9.1f}% "
+              f"{(a['peak_rss_mb'] / b['peak_rss_mb'] - 1) * 100:>+9.1f}% {files:>8}")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", default="10000,100000,1000000", help="comma separated dataset sizes, eg 10000,100000000")
+    parser.add_argument("--schemas", default="narrow,wide", help="comma separated schemas: narrow (5 columns), wide (50)")
+    parser.add_argument("--job-options", default="{}", help="json MaterializeAthenaQuery arguments for every case, eg '{\"chunksize\": 100000}'")
+    parser.add_argument("--output", help="write the results as json to compare with another run")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two result files")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv[1:])
+
+    if args.run_case:
+        run_case(json.loads(args.run_case))
+    elif args.compare:
+        compare(*args.compare)
+    else:
+        run(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,71 @@
+"""Startup benchmarks for the batch job entrypoint, no AWS account or stand-in needed
+
+Each case runs in a fresh interpreter, like a new container, and the median of --repeat runs is reported:
+    usage_error      python3 materialize_athena_query.py with no arguments, the job's fastest exit
+    import           importing materialize_athena_query
+    import_heavy     importing materialize_athena_query and touching awswrangler, what a real run pays up front
+    render           rendering every sql_jobs template
+
+    python3 benchmarks/bench_startup.py --output before.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SRC_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+RENDER_ALL = """
+import os
+import materialize_athena_query as maq
+params = {"watermark": None, "shard_start": "2021-01-01", "shard_end": "2021-01-02", "shard_value": "x"}
+for root, _, files in os.walk(maq.SQL_SCRIPTS_PATH):
+    for name in files:
+        if name.endswith(".sql"):
+            maq.get_query(os.path.relpath(os.path.join(root, name), maq.SQL_SCRIPTS_PATH).replace(os.sep, "/"), params)
+"""
+
+CASES = {
+    "usage_error": ["materialize_athena_query.py"],
+    "import": ["-c", "import materialize_athena_query"],
+    "import_heavy": ["-c", "import materialize_athena_query as maq; maq.wr.config"],
+    "render": ["-c", RENDER_ALL],
+}
+# the usage error exits with 2 like any command line tool given the wrong arguments
+EXIT_CODES = {"usage_error": 2}
+
+
+def time_case(args, env, repeat, exit_code=0):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, *args], cwd=SRC_PATH, env=env, capture_output=True)
+        timings.append(time.perf_counter() - start)
+        if result.returncode != exit_code:
+            raise subprocess.CalledProcessError(result.returncode, result.args, result.stdout, result.stderr)
+    return round(statistics.median(timings) * 1000, 1)
+
+
+def run(args):
+    results = {}
+    for name, case_args in CASES.items():
+        results[name] = time_case(case_args, dict(os.environ), args.repeat, EXIT_CODES.get(name, 0))
+        print(f"{name:<16} {results[name]:>8} ms")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=10, help="runs per case, the median is reported")
+    parser.add_argument("--output", help="write the results as json")
+    run(parser.parse_args(argv[1:]))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,257 @@
+"""Compacts the small parquet files of a Glue table, or of each of its partitions, into files of a target size
+
+Tables written with mode="append" (eg the file conversion lambda's ingested_csv datasets) collect one
+small file per write, which makes Athena scans slow and expensive. Compacted files are written to a new
+versioned prefix next to the table, `<table location>_compacted/<version>/`, and the table or partition
+location is then switched to it with a single catalog update. Readers only ever see the old complete set
+of files or the new one. Replaced files are deleted on a later run once retention_hours have passed so
+queries that started before the switch can still finish. Writers that looked up the old location just before
+the switch can still add files to it, so before the replaced files are deleted, files that landed there since
+are copied to the current location.
+"""
+from dataclasses import dataclass, field
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Any, List, Optional
+from urllib.parse import urlparse
+import json
+import logging
+import sys
+import uuid
+
+import boto3
+import awswrangler as wr
+import pandas as pd
+
+from state_store import StateStore, get_state_store
+
+LOGGER = logging.getLogger(__name__)
+
+COMPACTED_SUFFIX = "_compacted/"
+
+
+def list_files(location: str) -> Dict[str, int]:
+    """Lists the parquet files directly under a location (not in sub prefixes) with their sizes"""
+    loc = urlparse(location)
+    files = {}
+    paginator = boto3.client('s3').get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=loc.netloc, Prefix=loc.path[1:], Delimiter='/'):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('.parquet'):
+                files[f"s3://{loc.netloc}/{obj['Key']}"] = obj['Size']
+    return files
+
+
+@dataclass
+class CompactSmallFiles:
+    """CompactSmallFiles merges small files of a table into right sized ones
+    Args:
+        database (str): glue db of the table
+        table (str): table to compact
+        stg_athena_bucket (str): temp location where Athena results of the scan timing queries are stored
+        target_file_mb (int, optional): size the compacted files are built up to
+        small_file_mb (int, optional): files under this size are compacted, larger ones are carried over as is
+        retention_hours (int, optional): hours replaced files are kept for in flight queries before they're deleted
+        state_store_uri (str, optional): where replaced files waiting to expire are tracked,
+            defaults to s3://<stg_athena_bucket>/_materialize_state
+    """
+    database: str
+    table: str
+    stg_athena_bucket: str
+    target_file_mb: int = 128
+    small_file_mb: int = 32
+    retention_hours: int = 24
+    state_store_uri: str = None
+    version: str = field(init=False)
+
+    def __post_init__(self):
+        # the suffix keeps compactions of a table started in the same second apart
+        self.version = f"{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        self.glue = boto3.client('glue')
+        self.state_store: StateStore = get_state_store(
+            self.state_store_uri or f"s3://{self.stg_athena_bucket}/_materialize_state"
+        )
+        self.state_key = f"{self.database}/{self.table}/compaction"
+
+    def _time_scan(self) -> Dict[str, Any]:
+        df = wr.athena.read_sql_query(
+            sql=f'SELECT count(*) AS row_count FROM "{self.database}"."{self.table}"',
+            database=self.database,
+            ctas_approach=False,
+            s3_output=f"s3://{self.stg_athena_bucket}/{self.table}"
+        )
+        stats = df.query_metadata["Statistics"]
+        return {
+            "rows": int(df["row_count"].iloc[0]),
+            "engine_execution_ms": stats["EngineExecutionTimeInMillis"],
+            "total_execution_ms": stats["TotalExecutionTimeInMillis"],
+            "data_scanned_bytes": stats["DataScannedInBytes"],
+        }
+
+    def _compacted_location(self, table_location: str, location: str) -> str:
+        # strip a previous compaction version so the new one is built relative to the original table location
+        base = table_location.split(COMPACTED_SUFFIX)[0].rstrip("/")
+        relative = location.rstrip("/") + "/"
+        if COMPACTED_SUFFIX in relative:
+            relative = relative.split(COMPACTED_SUFFIX, 1)[1].split("/", 1)[1]
+        else:
+            relative = relative[len(table_location.rstrip("/")) + 1:]
+        return f"{base}{COMPACTED_SUFFIX}{self.version}/{relative}"
+
+    def _compact_location(self, location: str, new_location: str, dtype: Dict[str, str]) -> List[str]:
+        """Writes the compacted copy of a location, returns the replaced files or [] if there was nothing to compact"""
+        files = list_files(location)
+        small = {path: size for path, size in files.items() if size < self.small_file_mb * 1024 ** 2}
+        if len(small) < 2:
+            return []
+
+        # bin small files up to the target size, compressed input size approximates the output size
+        bins, current, current_size = [], [], 0
+        for path, size in sorted(small.items()):
+            if current and current_size + size > self.target_file_mb * 1024 ** 2:
+                bins.append(current)
+                current, current_size = [], 0
+            current.append(path)
+            current_size += size
+        bins.append(current)
+
+        for i, paths in enumerate(bins):
+            # read files one by one so ones written before a schema evolution still line up
+            df = pd.concat([wr.s3.read_parquet(path=path) for path in paths], ignore_index=True)
+            wr.s3.to_parquet(
+                df=df,
+                path=f"{new_location}compacted-{self.version}-{i:05d}.snappy.parquet",
+                index=False,
+                dtype={col: col_type for col, col_type in dtype.items() if col in df.columns}
+            )
+        large = [path for path in files if path not in small]
+        if large:
+            wr.s3.copy_objects(paths=large, source_path=location, target_path=new_location)
+        LOGGER.info(f"Compacted {len(small)} small files of {location} into {len(bins)} ({len(large)} carried over)")
+        return list(files)
+
+    def _catch_up(self, location: str, new_location: str, replaced: List[str]) -> List[str]:
+        """Copies files that landed in the old location while it was being compacted"""
+        late = [path for path in list_files(location) if path not in replaced]
+        if late:
+            LOGGER.info(f"Carrying over {len(late)} files written to {location} during compaction")
+            wr.s3.copy_objects(paths=late, source_path=location, target_path=new_location)
+        return late
+
+    def _current_location(self, values: Optional[List[str]]) -> str:
+        if values is None:
+            return self.glue.get_table(DatabaseName=self.database, Name=self.table)['Table']['StorageDescriptor']['Location']
+        return self.glue.get_partition(
+            DatabaseName=self.database, TableName=self.table, PartitionValues=values
+        )['Partition']['StorageDescriptor']['Location']
+
+    def _expire_replaced_files(self):
+        state = self.state_store.get(self.state_key) or {"pending": []}
+        now = datetime.now(timezone.utc)
+        keep = []
+        for entry in state["pending"]:
+            if datetime.fromisoformat(entry["expire_after"]) <= now:
+                paths = list(entry["paths"])
+                for moved in entry.get("locations", []):
+                    try:
+                        current = self._current_location(moved["values"]).rstrip("/") + "/"
+                    except self.glue.exceptions.EntityNotFoundException:
+                        continue
+                    # a location that's current again (eg a partition rewritten in place) holds live files
+                    if current != moved["location"]:
+                        paths.extend(self._catch_up(moved["location"], current, entry["paths"]))
+                LOGGER.info(f"Deleting {len(paths)} files replaced by compaction {entry['version']}")
+                wr.s3.delete_objects(path=paths)
+            else:
+                keep.append(entry)
+        state["pending"] = keep
+        self.state_store.put(self.state_key, state)
+
+    def run(self) -> Dict[str, Any]:
+        self._expire_replaced_files()
+        before = self._time_scan()
+
+        glue_table = self.glue.get_table(DatabaseName=self.database, Name=self.table)['Table']
+        table_location = glue_table['StorageDescriptor']['Location']
+        dtype = {col['Name']: col['Type'] for col in glue_table['StorageDescriptor']['Columns']}
+        if glue_table.get('PartitionKeys'):
+            locations = wr.catalog.get_partitions(database=self.database, table=self.table)
+        else:
+            locations = {table_location: None}
+
+        replaced, files_before, files_after, partition_updates = [], 0, 0, []
+        for location, values in locations.items():
+            location = location.rstrip("/") + "/"
+            new_location = self._compacted_location(table_location, location)
+            files_before += len(list_files(location))
+            location_replaced = self._compact_location(location, new_location, dtype)
+            if not location_replaced:
+                files_after += len(list_files(location))
+                continue
+            if values is None:
+                table_input = {k: v for k, v in glue_table.items() if k in (
+                    'Name', 'Description', 'Owner', 'Retention', 'StorageDescriptor', 'PartitionKeys',
+                    'TableType', 'Parameters'
+                )}
+                table_input['StorageDescriptor']['Location'] = new_location
+                self.glue.update_table(DatabaseName=self.database, TableInput=table_input)
+            else:
+                partition = self.glue.get_partition(DatabaseName=self.database, TableName=self.table, PartitionValues=values)['Partition']
+                partition['StorageDescriptor']['Location'] = new_location
+                partition_updates.append({
+                    'PartitionValueList': values,
+                    'PartitionInput': {'Values': values, 'StorageDescriptor': partition['StorageDescriptor'],
+                                       'Parameters': partition.get('Parameters', {})}
+                })
+            replaced.append((location, values, new_location, location_replaced))
+
+        # glue takes up to 100 partition updates per call
+        for i in range(0, len(partition_updates), 100):
+            self.glue.batch_update_partition(
+                DatabaseName=self.database, TableName=self.table, Entries=partition_updates[i:i + 100]
+            )
+
+        expiring, moved = [], []
+        for location, values, new_location, location_replaced in replaced:
+            late = self._catch_up(location, new_location, location_replaced)
+            expiring.extend(location_replaced + late)
+            moved.append({"location": location, "values": values})
+            files_after += len(list_files(new_location))
+        if expiring:
+            state = self.state_store.get(self.state_key) or {"pending": []}
+            state["pending"].append({
+                "version": self.version,
+                "expire_after": (datetime.now(timezone.utc) + timedelta(hours=self.retention_hours)).isoformat(),
+                "paths": expiring,
+                # caught up again at expiry, see _expire_replaced_files
+                "locations": moved
+            })
+            self.state_store.put(self.state_key, state)
+
+        report = {
+            "table": f"{self.database}.{self.table}",
+            "locations_compacted": len(replaced),
+            "files_before": files_before,
+            "files_after": files_after,
+            "scan_before": before,
+            "scan_after": self._time_scan(),
+        }
+        LOGGER.info(f"*****COMPACTION RESULT*****\n{json.dumps(report, sort_keys=True, indent=2)}")
+        return report
+
+
+def main(argv):
+    if len(argv) not in (4, 5):
+        LOGGER.info("Syntax: python compact_small_files.py <<database>> <<table>> <<stg_athena_bucket>> [<<job_options_json>>]")
+        sys.exit(2)
+    # optional json object with any other CompactSmallFiles arguments, eg '{"target_file_mb": 256}'
+    job_options = json.loads(argv[4]) if len(argv) == 5 else {}
+    CompactSmallFiles(database=argv[1], table=argv[2], stg_athena_bucket=argv[3], **job_options).run()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s.%(msecs)03d %(levelname)s %(module)s - %(funcName)s: %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+    )
+    main(sys.argv)
@@ -0,0 +1,203 @@
+"""Runs rendered sql_jobs queries with an embedded DuckDB instead of Athena
+
+Meant for iterating on templates and for CI, small jobs run in seconds with no Athena queueing. Source tables
+are read into DuckDB under their Athena names ("database"."table"), either from the paths given in `tables`
+(local or s3:// Parquet and csv files) or, for tables that aren't given, from the Glue catalog's locations. With
+AWS_ENDPOINT_URL pointing at a moto server that's a local S3/Glue stand-in, see benchmarks/bench_materialize.py.
+
+Presto/Trino functions DuckDB doesn't have are added as macros (PRESTO_MACROS). The rest of the shim rewrites the
+query before it runs (to_duckdb_sql): date_parse and date_format take a MySQL style format, which DuckDB needs as
+a constant, so calls with a literal format become strptime and strftime, and try(cast(x AS t)) becomes
+try_cast(x AS t) since DuckDB's try can't wrap window functions. Other uses of try need duckdb>=1.3.
+"""
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+import logging
+import re
+
+import awswrangler as wr
+import duckdb
+import pandas as pd
+import pyarrow as pa
+
+from materialize_athena_query import get_source_tables
+
+LOGGER = logging.getLogger()
+
+# Presto (MySQL style) date format specifiers and their strftime equivalents, applied in order
+PRESTO_DATE_FORMATS = [
+    ("%M", "%B"), ("%W", "%A"), ("%i", "%M"), ("%s", "%S"), ("%h", "%I"), ("%T", "%H:%M:%S"),
+    ("%r", "%I:%M:%S %p"), ("%c", "%-m"), ("%e", "%-d"), ("%k", "%-H"), ("%l", "%-I"),
+]
+
+
+PRESTO_FORMAT_FUNCTIONS = {"date_parse": "strptime", "date_format": "strftime"}
+SHIMMED_CALL_PATTERN = re.compile(r"\b(date_parse|date_format|try)\s*\(", re.IGNORECASE)
+CAST_PATTERN = re.compile(r"cast\s*\(", re.IGNORECASE)
+
+PRESTO_MACROS = {
+    "from_iso8601_timestamp(s)": "CAST(s AS TIMESTAMP)",
+    "from_iso8601_date(s)": "CAST(s AS DATE)",
+    "to_unixtime(ts)": "epoch(ts)",
+    "from_unixtime(x)": "to_timestamp(x)",
+    "approx_distinct(x)": "approx_count_distinct(x)",
+    "cardinality(a)": "len(a)",
+    "regexp_like(s, pattern)": "regexp_matches(s, pattern)",
+    "day_of_week(d)": "isodow(d)",
+    "dow(d)": "isodow(d)",
+    "day_of_year(d)": "dayofyear(d)",
+    "doy(d)": "dayofyear(d)",
+}
+
+# Athena results come back with nullable integers, not the floats pandas turns integers with nulls into
+INT_TYPES = {pa_type: pd.Int64Dtype() for pa_type in (pa.int8(), pa.int16(), pa.int32(), pa.int64())}
+GLUE_TO_PANDAS_TYPES = {"tinyint": "Int64", "smallint": "Int64", "int": "Int64", "integer": "Int64", "bigint": "Int64",
+                        "float": "float64", "double": "float64", "boolean": "boolean"}
+
+
+def to_strftime_format(fmt: str) -> str:
+    for presto, strftime in PRESTO_DATE_FORMATS:
+        fmt = fmt.replace(presto, strftime)
+    return fmt
+
+
+def _scan_call(sql: str, start: int) -> Tuple[Optional[int], List[int]]:
+    """Finds the closing paren of a call whose arguments start at start, and its top level commas"""
+    depth, quote, commas = 0, None, []
+    for i in range(start, len(sql)):
+        char = sql[i]
+        if quote:
+            quote = None if char == quote else quote
+        elif char in "'\"":
+            quote = char
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            if depth == 0:
+                return i, commas
+            depth -= 1
+        elif char == "," and depth == 0:
+            commas.append(i)
+    return None, commas
+
+
+def to_duckdb_sql(sql: str) -> str:
+    """Rewrites the Presto calls DuckDB can't run as they are, see the module docstring"""
+    out, pos = [], 0
+    for match in SHIMMED_CALL_PATTERN.finditer(sql):
+        if match.start() < pos:
+            # inside a call already rewritten, its arguments were rewritten with it
+            continue
+        end, commas = _scan_call(sql, match.end())
+        if end is None:
+            continue
+        function = match.group(1).lower()
+        if function == "try":
+            inner = sql[match.end():end].strip()
+            cast = CAST_PATTERN.match(inner)
+            if not cast or _scan_call(inner, cast.end())[0] != len(inner) - 1:
+                continue
+            call = f"try_cast({to_duckdb_sql(inner[cast.end():-1])})"
+        else:
+            fmt = sql[commas[-1] + 1:end].strip() if commas else ""
+            if not (fmt.startswith("'") and fmt.endswith("'")):
+                continue
+            call = f"{PRESTO_FORMAT_FUNCTIONS[function]}({to_duckdb_sql(sql[match.end():commas[-1]])}, {to_strftime_format(fmt)})"
+        out.append(sql[pos:match.start()] + call)
+        pos = end + 1
+    return "".join(out) + sql[pos:]
+
+
+def read_glue_table(database: str, table: str) -> Optional[pd.DataFrame]:
+    """Reads a catalog table from its S3 location, None when it isn't in the catalog. Partitions are read from their
+    own locations, so tables whose partitions were moved (compaction, versioned publishing) read like in Athena"""
+    if not wr.catalog.does_table_exist(database=database, table=table):
+        return None
+    types = wr.catalog.get_table_types(database=database, table=table)
+    partitions = wr.catalog.get_partitions(database=database, table=table)
+    if not partitions:
+        return wr.s3.read_parquet(path=wr.catalog.get_table_location(database=database, table=table), dataset=True)
+    glue_table = wr.catalog.table(database=database, table=table)
+    keys = glue_table.loc[glue_table["Partition"], "Column Name"].tolist()
+    frames = []
+    for location, values in partitions.items():
+        df = wr.s3.read_parquet(path=location)
+        for key, value in zip(keys, values):
+            df[key] = value
+        frames.append(df)
+    df = pd.concat(frames, ignore_index=True)
+    for key in keys:
+        if types[key] in ("date", "timestamp"):
+            df[key] = pd.to_datetime(df[key])
+        elif types[key] in GLUE_TO_PANDAS_TYPES:
+            df[key] = df[key].astype(GLUE_TO_PANDAS_TYPES[types[key]])
+    return df
+
+
+@dataclass
+class DuckDBEngine:
+    """DuckDBEngine runs Athena queries locally
+    Args:
+        default_database (str): database of unqualified table names, like Athena's query context
+        tables (Dict[str, str], optional): "database.table" names and where to read them, a local or s3:// path to
+            a Parquet (or .csv) file, directory or glob. Tables that aren't listed are read from the Glue catalog
+    """
+    default_database: str
+    tables: Dict[str, str] = field(default_factory=dict)
+
+    def __post_init__(self):
+        self.conn = duckdb.connect()
+        for signature, body in PRESTO_MACROS.items():
+            self.conn.execute(f"CREATE OR REPLACE MACRO {signature} AS {body}")
+        self._loaded: List[str] = []
+
+    def _source_sql(self, location: str) -> str:
+        reader = "read_csv_auto" if location.endswith(".csv") else "read_parquet"
+        if not location.endswith((".csv", ".parquet")) and "*" not in location:
+            location = location.rstrip("/") + "/**/*.parquet"
+        options = "" if reader == "read_csv_auto" else ", hive_partitioning = true"
+        return f"SELECT * FROM {reader}('{location}'{options})"
+
+    def _load_table(self, name: str):
+        database, table = name.split(".", 1)
+        location = self.tables.get(name)
+        if location is None:
+            df = read_glue_table(database, table)
+            if df is None:
+                # a CTE or subquery alias rather than a table
+                return
+        elif location.startswith("s3://"):
+            # read through awswrangler so the same endpoint settings (eg a moto stand-in) apply
+            df = wr.s3.read_csv(path=location) if location.endswith(".csv") else wr.s3.read_parquet(path=location, dataset=True)
+        else:
+            df = None
+        self.conn.execute(f'CREATE SCHEMA IF NOT EXISTS "{database}"')
+        if df is None:
+            self.conn.execute(f'CREATE OR REPLACE VIEW "{database}"."{table}" AS {self._source_sql(location)}')
+        else:
+            self.conn.register(f"_source_{len(self._loaded)}", df)
+            self.conn.execute(f'CREATE OR REPLACE VIEW "{database}"."{table}" AS SELECT * FROM "_source_{len(self._loaded)}"')
+        self._loaded.append(name)
+        LOGGER.info(f"Loaded {name} from {location or 'the glue catalog'}")
+
+    def _prepare(self, sql: str):
+        for name in get_source_tables(sql, self.default_database):
+            if name not in self._loaded:
+                self._load_table(name)
+        self.conn.execute(f'CREATE SCHEMA IF NOT EXISTS "{self.default_database}"')
+        self.conn.execute(f"SET search_path = '{self.default_database},main'")
+
+    def _arrow_reader(self, sql: str, batch_rows: int) -> pa.RecordBatchReader:
+        self._prepare(sql)
+        result = self.conn.execute(to_duckdb_sql(sql))
+        # renamed in duckdb 1.4
+        return (getattr(result, "to_arrow_reader", None) or result.fetch_record_batch)(batch_rows)
+
+    def query(self, sql: str) -> pd.DataFrame:
+        """Runs a query and returns its result like wr.athena.get_query_results would"""
+        return self._arrow_reader(sql, 1000000).read_all().to_pandas(types_mapper=INT_TYPES.get)
+
+    def query_chunks(self, sql: str, chunksize: int) -> Iterator[pd.DataFrame]:
+        """Runs a query and streams its result in frames of up to chunksize rows"""
+        for batch in self._arrow_reader(sql, chunksize):
+            yield pa.Table.from_batches([batch]).to_pandas(types_mapper=INT_TYPES.get)
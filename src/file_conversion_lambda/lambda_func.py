@@ -1,34 +1,414 @@
 import awswrangler as wr
+import pandas as pd
+import json
+import hashlib
+import io
 import urllib
 import os
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
-    
-def lambda_handler(event, context):
+from instrumentation import Instrumentation, peak_rss_mb
 
-    try:
-        bucket = event['Records'][0]['s3']['bucket']['name']
-        output_bucket = os.environ['OUTPUT_BUCKET_NAME']
-        key = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
-        file_name = key.split("/")[-1].split(".")[0]
-        df = wr.s3.read_csv(f"s3://{bucket}/{key}", dataset=True)
-        
-        # will create a table in the Default Glue DB or whatever is set in global config: https://github.com/aws/aws-sdk-pandas/blob/main/tutorials/021%20-%20Global%20Configurations.ipynb
-        # table name will be the filename
+# rows converted at a time, bounds the memory used per file regardless of the upload's size
+CHUNK_ROWS = int(os.environ.get('CHUNK_ROWS', 100000))
+# files converted at once, defaults to one per 512MB of lambda memory
+MAX_CONCURRENT_FILES = int(os.environ.get(
+    'MAX_CONCURRENT_FILES',
+    max(1, int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', 512)) // 512)
+))
+# where queued batches are written before they're moved into their table, outside every table's location
+STAGING_PREFIX = "_staging/"
+# in memory size a batch of queued files for one table is built up to before it's written, defaults to a quarter of the lambda's memory
+MAX_BATCH_MB = int(os.environ.get(
+    'MAX_BATCH_MB',
+    max(64, int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', 512)) // 4)
+))
+
+
+def get_table_name(key):
+    # table name will be the filename
+    return key.split("/")[-1].split(".")[0]
+
+
+def get_database():
+    """The glue db set in the global config (WR_DATABASE), or None. Without one the files are only written and the
+    stack's crawler catalogs them"""
+    # wr.config raises if it was never set
+    return getattr(wr.config, "database", None)
+
+
+def get_target(file_name, output_bucket, metrics):
+    """Returns the table's location and its column types, or the default location and None for a new table"""
+    path = f"s3://{output_bucket}/ingested_csv/{file_name}/"
+    dtype = None
+    database = get_database()
+    with metrics.stage("catalog_lookup"):
+        if database and wr.catalog.does_table_exist(database=database, table=file_name):
+            dtype = wr.catalog.get_table_types(database=database, table=file_name)
+            # follow the catalog, compaction moves a table's location to a new versioned prefix
+            path = wr.catalog.get_table_location(database=database, table=file_name)
+    return path, dtype
+
+
+def source_prefix(bucket, key, etag):
+    """Filename prefix of the parquet files converted from one upload. A retry of the upload gets the same prefix, so it
+    can find what an earlier attempt wrote, a new upload of the same key gets a new one"""
+    return hashlib.sha1(f"{bucket}/{key}/{etag}".encode()).hexdigest()[:16] + "_"
+
+
+class TypesWidened(Exception):
+    """A later chunk didn't fit the column types inferred from the first one, the conversion starts over with the wider types"""
+    def __init__(self, dtype):
+        super().__init__(f"Column types widened to {dtype}")
+        self.dtype = dtype
+
+
+def infer_types(bucket, key):
+    """Column types of a new table, inferred from the first chunk of its file. Later chunks can widen them, see cast_chunk"""
+    first = next(iter(wr.s3.read_csv(f"s3://{bucket}/{key}", chunksize=CHUNK_ROWS)))
+    dtype, _ = wr.catalog.extract_athena_types(df=first, index=False)
+    return dtype
+
+
+def cast_chunk(chunk, dtype, widen=False):
+    """Casts a chunk to the table's column types, so a chunk can't have a type of its own.
+
+    With widen, for types that were only inferred from the first chunk, a column that doesn't fit its type raises
+    TypesWidened with the type it needs: double for an integer column with fractional values, otherwise string.
+    """
+    widened = {}
+    for col, col_type in dtype.items():
+        if col not in chunk.columns:
+            continue
+        try:
+            chunk[col] = chunk[col].astype(athena_to_pandas(col_type))
+        except (TypeError, ValueError):
+            if not widen:
+                raise
+            try:
+                chunk[col].astype("float64")
+                widened[col] = "double" if col_type in ("tinyint", "smallint", "int", "bigint") else "string"
+            except (TypeError, ValueError):
+                widened[col] = "string"
+    if widened:
+        raise TypesWidened({**dtype, **widened})
+    return chunk
+
+
+def read_csv_chunks(bucket, key, dtype, widen=False):
+    """Reads the csv in chunks cast to the table's column types. String columns are parsed as strings so values
+    like zip codes keep their text, the others are parsed then cast, see cast_chunk"""
+    chunks = wr.s3.read_csv(
+        f"s3://{bucket}/{key}",
+        chunksize=CHUNK_ROWS,
+        dtype={col: "object" for col, col_type in dtype.items() if athena_to_pandas(col_type) == "object"}
+    )
+    for chunk in chunks:
+        yield cast_chunk(chunk, dtype, widen)
+
+
+def delete_new_table(file_name):
+    """Drops a table this conversion created with types it has since widened, its next write creates it again"""
+    if get_database():
+        wr.catalog.delete_table_if_exists(database=get_database(), table=file_name)
+
+
+def write_parquet(df, path, file_name, dtype, metrics, filename_prefix=None):
+    # will create a table in the Glue DB set in global config: https://github.com/aws/aws-sdk-pandas/blob/main/tutorials/021%20-%20Global%20Configurations.ipynb
+    # awswrangler needs the database and table together, without a database the files are left to the crawler
+    database = get_database()
+    with metrics.stage("write_parquet") as write_stats:
         wr.s3.to_parquet(
-            df, 
-            path=f"s3://{output_bucket}/ingested_csv/{file_name}/",
+            df,
+            path=path,
             dataset=True,
-            table=file_name,
+            database=database,
+            table=file_name if database else None,
             mode="append", #default is append
-            index=False, 
+            index=False,
             schema_evolution=True,
+            dtype={col: col_type for col, col_type in dtype.items() if col in df.columns},
+            filename_prefix=filename_prefix,
         )
-        
-        print(" Successfully converted the file")
-        
+        write_stats["rows"] += len(df)
+
+
+def convert_file(bucket, key, size, etag, output_bucket):
+    """Converts one csv to parquet chunk by chunk and returns its conversion stats.
+
+    The schema comes from the existing table when there is one, otherwise from the first chunk,
+    and every chunk is cast and written with it so they all have the same column types. When a later
+    chunk of a new table doesn't fit the inferred types, the file is converted again with wider ones.
+
+    Every chunk's file is named with the upload's source_prefix. A retry first deletes the files an
+    earlier attempt wrote for the upload, so rows of chunks it already appended aren't appended twice.
+    """
+    file_name = get_table_name(key)
+    metrics = Instrumentation(namespace="FileConversionLambda", dimensions={"Table": file_name})
+    start = time.perf_counter()
+    rows = 0
+    path, dtype = get_target(file_name, output_bucket, metrics)
+    prefix = source_prefix(bucket, key, etag)
+
+    def delete_earlier(attempt):
+        # unpartitioned, so the upload's files are right under the table's location
+        earlier = wr.s3.list_objects(f"{path.rstrip('/')}/{prefix}")
+        if earlier:
+            print(f"Deleting {len(earlier)} file(s) {attempt} converted from s3://{bucket}/{key}")
+            wr.s3.delete_objects(earlier)
+
+    delete_earlier("an earlier attempt")
+    inferred = dtype is None
+    if inferred:
+        dtype = infer_types(bucket, key)
+    metrics.record("read_csv", num_bytes=size)
+    while True:
+        try:
+            for chunk in metrics.timed_iter("read_csv", read_csv_chunks(bucket, key, dtype, widen=inferred)):
+                write_parquet(chunk, path, file_name, dtype, metrics, filename_prefix=prefix)
+                rows += len(chunk)
+            break
+        except TypesWidened as widened:
+            print(f"Rows of s3://{bucket}/{key} don't fit the types of its first chunk, converting it again with {widened.dtype}")
+            dtype, rows = widened.dtype, 0
+            delete_earlier("the narrower conversion")
+            delete_new_table(file_name)
+
+    seconds = time.perf_counter() - start
+    stats = {
+        'File': f"s3://{bucket}/{key}",
+        'Rows': rows,
+        'Bytes': size,
+        'Seconds': round(seconds, 3),
+        'MBPerSecond': round(size / 1024 ** 2 / seconds, 3) if seconds else None,
+        # process wide, so with concurrent files it's an upper bound for this one
+        'PeakRssMB': peak_rss_mb(),
+    }
+    metrics.properties.update(stats)
+    metrics.emit()
+    return stats
+
+
+def convert_table_files(objects, output_bucket):
+    # files for the same table are converted in order so their appends don't race
+    return [convert_file(bucket, key, size, etag, output_bucket) for bucket, key, size, etag in objects]
+
+
+def publish_marker(output_bucket, file_name, source):
+    """Where the files published for one queued upload are recorded while they're being published"""
+    return f"s3://{output_bucket}/{STAGING_PREFIX}{file_name}/_publishing/{source}.json"
+
+
+def undo_earlier_publish(markers):
+    """Deletes the table files and staging of a publish that didn't finish, found through the markers of the uploads it
+    had. An interrupted publish only happens in an invocation that failed, so every upload it had is redelivered"""
+    existing = set(wr.s3.list_objects(os.path.dirname(markers[0]) + "/")) if markers else set()
+    for marker in markers:
+        if marker not in existing:
+            continue
+        body = io.BytesIO()
+        wr.s3.download(path=marker, local_file=body)
+        earlier = json.loads(body.getvalue())
+        print(f"Deleting {len(earlier['paths'])} file(s) of an earlier publish that didn't finish")
+        if earlier["paths"]:
+            wr.s3.delete_objects(earlier["paths"])
+        wr.s3.delete_objects(earlier["staging"])
+        wr.s3.delete_objects(marker)
+
+
+def publish_staged(staging, path, file_name, columns_types, metrics, markers):
+    """Moves a batch's staged files into the table's location and updates the table's columns with one catalog call,
+    when there's a global database, see get_database.
+
+    The files it's about to copy are first recorded in a marker for each upload of the batch. If the copy or the
+    catalog update doesn't finish, the redelivered uploads find their marker and delete the copied files before
+    they're published again, so their rows aren't appended twice. The markers are deleted once the batch is published.
+    """
+    with metrics.stage("publish"):
+        staged = wr.s3.list_objects(staging)
+        paths = [f"{path.rstrip('/')}/{staged_path[len(staging):]}" for staged_path in staged]
+        record = json.dumps({"paths": paths, "staging": staging}).encode()
+        for marker in markers:
+            wr.s3.upload(local_file=io.BytesIO(record), path=marker)
+        wr.s3.copy_objects(paths=staged, source_path=staging, target_path=path)
+        # append keeps the table and its columns, adding the batch's new columns. Without a database the crawler does
+        if get_database():
+            wr.catalog.create_parquet_table(
+                database=get_database(),
+                table=file_name,
+                path=path,
+                columns_types=columns_types,
+                mode="append",
+            )
+        wr.s3.delete_objects(markers)
+
+
+def convert_table_batch(file_name, objects, output_bucket):
+    """Converts a batch of queued files for one table with as few writes as possible, returns the batch's stats.
+
+    Files are concatenated and written together, so the batch makes one write and one catalog update, unless
+    it's over MAX_BATCH_MB in memory in which case it's written each time that much has been read.
+
+    Writes go to a staging prefix outside the table and the staged files are only moved into the table once
+    the whole batch is converted. A batch that fails part way leaves nothing in the table, so when SQS
+    redelivers its messages the retry doesn't append the rows of earlier writes twice. For the same reason a
+    new table's batch whose later rows don't fit the types inferred from its first chunk just starts over.
+    A batch that fails while it's published is undone when its uploads are redelivered, see publish_staged.
+    """
+    metrics = Instrumentation(namespace="FileConversionLambda", dimensions={"Table": file_name})
+    start = time.perf_counter()
+    path, dtype = get_target(file_name, output_bucket, metrics)
+    staging = f"s3://{output_bucket}/{STAGING_PREFIX}{file_name}/{uuid.uuid4().hex}/"
+    # named by upload, so a redelivered upload finds the marker whichever batch it comes back in
+    markers = [publish_marker(output_bucket, file_name, source_prefix(bucket, key, etag)) for bucket, key, _, etag in objects]
+    columns_types = {}
+    pending, pending_bytes, rows, writes = [], 0, 0, 0
+
+    def flush():
+        nonlocal pending, pending_bytes, writes
+        df = pd.concat(pending, ignore_index=True)
+        df_dtype = {col: col_type for col, col_type in dtype.items() if col in df.columns}
+        with metrics.stage("write_parquet") as write_stats:
+            wr.s3.to_parquet(df, path=staging, dataset=True, database=None, table=None, mode="append", index=False, dtype=df_dtype)
+            write_stats["rows"] += len(df)
+        columns_types.update(wr.catalog.extract_athena_types(df=df, index=False, dtype=df_dtype)[0])
+        pending, pending_bytes, writes = [], 0, writes + 1
+
+    inferred = dtype is None
+    publishing = False
+    metrics.record("read_csv", num_bytes=sum(size for _, _, size, _ in objects))
+    try:
+        while True:
+            try:
+                for bucket, key, _, _ in objects:
+                    if dtype is None:
+                        dtype = infer_types(bucket, key)
+                    # cast to the table's types, so files concatenate without a type of their own
+                    for chunk in metrics.timed_iter("read_csv", read_csv_chunks(bucket, key, dtype, widen=inferred)):
+                        pending.append(chunk)
+                        pending_bytes += chunk.memory_usage(deep=True).sum()
+                        rows += len(chunk)
+                        if pending_bytes > MAX_BATCH_MB * 1024 ** 2:
+                            flush()
+                break
+            except TypesWidened as widened:
+                print(f"Rows queued for {file_name} don't fit the types of its first chunk, converting the batch again with {widened.dtype}")
+                wr.s3.delete_objects(staging)
+                dtype, columns_types = widened.dtype, {}
+                pending, pending_bytes, rows, writes = [], 0, 0, 0
+        if pending:
+            flush()
+        undo_earlier_publish(markers)
+        if writes:
+            publishing = True
+            publish_staged(staging, path, file_name, columns_types, metrics, markers)
+        wr.s3.delete_objects(staging)
+    except Exception:
+        # a publish that didn't finish keeps its staging, it's deleted with the copied files once its uploads are redelivered
+        if not publishing:
+            wr.s3.delete_objects(staging)
+        raise
+
+    seconds = time.perf_counter() - start
+    size = sum(size for _, _, size, _ in objects)
+    stats = {
+        'Table': file_name,
+        'Files': [f"s3://{bucket}/{key}" for bucket, key, _, _ in objects],
+        'Rows': rows,
+        'Bytes': size,
+        'Writes': writes,
+        'Seconds': round(seconds, 3),
+        'MBPerSecond': round(size / 1024 ** 2 / seconds, 3) if seconds else None,
+        'PeakRssMB': peak_rss_mb(),
+    }
+    metrics.properties.update({k: v for k, v in stats.items() if k != 'Files'})
+    metrics.emit()
+    return stats
+
+
+def athena_to_pandas(col_type):
+    """pandas dtype a csv column of the table is parsed as"""
+    if col_type in ("tinyint", "smallint", "int", "bigint"):
+        return "Int64"
+    if col_type in ("float", "double"):
+        return "float64"
+    if col_type == "boolean":
+        return "boolean"
+    return "object"
+
+
+def get_s3_object(record):
+    bucket = record['s3']['bucket']['name']
+    key = urllib.parse.unquote_plus(record['s3']['object']['key'], encoding='utf-8')
+    size, etag = record['s3']['object'].get('size'), record['s3']['object'].get('eTag')
+    if size is None or etag is None:
+        described = wr.s3.describe_objects(f"s3://{bucket}/{key}")[f"s3://{bucket}/{key}"]
+        size, etag = described['ContentLength'], described['ETag'].strip('"')
+    return bucket, key, size, etag
+
+
+def handle_queued_batch(event, output_bucket):
+    """Converts a batch of S3 events queued in SQS, one write per table. Only the messages of tables that failed
+    are reported back as batch item failures, so the rest aren't redelivered"""
+    objects_by_table, messages_by_table = defaultdict(list), defaultdict(set)
+    for message in event['Records']:
+        # S3 sends a test event without records when the notification is created
+        for record in json.loads(message['body']).get('Records', []):
+            s3_object = get_s3_object(record)
+            objects_by_table[get_table_name(s3_object[1])].append(s3_object)
+            messages_by_table[get_table_name(s3_object[1])].add(message['messageId'])
+
+    def convert(file_name):
+        try:
+            return convert_table_batch(file_name, objects_by_table[file_name], output_bucket)
+        except Exception as e:
+            print(f"Converting {file_name} failed: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_FILES) as pool:
+        results = dict(zip(objects_by_table, pool.map(convert, objects_by_table)))
+    failed = sorted({message_id for file_name, stats in results.items() if stats is None for message_id in messages_by_table[file_name]})
+    stats = [table_stats for table_stats in results.values() if table_stats is not None]
+
+    print(f" Converted {sum(len(table_stats['Files']) for table_stats in stats)} file(s) of {len(stats)} table(s), {len(failed)} message(s) failed")
+
+    return {
+        'StatusCode': '200',
+        'Message': 'Successfully Completed' if not failed else 'Partially Completed',
+        'Tables': stats,
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed]
+    }
+
+
+def lambda_handler(event, context):
+    """Converts every csv in the S3 event to parquet. Files for different tables are converted
+    concurrently. Set WR_S3_ENDPOINT_URL to run against a local S3 stand-in.
+
+    Events can also come through an SQS queue (see FileTypeConversionStack's buffered option), in which case
+    the files queued for each table are converted together with one write."""
+    try:
+        output_bucket = os.environ['OUTPUT_BUCKET_NAME']
+        if event['Records'] and event['Records'][0].get('eventSource') == 'aws:sqs':
+            return handle_queued_batch(event, output_bucket)
+
+        objects_by_table = defaultdict(list)
+        for record in event['Records']:
+            s3_object = get_s3_object(record)
+            objects_by_table[get_table_name(s3_object[1])].append(s3_object)
+
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_FILES) as pool:
+            results = list(pool.map(lambda objects: convert_table_files(objects, output_bucket), objects_by_table.values()))
+        stats = [file_stats for table_stats in results for file_stats in table_stats]
+
+        print(f" Successfully converted {len(stats)} file(s)")
+
         return{
             'StatusCode':'200',
-            'Message':'Successfully Completed'
+            'Message':'Successfully Completed',
+            'Files': stats
         }
     except Exception as e:
         print (e)
@@ -0,0 +1,118 @@
+"""Per stage timing and resource instrumentation emitted as CloudWatch embedded metric format (EMF) records"""
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Any, Iterator, Iterable, Optional
+import json
+import os
+import resource
+import time
+import urllib.request
+
+
+def peak_rss_mb() -> float:
+    """Peak resident memory of the process so far in MB"""
+    try:
+        # VmHWM starts over on exec, unlike ru_maxrss which carries the parent's peak into a child process
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    # ru_maxrss is in KB on linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def memory_limit_mb() -> Optional[float]:
+    """Memory the container may use in MB, from the ECS task metadata on Fargate or the cgroup limit, None if unlimited"""
+    metadata_uri = os.environ.get("ECS_CONTAINER_METADATA_URI_V4")
+    if metadata_uri:
+        try:
+            with urllib.request.urlopen(f"{metadata_uri}/task", timeout=2) as response:
+                return float(json.load(response)["Limits"]["Memory"])
+        except (OSError, ValueError, KeyError):
+            pass
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        # cgroup v1 reports no limit as a huge number
+        if limit.isdigit() and int(limit) < 2 ** 60:
+            return round(int(limit) / 1024 ** 2, 1)
+        return None
+    return None
+
+
+@dataclass
+class Instrumentation:
+    """Instrumentation collects wall time, rows, bytes and peak RSS per stage of a run. A stage's peak_rss_mb is the
+    process wide peak when the stage ended, not the stage's own, so it never drops from one stage to the next
+    Args:
+        namespace (str): CloudWatch metric namespace
+        dimensions (Dict[str, str]): dimensions every metric is reported under, eg the job's target table
+        properties (Dict[str, Any], optional): extra values added to the record but not reported as metrics
+    """
+    namespace: str
+    dimensions: Dict[str, str]
+    properties: Dict[str, Any] = field(default_factory=dict)
+    stages: Dict[str, Dict[str, float]] = field(default_factory=dict)
+
+    def _stage_stats(self, name: str) -> Dict[str, float]:
+        return self.stages.setdefault(name, {"seconds": 0.0, "rows": 0, "bytes": 0, "peak_rss_mb": 0.0})
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[Dict[str, float]]:
+        """Times a block, the yielded dict can be used to add the rows and bytes it handled.
+        Entering the same stage again adds to its totals, eg once per streamed batch."""
+        stats = self._stage_stats(name)
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats["seconds"] += time.perf_counter() - start
+            # the VmHWM high water mark only grows, this is the process peak so far rather than the stage's own. Stages
+            # overlap in writer threads, so resetting it per stage (/proc/self/clear_refs) would mix them up anyway
+            stats["peak_rss_mb"] = peak_rss_mb()
+
+    def record(self, name: str, seconds: float = 0.0, rows: int = 0, num_bytes: int = 0):
+        """Adds a stage measured elsewhere, eg Athena queueing and execution times from the query statistics"""
+        stats = self._stage_stats(name)
+        stats["seconds"] += seconds
+        stats["rows"] += rows
+        stats["bytes"] += num_bytes
+
+    def timed_iter(self, name: str, items: Iterable) -> Iterator:
+        """Yields from an iterator, timing each step under a stage, eg pulling the batches of a streamed read"""
+        iterator = iter(items)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def emit(self) -> Dict[str, Any]:
+        """Prints the run as one EMF json record to stdout and returns it"""
+        metrics, values = [], {}
+        for stage, stats in self.stages.items():
+            for stat, unit in (("seconds", "Seconds"), ("rows", "Count"), ("bytes", "Bytes"), ("peak_rss_mb", "Megabytes")):
+                metrics.append({"Name": f"{stage}.{stat}", "Unit": unit})
+                values[f"{stage}.{stat}"] = round(stats[stat], 3)
+        emf = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [list(self.dimensions)],
+                    "Metrics": metrics
+                }]
+            },
+            **self.dimensions,
+            **self.properties,
+            **values
+        }
+        print(json.dumps(emf, sort_keys=True, default=str))
+        return emf
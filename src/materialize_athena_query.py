@@ -1,15 +1,51 @@
-from dataclasses import dataclass, field
-from typing import Dict, Any, Optional, List
+from __future__ import annotations
 
-import boto3
-import botocore
-import awswrangler as wr
+from dataclasses import dataclass, field, replace
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, Any, Optional, List, Iterator, Union, Set
+
+import copy
+import importlib.util
 import json
 import os
-import jinja2 as j2
+import queue
+import uuid
+import re
+import hashlib
+import threading
+from datetime import date, datetime, timezone, timedelta
+from urllib.parse import unquote, urlparse
+
+from state_store import StateStore, get_state_store
+from instrumentation import Instrumentation, memory_limit_mb, peak_rss_mb
 import logging
 import sys
 
+def lazy_import(name: str):
+    """Returns a module that is only imported on first attribute access. Keeps heavy imports (awswrangler pulls in
+    pandas and pyarrow) off the startup path, eg for the usage error path or rendering a template"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+boto3 = lazy_import("boto3")
+wr = lazy_import("awswrangler")
+pd = lazy_import("pandas")
+j2 = lazy_import("jinja2")
+
+def load_lazy_modules():
+    """Finishes importing the lazy modules. LazyLoader modules aren't thread safe before python 3.12.3, two threads
+    touching one while it loads get AttributeErrors, so this runs before starting any threads that use them"""
+    for module in (boto3, wr, pd, j2):
+        # any attribute access runs the module's import
+        module.__name__
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s.%(msecs)03d %(levelname)s %(module)s - %(funcName)s: %(message)s',
@@ -21,16 +57,290 @@ LOGGER = logging.getLogger()
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 SQL_SCRIPTS_PATH = os.path.join(DIR_PATH,"sql_jobs")
 
-J2_ENV = j2.Environment(loader=j2.FileSystemLoader(SQL_SCRIPTS_PATH), undefined=j2.StrictUndefined)
+# athena result types that are spelled differently in the glue catalog
+ATHENA_TO_GLUE_TYPES = {"varchar": "string", "char": "string", "integer": "int", "real": "float"}
+GLUE_TO_ATHENA_TYPES = {"string": "varchar", "int": "integer", "float": "real"}
+# nullable pandas dtypes for declared integer columns, so a smallint isn't held as an int64 or float64 in memory
+GLUE_TO_PANDAS_INT_TYPES = {"tinyint": "Int8", "smallint": "Int16", "int": "Int32", "integer": "Int32", "bigint": "Int64"}
+
+# runs kept in a job's stats history, used to size its Batch job definition (cdk/stacks/helpers/fargate_sizing.py)
+STATS_HISTORY = 20
+# layout options and their defaults, see MaterializeAthenaQuery.layout
+LAYOUT_DEFAULTS = {"sort_by": [], "compression": "snappy", "dictionary_columns": None, "row_group_rows": 100000}
+# athena partition projection types, the setting each one needs and the defaults of the others, see partition_projection
+PROJECTION_REQUIRED = {"enum": "values", "integer": "range", "date": "range", "injected": None}
+PROJECTION_DEFAULTS = {"date": {"format": "yyyy-MM-dd", "interval": 1, "interval_unit": "DAYS"}}
+# most partitions a glue BatchCreatePartition call takes
+PARTITION_BATCH_SIZE = 100
+# array jobs pass their size to each child, see cdk/stacks/helpers/batch_job_utils.py
+SHARD_COUNT_ENV = "MATERIALIZE_SHARD_COUNT"
+# string literals and comments, blanked out before looking for source tables
+SQL_LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'|--[^\n]*|/\*.*?\*/", re.DOTALL)
+# quoted identifiers, words (bare names can have dashes, eg covid-19) and single punctuation characters
+SQL_TOKEN_PATTERN = re.compile(r'"(?:[^"]|"")*"|\w[\w-]*|\S')
+# keywords that can't be a table name or alias
+SQL_CLAUSE_KEYWORDS = {
+    "AS", "ON", "USING", "WHERE", "GROUP", "ORDER", "HAVING", "LIMIT", "OFFSET", "FETCH", "WINDOW", "UNION", "EXCEPT",
+    "INTERSECT", "JOIN", "INNER", "LEFT", "RIGHT", "FULL", "OUTER", "CROSS", "NATURAL", "SELECT", "FROM", "WITH",
+    "VALUES", "UNNEST", "LATERAL", "TABLESAMPLE", "FOR", "MATCH_RECOGNIZE",
+}
+# keywords ending a FROM clause, commas after them separate columns rather than relations
+SQL_FROM_END_KEYWORDS = {
+    "WHERE", "GROUP", "HAVING", "ORDER", "LIMIT", "OFFSET", "FETCH", "WINDOW", "UNION", "EXCEPT", "INTERSECT", "SELECT", ";",
+}
+
+@lru_cache(maxsize=None)
+def get_j2_env(strict: bool = True):
+    # a lenient env renders missing params as empty and falsy, see render_query
+    return j2.Environment(loader=j2.FileSystemLoader(SQL_SCRIPTS_PATH), undefined=j2.StrictUndefined if strict else j2.ChainableUndefined)
+
+def get_source_tables(query: str, default_database: str) -> List[str]:
+    """Lists the "database.table" names a query reads, unqualified names are assumed to be in default_database.
+
+    Every relation of a FROM or JOIN is read, including comma separated lists (FROM a, b) and parenthesized joins.
+    UNNEST, LATERAL and VALUES relations, FROM inside function calls (eg EXTRACT(year FROM col)) and the query's
+    own CTE names are left out.
+    """
+    query = SQL_LITERAL_PATTERN.sub(lambda literal: " " * len(literal.group()), query)
+    tokens = SQL_TOKEN_PATTERN.findall(query)
+    words = [token.upper() for token in tokens]
+    # the closing parenthesis of each opening one, and the opening parenthesis each token is inside of
+    closing, enclosing, opened = {}, [], []
+    for i, token in enumerate(tokens):
+        enclosing.append(opened[-1] if opened else None)
+        if token == "(":
+            opened.append(i)
+        elif token == ")" and opened:
+            closing[opened.pop()] = i
+
+    def is_name(i: int) -> bool:
+        if i >= len(tokens) or words[i] in SQL_CLAUSE_KEYWORDS:
+            return False
+        return tokens[i][0] == '"' or tokens[i][0].isalnum() or tokens[i][0] == "_"
+
+    def skip_parens(i: int) -> int:
+        return closing.get(i, len(tokens)) + 1 if i < len(tokens) and tokens[i] == "(" else i
+
+    def subquery(i: int) -> bool:
+        return i + 1 < len(tokens) and words[i + 1] in ("SELECT", "WITH", "VALUES", "(")
+
+    ctes = set()
+    for i, word in enumerate(words):
+        if word != "WITH" or (enclosing[i] is not None and not subquery(enclosing[i])):
+            continue
+        # WITH [RECURSIVE] name [(columns)] AS (...), ...
+        i += 2 if i + 1 < len(tokens) and words[i + 1] == "RECURSIVE" else 1
+        while is_name(i):
+            ctes.add(tokens[i].strip('"').lower())
+            i = skip_parens(i + 1)
+            if i < len(tokens) and words[i] == "AS":
+                i = skip_parens(i + 1)
+            if i >= len(tokens) or tokens[i] != ",":
+                break
+            i += 1
+
+    # the token each table name starts at, so tables are listed in the order the query mentions them
+    found = {}
+    # parentheses a FROM or JOIN reads tables in: subqueries, and parenthesized joins found while reading relations
+    relational = {i for i in closing if subquery(i)}
+
+    def read_relation(i: int):
+        if i >= len(tokens):
+            return
+        if tokens[i] == "(" and not subquery(i):
+            # a parenthesized join, eg FROM (a JOIN b ON ...), its first relations are read here, its JOINs by the scan
+            relational.add(i)
+            read_relations(i + 1)
+        elif is_name(i):
+            start, parts = i, [tokens[i]]
+            while i + 2 < len(tokens) and tokens[i + 1] == "." and is_name(i + 2):
+                parts.append(tokens[i + 2])
+                i += 2
+            parts = [part.strip('"').replace('""', '"') for part in parts[-2:]]
+            if len(parts) == 2 or parts[0].lower() not in ctes:
+                found[start] = ".".join(parts) if len(parts) == 2 else f"{default_database}.{parts[0]}"
+        # subqueries are read by the scan, UNNEST, LATERAL and VALUES don't read tables
+
+    # the relation at i and the rest of its comma separated list, FROM a JOIN b ON ..., c
+    def read_relations(i: int):
+        level = enclosing[i] if i < len(tokens) else None
+        end = closing.get(level, len(tokens)) if level is not None else len(tokens)
+        read_relation(i)
+        for j in range(i, end):
+            if enclosing[j] != level:
+                continue
+            if words[j] in SQL_FROM_END_KEYWORDS:
+                break
+            if tokens[j] == ",":
+                read_relation(j + 1)
+
+    for i, word in enumerate(words):
+        if word == "FROM" and (enclosing[i] is None or enclosing[i] in relational):
+            read_relations(i + 1)
+        elif word == "JOIN" and (enclosing[i] is None or enclosing[i] in relational):
+            read_relation(i + 1)
+    return list(dict.fromkeys(found[start] for start in sorted(found)))
+
+def get_projection_parameters(partition_projection: Dict[str, Dict[str, Any]], partition_cols: List[str], location: str) -> Dict[str, str]:
+    """Glue table parameters projecting partitions in the hive layout (col=value/...) under location, eg
+    {"reporting_date": {"type": "date", "range": "2020-01-01,NOW"}} gives "projection.reporting_date.type": "date",
+    "projection.reporting_date.range": "2020-01-01,NOW", the date format and interval defaults and the location template"""
+    if set(partition_projection) != set(partition_cols):
+        raise ValueError(f"partition_projection needs settings for exactly the partition columns {partition_cols}, got {sorted(partition_projection)}")
+    parameters = {"projection.enabled": "true"}
+    for col in partition_cols:
+        settings = partition_projection[col]
+        projection_type = settings.get("type")
+        if projection_type not in PROJECTION_REQUIRED:
+            raise ValueError(f"Unknown projection type [{projection_type}] of [{col}], expected one of {sorted(PROJECTION_REQUIRED)}")
+        required = PROJECTION_REQUIRED[projection_type]
+        if required and required not in settings:
+            raise ValueError(f"{projection_type} projection of [{col}] needs its {required}")
+        for name, value in {**PROJECTION_DEFAULTS.get(projection_type, {}), **settings}.items():
+            # lists of enum values or range bounds are comma separated, interval_unit is interval.unit
+            value = ",".join(str(item) for item in value) if isinstance(value, (list, tuple)) else str(value)
+            parameters[f"projection.{col}.{name.replace('_', '.')}"] = value
+    parameters["storage.location.template"] = location.rstrip("/") + "/" + "/".join(f"{col}=${{{col}}}" for col in partition_cols)
+    return parameters
+
+
+def get_shard_params(sharding: Dict[str, Any], shard_index: int, shard_count: int, engine: str = "pandas") -> Dict[str, Any]:
+    """Template params selecting one shard's slice of the query. Every shard gets shard_index, shard_count and
+    shard_filter, a predicate on sharding["key"] for the template's WHERE clause. Keys are hashed into shards, or
+    with a "start" and "end" (dates or integers) the range [start, end) is split into consecutive slices, passed
+    as shard_start and shard_end too. Rows with a NULL key go to shard 0"""
+    params = {"shard_index": shard_index, "shard_count": shard_count, "shard_filter": "1 = 1"}
+    if not sharding:
+        return params
+    key = f'"{sharding["key"]}"'
+    if "start" not in sharding:
+        # duckdb has no xxhash64, its own hash spreads keys as well. NULL keys hash as '' so they land in a shard
+        if engine == "duckdb":
+            params["shard_filter"] = f"hash(coalesce(CAST({key} AS VARCHAR), '')) % {shard_count} = {shard_index}"
+        else:
+            params["shard_filter"] = (
+                f"mod(bitwise_and(from_big_endian_64(xxhash64(to_utf8(coalesce(CAST({key} AS varchar), '')))), "
+                f"9223372036854775807), {shard_count}) = {shard_index}"
+            )
+        return params
+    start, end = sharding["start"], sharding["end"]
+    if isinstance(start, int):
+        shard_start, shard_end = (start + (end - start) * i // shard_count for i in (shard_index, shard_index + 1))
+        literal = "{}"
+    else:
+        days = (date.fromisoformat(end) - date.fromisoformat(start)).days
+        shard_start, shard_end = (
+            (date.fromisoformat(start) + timedelta(days=days * i // shard_count)).isoformat() for i in (shard_index, shard_index + 1)
+        )
+        literal = "DATE '{}'"
+    params.update({
+        "shard_start": shard_start,
+        "shard_end": shard_end,
+        "shard_filter": f"({key} >= {literal.format(shard_start)} AND {key} < {literal.format(shard_end)}"
+                        f"{f' OR {key} IS NULL' if shard_index == 0 else ''})",
+    })
+    return params
+
+
+def render_query(sql_script: str, params: Dict[str, Any] = None, strict: bool = True) -> str:
+    """Renders a template without logging it, see get_query. With strict=False params that aren't given render as
+    empty strings, and are false in {% if %} blocks, instead of raising"""
+    return get_j2_env(strict).get_template(sql_script).render(**(params or {}))
+
 
 def get_query(sql_script:str, params: Dict[str, Any] = None):
 
-    if params is None:
-        params = {}
-    query = J2_ENV.get_template(sql_script).render(**params)
+    query = render_query(sql_script, params)
     LOGGER.info(f'*****RETRIEVED QUERY*****\n{query}')
     return query
 
+
+def get_query_variables(sql_script: str) -> Set[str]:
+    """Names of the parameters the template reads"""
+    from jinja2 import meta
+
+    env = get_j2_env()
+    source, _, _ = env.loader.get_source(env, sql_script)
+    return meta.find_undeclared_variables(env.parse(source))
+
+def resolve_killed_runs(runs: List[Dict[str, Any]]):
+    """Marks the earlier runs still recorded as running with why their Batch attempt stopped: oom_killed when ECS
+    killed the container for its memory usage, which is the only status sizing grows memory for, otherwise killed.
+    Runs outside Batch, and those whose attempt hasn't stopped, eg a concurrent run, are left running"""
+    unresolved = [run for run in runs if run.get("status") == "running" and run.get("batch_job_id")]
+    if not unresolved:
+        return
+    job_ids = sorted({run["batch_job_id"] for run in unresolved})
+    jobs = {job["jobId"]: job for job in boto3.client("batch").describe_jobs(jobs=job_ids[:100])["jobs"]}
+    for run in unresolved:
+        job = jobs.get(run["batch_job_id"])
+        if job is None:
+            # past Batch's job retention, why it stopped is unknown
+            run["status"] = "killed"
+            continue
+        started = datetime.fromisoformat(run["started_at"]).timestamp() * 1000
+        for attempt in job.get("attempts", []):
+            if attempt.get("startedAt", 0) <= started <= attempt.get("stoppedAt", 0):
+                reason = attempt.get("container", {}).get("reason", "")
+                run["status"] = "oom_killed" if reason.startswith("OutOfMemoryError") else "killed"
+
+
+def save_run_record(state_store: StateStore, key: str, run: Dict[str, Any]):
+    """Adds a run to the stats history at key, replacing the record of the same run_id. Each history has one writer at
+    a time: a job's runs, each shard of an array job, or a backfill for its shards together"""
+    try:
+        history = state_store.get(key) or {"runs": []}
+        runs = [saved for saved in history["runs"] if saved.get("run_id") != run["run_id"]]
+        if run["status"] == "running":
+            try:
+                resolve_killed_runs(runs)
+            except Exception as exc:
+                LOGGER.warning(f"Could not look up why earlier runs were killed: {exc}")
+        # cached runs did no work, they'd only push real runs out of the history
+        history["runs"] = (runs + ([run] if run["status"] != "cached" else []))[-STATS_HISTORY:]
+        state_store.put(key, history)
+    except Exception as exc:
+        # stats are only used for sizing, they shouldn't fail a run
+        LOGGER.warning(f"Could not save run stats: {exc}")
+
+
+@dataclass
+class OutputTarget:
+    """OutputTarget is another table a job's query result is written to, see MaterializeAthenaQuery.targets
+    Args:
+        target_table (str): table to store data in
+        target_database (str, optional): glue db of the table, defaults to the job's
+        table_description (str, optional): defaults to the job's
+        partition_cols (List[str], optional): columns to partition the table by
+        columns (List[str], optional): the result columns written, defaults to all of them. Partition columns are always written
+        filter (str, optional): pandas DataFrame.query expression selecting the rows written, eg "state == 'New York'"
+        savemode (str, optional): "overwrite", "overwrite_partitions" or "append", defaults like the job's
+            (overwrite_partitions with partition_cols, otherwise overwrite, or append for incremental jobs)
+        layout (Dict, optional): Parquet layout of the table, see MaterializeAthenaQuery.layout
+        writer_options (Dict, optional): see MaterializeAthenaQuery.writer_options
+        partition_projection (Dict, optional): see MaterializeAthenaQuery.partition_projection
+    """
+    target_table: str
+    target_database: Optional[str] = None
+    table_description: Optional[str] = None
+    partition_cols: List[str] = field(default_factory=list)
+    columns: List[str] = field(default_factory=list)
+    filter: Optional[str] = None
+    savemode: Optional[str] = None
+    layout: Dict[str, Any] = field(default_factory=dict)
+    writer_options: Dict[str, Any] = field(default_factory=dict)
+    partition_projection: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+
+    def select(self, df: pd.DataFrame) -> pd.DataFrame:
+        """The rows and columns of a result frame this target writes"""
+        if self.filter:
+            df = df.query(self.filter)
+        if self.columns:
+            df = df[self.columns + [col for col in self.partition_cols if col not in self.columns]]
+        # a shallow copy, so writers casting columns don't change the frame the other targets write
+        return df.copy(deep=False)
+
+
 @dataclass
 class MaterializeAthenaQuery:
     """MaterializeAthenaQuery allows the user to run and publish athena Queries
@@ -43,6 +353,78 @@ class MaterializeAthenaQuery:
         stg_athena_bucket (str): temp location where Athena results are stored
         partition_cols (List[str], optional): columns to parition resulting table by
         query_params (Dict, , optional): dict of parmeters to pass into jinja templae
+        chunksize (int, optional): stream the query results in batches of this many rows and write
+            each batch as it arrives, keeping memory flat regardless of the result size
+        engine (str, optional): "pandas" (default) brings the results into the container and writes them
+            with awswrangler, "unload" has Athena write Parquet straight to the target and only updates the catalog,
+            "duckdb" runs the query locally with duckdb_engine.DuckDBEngine instead of Athena and writes its result like "pandas"
+        local_tables (Dict[str, str], optional): with the duckdb engine, where to read source tables from, eg
+            {"covid-19.nytimes_counties": "fixtures/nytimes_counties.parquet"}. Tables not listed are read from their Glue locations
+        watermark_column (str, optional): run incrementally. The max of this column in the target table is kept as a
+            high-water mark and passed into the template as `watermark` (None on the first run) so only newer rows are queried.
+            Templates compare with `watermark_op`, ">=" when the slice's partitions are overwritten and ">" when it's appended
+            to an unpartitioned table, so the rows at the watermark aren't appended again. With partition_cols it has to be
+            one of them, so the overwritten partitions only hold rows of the slice
+        lookback_days (int, optional): move the watermark passed to the template back by this many days (or units
+            for numeric watermarks) so late arriving or restated rows get rewritten. Needs partition_cols
+        state_store_uri (str, optional): where job state (watermarks, cache entries) is kept, see state_store.get_state_store.
+            Defaults to s3://<stg_athena_bucket>/_materialize_state
+        use_cache (bool, optional): skip the run when the rendered query and its source tables are unchanged since
+            the last successful run
+        cache_fingerprint (str, optional): how source tables are fingerprinted for the cache. "s3" (default) hashes the
+            keys and ETags of the table's objects, "glue" only uses the catalog's table update time and partition list.
+            "glue" misses files added to a table's existing partitions, or to an unpartitioned table, so it's only safe
+            for sources whose every change goes through the catalog, eg tables replaced by versioned publishing
+        source_tables (List[str], optional): "database.table" names the query reads, inferred from the query when empty
+        force_refresh (bool, optional): ignore a cache hit and run anyway, the new result replaces the cache entry
+        dtypes (Dict[str, str], optional): declared catalog types of result columns, eg {"state": "string", "new_cases": "int"}.
+            Declared columns are cast when read and written with exactly these types, and the table schema is no
+            longer evolved from each result, so catalog types stay the same across runs
+        categorical_cols (List[str], optional): low cardinality columns, eg state or county, read as pandas categoricals
+        arrow_strings (bool, optional): hold string columns as Arrow backed strings instead of python objects
+        downcast_ints (bool, optional): hold integer columns in the smallest integer type that fits their values.
+            They're still written with their original (or declared) type
+        writer_options (Dict, optional): write with parquet_writer.ParquetWriter instead of wr.s3.to_parquet, which splits
+            partitions into files of a target size and uploads them concurrently, eg {"target_file_mb": 128, "max_workers": 16}
+        publish_mode (str, optional): "inplace" (default) rewrites the dataset where it is. "versioned" writes each run to a
+            new version prefix of the dataset, audits it, then points the Glue table (or each partition) at it in one
+            catalog update, so readers never see a partly written table. Replaced versions are deleted after version_retention_hours
+        audit (Dict, optional): checks a versioned run has to pass before it's published, read from the Parquet footers,
+            eg {"min_rows": 1, "max_rows": 10000000, "not_null": ["state", "reporting_date"]}
+        version_retention_hours (int, optional): hours replaced versions are kept for in flight queries before they're deleted
+        layout (Dict, optional): Parquet layout tuned for the queries that read the table, eg {"sort_by": ["reporting_date", "fips"],
+            "compression": "zstd", "dictionary_columns": ["state", "county"], "row_group_rows": 100000}. Rows are sorted within each
+            partition (each batch with chunksize) so row group min/max statistics let Athena skip row groups of filtered queries.
+            Row groups default to 100k rows. Written with parquet_writer.ParquetWriter, the unload engine only applies the
+            sort order and codec
+        preflight (str, optional): "warn" or "fail" to check the rendered query's EXPLAIN IO plan before it runs, for partitioned
+            source tables read without constraining any partition key and, with scan_budget_gb, an estimated scan over budget
+        scan_budget_gb (float, optional): most data the query is expected to scan, see preflight.py for how it's estimated
+        checkpoint (bool, optional): save each stage of a run (query submitted, results available, files written, catalog
+            committed) in the state store, keyed by the rendered query and the Batch job, so a retried or rerun attempt
+            reuses the earlier attempt's query and files and picks up at the first incomplete stage. Off by default
+        checkpoint_ttl_hours (int, optional): hours a failed attempt's checkpoint can be resumed from, older ones are ignored
+        targets (List[Dict], optional): more tables to write the same result to, each an OutputTarget, eg
+            [{"target_table": "ny_cases", "filter": "state == 'New York'", "columns": ["reporting_date", "new_cases"]}].
+            The query runs once and the result (or each streamed batch) is written to the job's table and every
+            target in parallel. Not supported by the unload engine
+        partition_projection (Dict[str, Dict], optional): register the table with Athena partition projection instead of
+            registering its partitions, settings for each partition column in Athena's projection properties, eg
+            {"reporting_date": {"type": "date", "range": "2020-01-01,NOW"}, "state": {"type": "enum", "values": ["AK", "AL"]}}.
+            Date columns default to the yyyy-MM-dd format with a 1 day interval. Athena works out the partitions of a query
+            from these settings and the partition_cols layout, so runs make no per partition catalog writes and queries no
+            partition lookups. Without it, partitions a run wrote are registered together once every file is written,
+            in concurrent batches of 100. Not supported with publish_mode "versioned", which points each partition at its own version
+        sharding (Dict, optional): how the query is split between shards, eg {"key": "fips"} hashes fips values into
+            shards and {"key": "reporting_date", "start": "2020-01-01", "end": "2022-01-01"} splits the range into consecutive
+            slices. The template selects its shard's rows with {{ shard_filter }}, see get_shard_params
+        shard_index (int, optional): the shard this run materializes, AWS_BATCH_JOB_ARRAY_INDEX in an array job
+        shard_count (int, optional): shards the query is split into, each run by one child of an AWS Batch array job.
+            Shards need publish_mode "versioned": every shard adds its files to the same version, and the last shard to
+            finish audits the whole version and switches the catalog to it once. Not supported by the unload engine or with use_cache
+        shard_run_id (str, optional): identifies the shards of one run, the array job's id in AWS Batch
+        save_stats (bool, optional): records each run in the job's stats history, used to size its Batch job definition.
+            Off for the shards of a backfill, which record their runs together under backfill_stats
         savemode (str): not in the constructor, how the query is saved
     """
     sql_query_path: str
@@ -53,13 +435,1049 @@ class MaterializeAthenaQuery:
     stg_athena_bucket: str
     partition_cols: List[str] = field(default_factory=list)
     query_params: Dict = field(default_factory=dict)
+    chunksize: Optional[int] = None
+    engine: str = "pandas"
+    local_tables: Dict[str, str] = field(default_factory=dict)
+    watermark_column: Optional[str] = None
+    lookback_days: int = 0
+    state_store_uri: Optional[str] = None
+    use_cache: bool = False
+    cache_fingerprint: str = "s3"
+    source_tables: List[str] = field(default_factory=list)
+    force_refresh: bool = False
+    dtypes: Dict[str, str] = field(default_factory=dict)
+    categorical_cols: List[str] = field(default_factory=list)
+    arrow_strings: bool = False
+    downcast_ints: bool = False
+    writer_options: Dict[str, Any] = field(default_factory=dict)
+    layout: Dict[str, Any] = field(default_factory=dict)
+    publish_mode: str = "inplace"
+    audit: Dict[str, Any] = field(default_factory=dict)
+    version_retention_hours: int = 24
+    preflight: Optional[str] = None
+    scan_budget_gb: Optional[float] = None
+    checkpoint: bool = False
+    checkpoint_ttl_hours: int = 12
+    targets: List[Dict[str, Any]] = field(default_factory=list)
+    partition_projection: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    sharding: Dict[str, Any] = field(default_factory=dict)
+    shard_index: int = 0
+    shard_count: int = 1
+    shard_run_id: Optional[str] = None
+    save_stats: bool = True
     savemode: str = field(init=False)
-    # dtypes: Dict[str, str] = field(default_factory=dict)
+    metrics: Instrumentation = field(init=False, repr=False)
 
     def __post_init__(self):
         self.savemode = "overwrite_partitions" if self.partition_cols else "overwrite"
+        self.metrics = self._new_metrics()
+        if self.watermark_column and not self.partition_cols:
+            # without partitions to overwrite, incremental slices can only be appended
+            self.savemode = "append"
+            if self.lookback_days:
+                raise ValueError("lookback_days needs partition_cols, appending would add the lookback window again on every run")
+        if self.watermark_column and self.partition_cols and self.watermark_column not in self.partition_cols:
+            # overwriting partitions with only the new slice would drop their rows below the watermark
+            raise ValueError(f"watermark_column [{self.watermark_column}] has to be one of the partition_cols {self.partition_cols}, "
+                             "each run overwrites the partitions its slice writes")
+        if self.engine not in ("pandas", "unload", "duckdb"):
+            raise ValueError(f"Unknown engine [{self.engine}], expected 'pandas', 'unload' or 'duckdb'")
+        if self.cache_fingerprint not in ("s3", "glue"):
+            raise ValueError(f"Unknown cache_fingerprint [{self.cache_fingerprint}], expected 's3' or 'glue'")
+        if self.engine == "unload" and self.chunksize:
+            LOGGER.warning("chunksize is ignored by the unload engine, no rows are read into the container")
+        if self.engine == "unload" and (self.categorical_cols or self.arrow_strings or self.downcast_ints or self.writer_options):
+            LOGGER.warning("categorical_cols, arrow_strings, downcast_ints and writer_options are ignored by the unload engine")
+        unknown_layout = set(self.layout) - set(LAYOUT_DEFAULTS)
+        if unknown_layout:
+            raise ValueError(f"Unknown layout options {sorted(unknown_layout)}, expected {sorted(LAYOUT_DEFAULTS)}")
+        if self.engine == "unload" and (self.layout.get("dictionary_columns") or self.layout.get("row_group_rows")):
+            LOGGER.warning("layout dictionary_columns and row_group_rows are ignored by the unload engine")
+        if self.engine == "duckdb" and self.preflight:
+            LOGGER.warning("preflight checks Athena's plan, it's skipped by the duckdb engine")
+            self.preflight = None
+        if self.preflight not in (None, "warn", "fail"):
+            raise ValueError(f"Unknown preflight [{self.preflight}], expected 'warn' or 'fail'")
+        if self.publish_mode not in ("inplace", "versioned"):
+            raise ValueError(f"Unknown publish_mode [{self.publish_mode}], expected 'inplace' or 'versioned'")
+        if self.publish_mode == "versioned" and self.savemode == "append":
+            raise ValueError("publish_mode 'versioned' replaces the table or its partitions, it can't append incremental runs")
+        if self.partition_projection:
+            if self.publish_mode == "versioned":
+                raise ValueError("partition_projection reads partitions from one location template, publish_mode 'versioned' can't be projected")
+            # validates the settings before anything runs
+            get_projection_parameters(self.partition_projection, self.partition_cols, self.s3_dataset_output)
+        if not 0 <= self.shard_index < self.shard_count:
+            raise ValueError(f"shard_index {self.shard_index} is outside the {self.shard_count} shards")
+        if self.shard_count > 1:
+            if self.publish_mode != "versioned":
+                raise ValueError("Shards add their files to one version that's published once they're all written, they need publish_mode 'versioned'")
+            if not self.sharding:
+                raise ValueError("shard_count > 1 needs sharding, without it every shard would write the whole result")
+            if not self.shard_run_id:
+                raise ValueError("Shards of a run share a shard_run_id, eg the array job's id")
+            if self.engine == "unload" or self.use_cache:
+                raise ValueError("Sharding isn't supported by the unload engine, which writes server side, or with use_cache")
+        # types pinned for columns whose in memory type no longer matches the type they should be written with
+        self._write_dtypes = dict(self.dtypes)
+        self._new_version()
+        self._checkpoint = {"stages": {}}
+        self._resumed = False
+        # target writers save their progress in the job's checkpoint, from their own threads
+        self._checkpoint_lock = threading.Lock()
+        # index of the streamed batch being written, see _write_chunks
+        self._batch: Optional[int] = None
+        self._targets = [OutputTarget(**target) for target in self.targets]
+        if self._targets and self.engine == "unload":
+            raise ValueError("targets need the result in the container, they can't be used with the unload engine")
+        # set on the writers of targets, see _target_writers
+        self._target: Optional[OutputTarget] = None
+        self._writers: List[MaterializeAthenaQuery] = []
+
+    @property
+    def s3_dataset_output(self) -> str:
+        return f"s3://{self.target_bucket}/{self.target_database}/{self.target_table}"
 
-    def process_query(self) -> Optional[str]:
+    @property
+    def output_path(self) -> str:
+        """Where this run writes, the run's version prefix of the dataset when publishing versioned"""
+        if self.publish_mode == "versioned":
+            return f"{self.s3_dataset_output}/{self.version}"
+        return self.s3_dataset_output
+
+    def _new_version(self):
+        self.version = f"v_{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        if self.shard_count > 1:
+            # every shard of a run writes to the same version
+            self.version = f"v_{self.shard_run_id}"
+        # catalog types of everything this run wrote, registered when the version is published
+        self._columns_types: Dict[str, str] = {}
+        self._partitions_types: Dict[str, str] = {}
+
+    def _new_metrics(self) -> Instrumentation:
+        return Instrumentation(
+            namespace="MaterializeAthenaQuery",
+            dimensions={"Job": f"{self.target_database}.{self.target_table}"},
+            properties={"engine": self.engine, "savemode": self.savemode, "chunksize": self.chunksize}
+        )
+
+    @property
+    def state_store(self) -> StateStore:
+        if not hasattr(self, "_state_store"):
+            self._state_store = get_state_store(self.state_store_uri or f"s3://{self.stg_athena_bucket}/_materialize_state")
+        return self._state_store
+
+    def _state_key(self, name: str) -> str:
+        return f"{self.target_database}/{self.target_table}/{name}"
+
+    def _get_watermark(self) -> Optional[str]:
+        """Gets the stored high-water mark moved back by the lookback window"""
+        state = self.state_store.get(self._state_key("watermark"))
+        if state is None:
+            LOGGER.info("No watermark found, running a full load")
+            return None
+        watermark = state["watermark"]
+        if self.lookback_days:
+            try:
+                watermark = str(float(watermark) - self.lookback_days) if "." in watermark else str(int(watermark) - self.lookback_days)
+            except ValueError:
+                moved = pd.Timestamp(watermark) - pd.Timedelta(days=self.lookback_days)
+                # in the stored format, a date column's watermark stays a date
+                if re.fullmatch(r"\d{4}-\d{2}-\d{2}", watermark):
+                    watermark = moved.strftime("%Y-%m-%d")
+                else:
+                    watermark = moved.isoformat() if "T" in watermark else str(moved)
+        LOGGER.info(f"Stored watermark [{state['watermark']}], querying from [{watermark}]")
+        return watermark
+
+    def _save_watermark(self):
+        sql = f'SELECT max("{self.watermark_column}") AS watermark FROM "{self.target_database}"."{self.target_table}"'
+        if self.engine == "duckdb":
+            from duckdb_engine import DuckDBEngine
+            df = DuckDBEngine(default_database=self.target_database).query(sql)
+        else:
+            df = wr.athena.read_sql_query(
+                sql=sql,
+                database=self.target_database,
+                ctas_approach=False,
+                s3_output=f"s3://{self.stg_athena_bucket}/{self.target_table}"
+            )
+        watermark = df["watermark"].iloc[0]
+        if pd.isna(watermark):
+            LOGGER.warning(f"Target table has no {self.watermark_column} values, watermark not updated")
+            return
+        self.state_store.put(self._state_key("watermark"), {
+            "watermark": str(watermark),
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        })
+        LOGGER.info(f"Saved watermark [{watermark}]")
+
+    def _get_table_fingerprint(self, table: str) -> Optional[str]:
+        """Hashes what identifies the current contents of a source table, None if it isn't a catalog table (eg a CTE)"""
+        database, name = table.split(".", 1)
+        glue = boto3.client('glue')
+        try:
+            glue_table = glue.get_table(DatabaseName=database, Name=name)['Table']
+        except glue.exceptions.EntityNotFoundException:
+            return None
+
+        digest = hashlib.sha256(str(glue_table.get('UpdateTime')).encode())
+        # projected tables have no partitions in the catalog, their objects are listed instead
+        if self.cache_fingerprint == "glue" and glue_table.get('Parameters', {}).get('projection.enabled') != "true":
+            for page in glue.get_paginator('get_partitions').paginate(DatabaseName=database, TableName=name):
+                for partition in page['Partitions']:
+                    digest.update(f"{partition['Values']}:{partition.get('CreationTime')}".encode())
+        else:
+            loc = urlparse(glue_table['StorageDescriptor']['Location'])
+            paginator = boto3.client('s3').get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=loc.netloc, Prefix=loc.path[1:]):
+                for obj in page.get('Contents', []):
+                    digest.update(f"{obj['Key']}:{obj['ETag']}:{obj['Size']}".encode())
+        return digest.hexdigest()
+
+    def _get_cache_key(self, sql_query: str) -> str:
+        source_tables = self.source_tables or get_source_tables(sql_query, self.target_database)
+        fingerprints = {table: self._get_table_fingerprint(table) for table in source_tables}
+        LOGGER.info(f"*****SOURCE FINGERPRINTS*****\n{json.dumps(fingerprints, sort_keys=True, indent=2)}")
+        return hashlib.sha256(json.dumps({
+            "sql": sql_query,
+            "target": self.s3_dataset_output,
+            "partition_cols": self.partition_cols,
+            "savemode": self.savemode,
+            "engine": self.engine,
+            "sources": fingerprints
+        }, sort_keys=True).encode()).hexdigest()
+
+    @property
+    def _stats_key(self) -> str:
+        # shards of a run finish together, each keeps its own history so they don't overwrite each other's runs
+        return self._state_key(f"stats/shard-{self.shard_index:05d}" if self.shard_count > 1 else "stats")
+
+    def run_record(self, status: str) -> Dict[str, Any]:
+        """This run's resource usage, as saved in the job's stats history"""
+        stages = self.metrics.stages
+        now = datetime.now(timezone.utc).isoformat()
+        if status == "running":
+            self._run_started_at = now
+        return {
+            "run_id": self._run_id,
+            "status": status,
+            "started_at": self._run_started_at,
+            "completed_at": now,
+            "batch_job_id": os.environ.get("AWS_BATCH_JOB_ID"),
+            "engine": self.engine,
+            "chunksize": self.chunksize,
+            "data_scanned_bytes": stages.get("athena_execution", {}).get("bytes", 0),
+            "result_rows": stages.get("write", stages.get("download_parse", {})).get("rows", 0),
+            "result_bytes": stages.get("download_parse", {}).get("bytes", 0),
+            "peak_rss_mb": peak_rss_mb(),
+            "seconds": round(sum(stats["seconds"] for stats in stages.values()), 3),
+            "memory_limit_mb": memory_limit_mb(),
+        }
+
+    def _save_run_stats(self, status: str):
+        """Records this run's resource usage in the job's stats history. Runs are recorded as running when they start
+        and replaced when they end, so a run that was killed stays running in the history until a later run finds out
+        why, see resolve_killed_runs. Backfill shards don't save theirs, the backfill saves them together"""
+        run = self.run_record(status)
+        if self.save_stats:
+            save_run_record(self.state_store, self._stats_key, run)
+
+    def invalidate_cache(self):
+        """Drops the cache entry so the next run materializes regardless of its inputs"""
+        self.state_store.delete(self._state_key("cache"))
+
+    def _start_checkpoint(self, sql_query: str):
+        """Loads the checkpoint an earlier attempt of this run left, or starts a new one.
+
+        Attempts are the same run when they render the same query with the same write settings, and within
+        AWS Batch belong to the same job (retries keep AWS_BATCH_JOB_ID), so a later scheduled run of an
+        unchanged query doesn't reuse a failed run's results.
+        """
+        self._checkpoint = {"stages": {}}
+        self._resumed = False
+        if not self.checkpoint:
+            return
+        run_id = hashlib.sha256(json.dumps({
+            "sql": sql_query,
+            "target": self.s3_dataset_output,
+            "partition_cols": self.partition_cols,
+            "savemode": self.savemode,
+            "engine": self.engine,
+            "chunksize": self.chunksize,
+            "publish_mode": self.publish_mode,
+            "batch_job_id": os.environ.get("AWS_BATCH_JOB_ID"),
+        }, sort_keys=True).encode()).hexdigest()
+        self._checkpoint_key = self._state_key(f"checkpoints/{run_id}")
+        saved = self.state_store.get(self._checkpoint_key)
+        if saved is None:
+            return
+        if datetime.fromisoformat(saved["created_at"]) < datetime.now(timezone.utc) - timedelta(hours=self.checkpoint_ttl_hours):
+            LOGGER.info(f"Ignoring the checkpoint of an attempt from {saved['created_at']}, it's past checkpoint_ttl_hours")
+            return
+        self._checkpoint = saved
+        self._resumed = True
+        # versioned runs resume writing to the version the earlier attempt started
+        self.version = saved["version"]
+        LOGGER.info(f"*****RESUMING*****\n\tattempt from {saved['created_at']} completed stages {sorted(saved['stages'])}")
+
+    def _save_checkpoint(self, stage: str, **values):
+        if not self.checkpoint:
+            return
+        with self._checkpoint_lock:
+            self._checkpoint.setdefault("created_at", datetime.now(timezone.utc).isoformat())
+            self._checkpoint["version"] = self.version
+            # a copy, the caller keeps adding to its write result while other writers save the checkpoint
+            self._checkpoint["stages"][stage] = {**copy.deepcopy(values), "completed_at": datetime.now(timezone.utc).isoformat()}
+            self.state_store.put(self._checkpoint_key, self._checkpoint)
+
+    def _written_types(self) -> Dict[str, Dict[str, str]]:
+        return {"columns": self._columns_types, "partitions": self._partitions_types}
+
+    def _restore_types(self, types: Dict[str, Dict[str, str]]):
+        self._columns_types.update(types["columns"])
+        self._partitions_types.update(types["partitions"])
+
+    def _clear_checkpoint(self):
+        if self.checkpoint and self._checkpoint["stages"]:
+            self.state_store.delete(self._checkpoint_key)
+
+    def _resume_query(self, stage: str) -> Optional[Dict[str, Any]]:
+        """Returns the checkpointed stage of a query an earlier attempt submitted, once the query has succeeded.
+        Waits for it if it's still running, None when there's no such query or it failed"""
+        saved = self._checkpoint["stages"].get(stage)
+        if not saved:
+            return None
+        try:
+            query_metadata = wr.athena.wait_query(query_execution_id=saved["query_execution_id"])
+        except Exception as exc:
+            LOGGER.warning(f"Can't reuse query [{saved['query_execution_id']}] of an earlier attempt, running it again: {exc}")
+            return None
+        self._result_location = query_metadata["ResultConfiguration"]["OutputLocation"]
+        LOGGER.info(f"Reusing the results of query [{saved['query_execution_id']}] from an earlier attempt")
+        return saved
+
+    def _log_query_stats(self, statistics: Dict[str, Any]):
+        LOGGER.info(
+            '*****Query Stats*****\n%s',
+            json.dumps(statistics, sort_keys=True, indent=2),
+        )
+        self.metrics.record("athena_queue", seconds=statistics.get("QueryQueueTimeInMillis", 0) / 1000)
+        self.metrics.record(
+            "athena_execution",
+            seconds=statistics.get("EngineExecutionTimeInMillis", 0) / 1000,
+            num_bytes=statistics.get("DataScannedInBytes", 0)
+        )
+
+    def _compact_frame(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Applies the declared dtypes and the compact in memory representations to a result frame"""
+        for col, col_type in self.dtypes.items():
+            if col in df.columns and col_type in GLUE_TO_PANDAS_INT_TYPES:
+                df[col] = df[col].astype(GLUE_TO_PANDAS_INT_TYPES[col_type])
+        if self.arrow_strings:
+            for col in df.columns[df.dtypes == object]:
+                if col not in self.categorical_cols and pd.api.types.infer_dtype(df[col], skipna=True) == "string":
+                    df[col] = df[col].astype("string[pyarrow]")
+        if self.downcast_ints:
+            for col in df.select_dtypes(include=["integer"]).columns:
+                if col not in self._write_dtypes:
+                    # pin the result's type first so the catalog doesn't follow the downcast values
+                    self._write_dtypes.update(wr.catalog.extract_athena_types(df=df[[col]], index=False)[0])
+                df[col] = pd.to_numeric(df[col], downcast="integer")
+        return df
+
+    def _write_frame(self, df: pd.DataFrame, mode: str) -> Dict[str, Any]:
+        if df.empty and self.shard_count > 1:
+            # a shard's slice can be empty, the other shards' rows are still published
+            LOGGER.warning(f"Shard {self.shard_index} has no rows, nothing was written")
+            return {"paths": [], "partitions_values": {}}
+        # awswrangler encodes, uploads and updates the catalog in one call, so they're timed as one stage
+        with self.metrics.stage("write") as stats:
+            write_result = self._to_parquet(df, mode)
+            stats["rows"] += len(df)
+        self.metrics.record("write", num_bytes=sum(wr.s3.size_objects(path=write_result["paths"]).values()))
+        return write_result
+
+    def _to_parquet(self, df: pd.DataFrame, mode: str) -> Dict[str, Any]:
+        dtype = {col: col_type for col, col_type in self._write_dtypes.items() if col in df.columns}
+        # versions are only registered in the catalog once they're complete and audited (see _publish), partitioned
+        # tables once every partition is written (see _commit_catalog)
+        register = self.publish_mode != "versioned" and not self.partition_cols
+        if self.shard_count > 1:
+            # shards share the version's partitions, each only adds (and on a retry replaces) its own files
+            mode = "append"
+        if not register:
+            columns_types, partitions_types = wr.catalog.extract_athena_types(
+                df=df, index=False, partition_cols=self.partition_cols, dtype=dtype
+            )
+            self._columns_types.update(columns_types)
+            self._partitions_types.update(partitions_types)
+        if self.writer_options or self.layout:
+            from parquet_writer import ParquetWriter
+            return ParquetWriter(
+                path=self.output_path,
+                database=self.target_database if register else None,
+                table=self.target_table,
+                partition_cols=self.partition_cols,
+                description=self.table_description,
+                dtype=dtype,
+                schema_evolution=not self.dtypes,
+                filename_prefix=self._filename_prefix or "",
+                **{**self.writer_options, **self._layout}
+            ).write(df, mode)
+        return wr.s3.to_parquet(
+            df=df,
+            path=self.output_path,
+            dataset=True,
+            database=self.target_database if register else None,
+            table=self.target_table if register else None,
+            mode=mode,
+            partition_cols=self.partition_cols,
+            schema_evolution=not self.dtypes,
+            index=False,
+            description=self.table_description,
+            dtype=dtype,
+            filename_prefix=self._filename_prefix
+        )
+
+    @property
+    def _layout(self) -> Dict[str, Any]:
+        """The layout the files are written with, layout over writer_options over the defaults"""
+        return {**LAYOUT_DEFAULTS, **{k: v for k, v in self.writer_options.items() if k in LAYOUT_DEFAULTS}, **self.layout}
+
+    @property
+    def _shard_prefix(self) -> str:
+        return f"shard-{self.shard_index:05d}_" if self.shard_count > 1 else ""
+
+    @property
+    def _filename_prefix(self) -> Optional[str]:
+        # streamed batches are named by run and batch, so a resumed attempt can find the files of the batch it rewrites
+        batch = f"{self.version}_batch-{self._batch:05d}_" if self._batch is not None else ""
+        return self._shard_prefix + batch or None
+
+    def _delete_files(self, prefix: str, written_by: str):
+        paths = [path for path in wr.s3.list_objects(path=f"{self.output_path}/") if os.path.basename(path).startswith(prefix)]
+        if paths:
+            LOGGER.info(f"Deleting {len(paths)} files {written_by} wrote")
+            wr.s3.delete_objects(path=paths)
+
+    def _clear_shard_files(self):
+        """Deletes the files an earlier attempt of this shard wrote to the version, the other shards' are kept"""
+        if (self.state_store.get(self._shard_key("commit")) or {}).get("published_at"):
+            raise ValueError(f"Shards of run {self.shard_run_id} were already published, a shard can't be written again")
+        self._delete_files(self._shard_prefix, f"an earlier attempt of shard {self.shard_index}")
+
+    def _shard_key(self, name: str) -> str:
+        return self._state_key(f"shards/{self.shard_run_id}/{name}")
+
+    def _collect_shards(self, write_result: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Records this shard's write result, then if every shard has written returns the write result of the whole
+        version, with each target's merged the same way. Only one shard gets it, the others get None.
+
+        Each shard writes its result before reading the others', so at least the last one to finish sees them all.
+        When more than one does, a conditional put of the commit key picks the shard that publishes.
+        """
+        self.state_store.put(self._shard_key(str(self.shard_index)), {
+            "write_result": write_result,
+            "types": self._written_types(),
+            "targets": [{"write_result": writer._target_result, "types": writer._written_types()} for writer in self._writers],
+        })
+        shards = [self.state_store.get(self._shard_key(str(i))) for i in range(self.shard_count)]
+        if not all(shards):
+            LOGGER.info(f"Shard {self.shard_index} written, {shards.count(None)} of {self.shard_count} shards are still running")
+            return None
+        claimed = self.state_store.put_if_absent(self._shard_key("commit"), {"shard_index": self.shard_index})
+        # a retry of the shard that claimed the commit picks it up again
+        if not claimed and self.state_store.get(self._shard_key("commit"))["shard_index"] != self.shard_index:
+            LOGGER.info(f"Shard {self.shard_index} written, another shard publishes the version")
+            return None
+
+        merged = {"paths": [], "partitions_values": {}}
+        targets = [{"paths": [], "partitions_values": {}} for _ in self._writers]
+        for shard in shards:
+            merged["paths"].extend(shard["write_result"]["paths"])
+            merged["partitions_values"].update(shard["write_result"]["partitions_values"])
+            self._restore_types(shard["types"])
+            for writer, target, written in zip(self._writers, targets, shard["targets"]):
+                target["paths"].extend(written["write_result"]["paths"])
+                target["partitions_values"].update(written["write_result"]["partitions_values"])
+                writer._restore_types(written["types"])
+        for writer, target in zip(self._writers, targets):
+            writer._target_result = target
+        LOGGER.info(f"All {self.shard_count} shards written, shard {self.shard_index} publishes {len(merged['paths'])} files")
+        return merged
+
+    def _clear_shards(self):
+        # the commit key is kept, it stops a rerun of a shard from changing the published version
+        self.state_store.put(self._shard_key("commit"), {
+            "shard_index": self.shard_index,
+            "published_at": datetime.now(timezone.utc).isoformat()
+        })
+        for i in range(self.shard_count):
+            self.state_store.delete(self._shard_key(str(i)))
+
+    def _target_writers(self) -> List[MaterializeAthenaQuery]:
+        """A job for each target that only writes, sharing this job's settings"""
+        writers = []
+        for target in self._targets:
+            writer = replace(
+                self,
+                target_database=target.target_database or self.target_database,
+                target_table=target.target_table,
+                table_description=target.table_description or self.table_description,
+                partition_cols=target.partition_cols,
+                layout=target.layout,
+                writer_options=target.writer_options,
+                partition_projection=target.partition_projection,
+                # incremental state and caching belong to the job
+                watermark_column=None,
+                use_cache=False,
+                preflight=None,
+                targets=[]
+            )
+            savemode = target.savemode
+            if not savemode and self.watermark_column:
+                # incremental runs only query the new slice, which has to be appended or overwrite just the partitions it covers
+                if target.partition_cols and self.watermark_column not in target.partition_cols:
+                    raise ValueError(f"Target {target.target_table} of an incremental job needs {self.watermark_column} in its "
+                                     "partition_cols or an explicit savemode, overwriting its partitions would drop older rows")
+                savemode = "overwrite_partitions" if target.partition_cols else "append"
+            if savemode:
+                if savemode not in ("overwrite", "overwrite_partitions", "append"):
+                    raise ValueError(f"Unknown savemode [{savemode}] of target {target.target_table}")
+                if self.publish_mode == "versioned" and savemode == "append":
+                    raise ValueError(f"publish_mode 'versioned' can't append, target {target.target_table} does")
+                writer.savemode = savemode
+            writer._target = target
+            # batches a target wrote are checkpointed with the job's, so a resumed attempt skips them for every target
+            writer._checkpoint = self._checkpoint
+            writer._checkpoint_key = getattr(self, "_checkpoint_key", None)
+            writer._checkpoint_lock = self._checkpoint_lock
+            writer._resumed = self._resumed
+            # types pinned while compacting the shared result apply to every target
+            writer._write_dtypes = self._write_dtypes
+            writer.version = self.version
+            writers.append(writer)
+        return writers
+
+    def _write_result(self, result: Union[pd.DataFrame, Iterator[pd.DataFrame]]) -> Dict[str, Any]:
+        """Writes the query result to the job's table and in parallel to every target, returns the job's write result.
+
+        A streamed result is passed to each writer through a small queue, so every batch is held in memory once
+        however many targets there are, and the slowest writer sets the pace.
+        """
+        if not self._writers:
+            return self._write_chunks(result) if self.chunksize else self._write_frame(result, self.savemode)
+        writers = [self] + self._writers
+        with ThreadPoolExecutor(max_workers=len(writers)) as pool:
+            if not self.chunksize:
+                futures = [pool.submit(writer._write_frame, writer._select(result), writer.savemode) for writer in writers]
+            else:
+                queues = [queue.Queue(maxsize=2) for _ in writers]
+                futures = [pool.submit(writer._write_from_queue, batches) for writer, batches in zip(writers, queues)]
+                try:
+                    for chunk in result:
+                        for batches in queues:
+                            batches.put(chunk)
+                finally:
+                    for batches in queues:
+                        batches.put(None)
+            results = [future.result() for future in futures]
+        for writer, write_result in zip(self._writers, results[1:]):
+            writer._target_result = write_result
+            LOGGER.info(f"Wrote {len(write_result['paths'])} files to target {writer.target_database}.{writer.target_table}")
+        return results[0]
+
+    def _select(self, df: pd.DataFrame) -> pd.DataFrame:
+        return self._target.select(df) if self._target else df
+
+    def _write_from_queue(self, batches: queue.Queue) -> Dict[str, Any]:
+        def consume() -> Iterator[pd.DataFrame]:
+            while True:
+                chunk = batches.get()
+                if chunk is None:
+                    return
+                yield chunk
+
+        try:
+            return self._write_chunks(self._select(chunk) for chunk in consume())
+        except BaseException:
+            # keep taking batches so the reader isn't blocked on a writer that failed
+            for _ in consume():
+                pass
+            raise
+
+    @property
+    def _chunks_stage(self) -> str:
+        """The checkpoint stage of the batches this writer wrote, each target has its own"""
+        return f"chunks/{self.target_database}.{self.target_table}" if self._target else "chunks"
+
+    def _write_chunks(self, chunks: Iterator[pd.DataFrame]) -> Dict[str, Any]:
+        """Writes a stream of result batches to the dataset as they arrive.
+
+        The first batch is written with the savemode and later batches are appended, so nothing
+        this run wrote gets clobbered. With partition_cols, rows for a partition not yet seen in
+        this run overwrite that partition and rows for an already written partition are appended,
+        which ends with the same partitions as a single overwrite_partitions write of the full frame.
+
+        Progress is checkpointed after every batch. A resumed attempt skips the batches an earlier attempt
+        wrote. A batch that was being written when it failed is written again, after deleting the files the
+        failed attempt wrote for it, which are found by the batch's filename prefix.
+        """
+        stage = self._chunks_stage
+        if stage not in self._checkpoint["stages"]:
+            # recorded before anything is written, so a retry knows the first batch may have files to delete
+            self._save_checkpoint(stage, batches=0, write_result={"paths": [], "partitions_values": {}})
+        resumed = self._checkpoint["stages"].get(stage, {"batches": 0, "write_result": {"paths": [], "partitions_values": {}}})
+        write_result = copy.deepcopy(resumed["write_result"])
+        if "types" in resumed:
+            self._restore_types(resumed["types"])
+        written_partitions = set()
+        rows = 0
+        for i, chunk in enumerate(chunks):
+            rows += len(chunk)
+            if self.partition_cols:
+                keys = pd.MultiIndex.from_frame(chunk[self.partition_cols])
+                seen = keys.isin(list(written_partitions))
+                batches = [(chunk[~seen], self.savemode), (chunk[seen], "append")]
+                written_partitions.update(keys.unique())
+            else:
+                batches = [(chunk, self.savemode if i == 0 else "append")]
+            if i < resumed["batches"]:
+                LOGGER.info(f"Skipping batch {i}, written by an earlier attempt")
+                continue
+
+            self._batch = i
+            if self._resumed and i == resumed["batches"]:
+                self._delete_files(self._filename_prefix, f"the earlier attempt's write of batch {i}")
+            for df, mode in batches:
+                if df.empty:
+                    continue
+                result = self._write_frame(df, mode)
+                write_result["paths"].extend(result["paths"])
+                write_result["partitions_values"].update(result["partitions_values"])
+            self._save_checkpoint(stage, batches=i + 1, write_result=write_result, types=self._written_types())
+            LOGGER.info(f"Wrote batch {i} ({len(chunk)} rows, {rows} total)")
+        self._batch = None
+
+        if not rows:
+            LOGGER.warning("Query returned no rows, nothing was written")
+        return write_result
+
+    def _run_athena_statement(self, sql: str, checkpoint: Optional[str] = None, **checkpoint_values) -> str:
+        """Runs a statement and waits for it. With a checkpoint stage name, the query id is saved as soon as it's
+        submitted, so a retry can wait on the same query (see _resume_query) instead of running it again"""
+        query_execution_id = wr.athena.start_query_execution(
+            sql=sql,
+            database=self.target_database,
+            s3_output=f"s3://{self.stg_athena_bucket}/{self.target_table}"
+        )
+        if checkpoint:
+            self._save_checkpoint(checkpoint, query_execution_id=query_execution_id, **checkpoint_values)
+        query_metadata = wr.athena.wait_query(query_execution_id=query_execution_id)
+        self._log_query_stats(query_metadata["Statistics"])
+        self._result_location = query_metadata["ResultConfiguration"]["OutputLocation"]
+        if checkpoint:
+            self._save_checkpoint(checkpoint, query_execution_id=query_execution_id, succeeded=True, **checkpoint_values)
+        return query_execution_id
+
+    def _unload(self, sql_query: str) -> Dict[str, Any]:
+        """Materializes the query server side. Athena UNLOADs Parquet to S3 and only the Glue catalog
+        is updated from the container, so no rows are downloaded, parsed or uploaded again.
+
+        With "overwrite" the target prefix is emptied and unloaded into directly. With
+        "overwrite_partitions" the query is unloaded to a staging prefix and each partition it produced
+        replaces the matching target partition through server side S3 copies.
+        """
+        # UNLOAD needs the partition columns last, a LIMIT 0 probe gets the column names and types without a scan
+        probe_id = self._run_athena_statement(f"SELECT * FROM (\n{sql_query}\n) LIMIT 0")
+        columns_types = {
+            col: self.dtypes.get(col, ATHENA_TO_GLUE_TYPES.get(col_type, col_type))
+            for col, col_type in wr.athena.get_query_columns_types(query_execution_id=probe_id).items()
+        }
+        partitions_types = {col: columns_types.pop(col) for col in self.partition_cols}
+        select_cols = ", ".join(
+            f'CAST("{col}" AS {GLUE_TO_ATHENA_TYPES.get(self.dtypes[col], self.dtypes[col])}) AS "{col}"'
+            if col in self.dtypes else f'"{col}"'
+            for col in list(columns_types) + self.partition_cols
+        )
+        partitioned_by = (
+            f", partitioned_by = ARRAY[{', '.join(repr(col) for col in self.partition_cols)}]"
+            if self.partition_cols else ""
+        )
+
+        resumed = self._resume_query("unload")
+        if resumed:
+            unload_path = resumed["unload_path"]
+        elif self.publish_mode == "versioned" or self.savemode == "overwrite":
+            unload_path = f"{self.output_path}/"
+            # UNLOAD needs an empty target, a failed earlier attempt may have left files in it
+            wr.s3.delete_objects(path=unload_path)
+        else:
+            unload_path = f"s3://{self.stg_athena_bucket}/{self.target_table}/unload/{uuid.uuid4().hex}/"
+
+        # sorting makes Athena write the output in order, so the written files cover narrow ranges of the sort keys
+        order_by = ", ".join(f'"{col}"' for col in self.layout.get("sort_by", []))
+        compression = self._layout["compression"].upper()
+        if not resumed:
+            self._run_athena_statement(
+                f"UNLOAD (SELECT {select_cols} FROM (\n{sql_query}\n){f' ORDER BY {order_by}' if order_by else ''})\n"
+                f"TO '{unload_path}'\n"
+                f"WITH (format = 'PARQUET', compression = '{compression}'{partitioned_by})",
+                checkpoint="unload",
+                unload_path=unload_path
+            )
+        paths = wr.s3.list_objects(path=unload_path)
+
+        partitions_values = {}
+        if self.partition_cols:
+            for path in paths:
+                partition_dir = os.path.dirname(path[len(unload_path):]) + "/"
+                partitions_values[f"{self.output_path}/{partition_dir}"] = [
+                    unquote(part.split("=", 1)[1]) for part in partition_dir.strip("/").split("/")
+                ]
+        if self.publish_mode == "versioned":
+            self._columns_types, self._partitions_types = columns_types, partitions_types
+            return {"paths": paths, "partitions_values": partitions_values}
+
+        copied = self._checkpoint["stages"].get("copied")
+        if copied:
+            # the staging prefix is gone once its files are copied, the earlier attempt's copies are used as they are
+            paths, partitions_values = copied["paths"], copied["partitions_values"]
+        elif self.partition_cols:
+            with self.metrics.stage("s3_copy") as stats:
+                for target_dir in partitions_values:
+                    wr.s3.delete_objects(path=target_dir)
+                paths = wr.s3.copy_objects(
+                    paths=paths,
+                    source_path=unload_path,
+                    target_path=f"{self.s3_dataset_output}/"
+                )
+                self._save_checkpoint("copied", paths=paths, partitions_values=partitions_values)
+                wr.s3.delete_objects(path=unload_path)
+                stats["bytes"] += sum(wr.s3.size_objects(path=paths).values())
+
+        with self.metrics.stage("catalog"):
+            wr.catalog.create_parquet_table(
+                database=self.target_database,
+                table=self.target_table,
+                path=f"{self.s3_dataset_output}/",
+                columns_types=columns_types,
+                partitions_types=partitions_types,
+                compression=self._layout["compression"],
+                description=self.table_description,
+                parameters=self._projection_parameters(),
+                # awswrangler sets projection.enabled from this, over the parameters
+                projection_enabled=bool(self.partition_projection),
+                mode="overwrite" if self.savemode == "overwrite" else "append"
+            )
+            if partitions_values and not self.partition_projection:
+                self._columns_types = columns_types
+                self._register_partitions(partitions_values)
+        return {"paths": paths, "partitions_values": partitions_values}
+
+    def _projection_parameters(self) -> Optional[Dict[str, str]]:
+        if not self.partition_projection:
+            return None
+        return get_projection_parameters(self.partition_projection, self.partition_cols, self.s3_dataset_output)
+
+    def _register_partitions(self, partitions_values: Dict[str, List[str]]):
+        """Adds partitions to the catalog in batches of PARTITION_BATCH_SIZE, several batches at once. Partitions that
+        are already registered are left as they are, their location doesn't change"""
+        items = list(partitions_values.items())
+        batches = [dict(items[i:i + PARTITION_BATCH_SIZE]) for i in range(0, len(items), PARTITION_BATCH_SIZE)]
+
+        def add(batch: Dict[str, List[str]]):
+            wr.catalog.add_parquet_partitions(
+                database=self.target_database,
+                table=self.target_table,
+                partitions_values=batch,
+                compression=self._layout["compression"],
+                columns_types=self._columns_types
+            )
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(add, batches))
+        LOGGER.info(f"Registered {len(items)} partitions in {len(batches)} batches")
+
+    def _commit_catalog(self, write_result: Dict[str, Any]):
+        """Registers a partitioned table written in place once all its files are written: one table update with the
+        columns of every write, then the partitions in bulk, or none when they're projected"""
+        if not write_result["paths"]:
+            return
+        with self.metrics.stage("catalog"):
+            wr.catalog.create_parquet_table(
+                database=self.target_database,
+                table=self.target_table,
+                path=f"{self.s3_dataset_output}/",
+                columns_types=self._columns_types,
+                partitions_types=self._partitions_types,
+                compression=self._layout["compression"],
+                description=self.table_description,
+                parameters=self._projection_parameters(),
+                # awswrangler sets projection.enabled from this, over the parameters
+                projection_enabled=bool(self.partition_projection),
+                mode="overwrite" if self.savemode == "overwrite" else "append" if self.dtypes else "update"
+            )
+            if self.partition_projection:
+                self._check_projected_values(write_result["partitions_values"])
+            elif write_result["partitions_values"]:
+                self._register_partitions(write_result["partitions_values"])
+
+    def _check_projected_values(self, partitions_values: Dict[str, List[str]]):
+        """Warns about written partitions outside the projected enum values or integer ranges, Athena doesn't read them"""
+        def as_list(value: Any) -> List[str]:
+            return value.split(",") if isinstance(value, str) else [str(item) for item in value]
+
+        uncovered = set()
+        for values in partitions_values.values():
+            for col, value in zip(self.partition_cols, values):
+                settings = self.partition_projection[col]
+                if settings["type"] == "enum" and value not in [item.strip() for item in as_list(settings["values"])]:
+                    uncovered.add(f"{col}={value}")
+                elif settings["type"] == "integer":
+                    low, high = (int(bound) for bound in as_list(settings["range"]))
+                    if not low <= int(value) <= high:
+                        uncovered.add(f"{col}={value}")
+        if uncovered:
+            LOGGER.warning(f"Partitions outside partition_projection of {self.target_table} aren't visible to Athena: {sorted(uncovered)}")
+
+    def _read_and_write(self, sql_query: str) -> Dict[str, Any]:
+        # run the query, then fetch its csv result as a dataframe, or as an iterator of dataframes when streaming.
+        # This is read_sql_query with ctas_approach=False split up so the stages can be timed separately
+        # see different approaches here https://aws-data-wrangler.readthedocs.io/en/stable/stubs/awswrangler.athena.read_sql_query.html
+        resumed = self._resume_query("query")
+        query_execution_id = resumed["query_execution_id"] if resumed else self._run_athena_statement(sql_query, checkpoint="query")
+        result_bytes = wr.s3.size_objects(path=self._result_location)[self._result_location]
+
+        # write the dataframe(s) to the destination
+        if self.chunksize:
+            chunks = wr.athena.get_query_results(
+                query_execution_id=query_execution_id,
+                categories=self.categorical_cols or None,
+                chunksize=self.chunksize
+            )
+            self.metrics.record("download_parse", num_bytes=result_bytes)
+            chunks = (self._compact_frame(chunk) for chunk in chunks)
+            return self._write_result(self.metrics.timed_iter("download_parse", chunks))
+        with self.metrics.stage("download_parse") as stats:
+            df = self._compact_frame(wr.athena.get_query_results(
+                query_execution_id=query_execution_id,
+                categories=self.categorical_cols or None
+            ))
+            stats["rows"] += len(df)
+            stats["bytes"] += result_bytes
+        return self._write_result(df)
+
+    def _run_local(self, sql_query: str) -> Dict[str, Any]:
+        """Runs the query with DuckDB in the container and writes the result like _read_and_write"""
+        from duckdb_engine import DuckDBEngine
+
+        engine = DuckDBEngine(default_database=self.target_database, tables=self.local_tables)
+        def categorize(df: pd.DataFrame) -> pd.DataFrame:
+            return df.astype({col: "category" for col in self.categorical_cols if col in df.columns})
+
+        if self.chunksize:
+            chunks = (self._compact_frame(categorize(chunk)) for chunk in engine.query_chunks(sql_query, self.chunksize))
+            return self._write_result(self.metrics.timed_iter("local_query", chunks))
+        with self.metrics.stage("local_query") as stats:
+            df = self._compact_frame(categorize(engine.query(sql_query)))
+            stats["rows"] += len(df)
+        return self._write_result(df)
+
+    def _preflight(self, sql_query: str):
+        """Checks the rendered query's IO plan before it runs, warns or raises depending on the preflight mode"""
+        import preflight
+
+        df = wr.athena.read_sql_query(
+            sql=f"EXPLAIN (TYPE IO, FORMAT JSON)\n{sql_query}",
+            database=self.target_database,
+            ctas_approach=False,
+            s3_output=f"s3://{self.stg_athena_bucket}/{self.target_table}"
+        )
+        scans = preflight.parse_io_plan(json.loads("\n".join(df.iloc[:, 0].astype(str))))
+        preflight.add_catalog_metadata(scans, estimate_sizes=self.scan_budget_gb is not None)
+        report = preflight.analyze(scans, self.scan_budget_gb * 1024 ** 3 if self.scan_budget_gb is not None else None)
+        LOGGER.info('*****PREFLIGHT*****\n%s', json.dumps(report, sort_keys=True, indent=2))
+        self.metrics.properties["preflight_estimated_bytes"] = report["estimated_bytes"]
+        if report["problems"]:
+            message = f"Pre-flight check of {self.sql_query_path}: {'; '.join(report['problems'])}"
+            if self.preflight == "fail":
+                raise ValueError(message)
+            LOGGER.warning(message)
+
+    def _audit(self, paths: List[str]) -> int:
+        """Checks the written files against the audit rules using only their Parquet footers, returns the row count"""
+        from pyarrow import fs, parquet as pq
+
+        s3 = fs.S3FileSystem(endpoint_override=getattr(wr.config, "s3_endpoint_url", None))
+
+        def read_footer(path: str) -> Dict[str, Any]:
+            metadata = pq.read_metadata(path[len("s3://"):], filesystem=s3)
+            nulls: Dict[str, Optional[int]] = {}
+            for i in range(metadata.num_row_groups):
+                row_group = metadata.row_group(i)
+                for j in range(row_group.num_columns):
+                    column = row_group.column(j)
+                    stats = column.statistics
+                    count = stats.null_count if stats is not None and stats.has_null_count else None
+                    previous = nulls.get(column.path_in_schema, 0)
+                    nulls[column.path_in_schema] = None if previous is None or count is None else previous + count
+            return {"rows": metadata.num_rows, "nulls": nulls}
+
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            footers = list(pool.map(read_footer, paths))
+        rows = sum(footer["rows"] for footer in footers)
+        failures = []
+        if rows < self.audit.get("min_rows", 0):
+            failures.append(f"{rows} rows, expected at least {self.audit['min_rows']}")
+        if "max_rows" in self.audit and rows > self.audit["max_rows"]:
+            failures.append(f"{rows} rows, expected at most {self.audit['max_rows']}")
+        for col in self.audit.get("not_null", []):
+            if col in self.partition_cols:
+                continue
+            counts = [footer["nulls"].get(col) for footer in footers]
+            if any(count is None for count in counts):
+                LOGGER.warning(f"Null counts of [{col}] are missing from some footers, not audited")
+            elif sum(counts):
+                failures.append(f"{sum(counts)} nulls in [{col}]")
+        if failures:
+            raise ValueError(f"Audit of {self.output_path} failed, it was not published: {'; '.join(failures)}")
+        LOGGER.info(f"Audit of {self.output_path} passed: {rows} rows in {len(paths)} files")
+        return rows
+
+    def _replaced_location(self, location: str) -> Dict[str, List[str]]:
+        """What to delete once a location is no longer referenced. The dataset root also holds the version prefixes,
+        so its files are listed now instead of deleting the whole prefix later"""
+        location = location.rstrip("/") + "/"
+        if location == f"{self.s3_dataset_output}/":
+            files = [path for path in wr.s3.list_objects(path=location) if not path[len(location):].startswith("v_")]
+            return {"paths": files, "prefixes": []}
+        return {"paths": [], "prefixes": [location]}
+
+    def _swap_locations(self, partitions_values: Dict[str, List[str]]) -> Dict[str, List[str]]:
+        """Points the table, or each written partition, at this run's version. Returns what was replaced"""
+        glue = boto3.client('glue')
+        replaced = {"paths": [], "prefixes": []}
+        if not self.partition_cols:
+            try:
+                old_location = glue.get_table(DatabaseName=self.target_database, Name=self.target_table)['Table']['StorageDescriptor']['Location']
+            except glue.exceptions.EntityNotFoundException:
+                old_location = None
+            # a single UpdateTable switches the location and columns together
+            wr.catalog.create_parquet_table(
+                database=self.target_database,
+                table=self.target_table,
+                path=f"{self.output_path}/",
+                columns_types=self._columns_types,
+                compression=self._layout["compression"],
+                description=self.table_description,
+                mode="update"
+            )
+            return self._replaced_location(old_location) if old_location else replaced
+
+        wr.catalog.create_parquet_table(
+            database=self.target_database,
+            table=self.target_table,
+            path=f"{self.s3_dataset_output}/",
+            columns_types=self._columns_types,
+            partitions_types=self._partitions_types,
+            compression=self._layout["compression"],
+            description=self.table_description,
+            mode="append" if self.dtypes else "update"
+        )
+        existing = {}
+        paginator = glue.get_paginator('get_partitions')
+        for page in paginator.paginate(DatabaseName=self.target_database, TableName=self.target_table):
+            for partition in page['Partitions']:
+                existing[tuple(partition['Values'])] = partition
+
+        updates, new_partitions = [], {}
+        columns = [{"Name": col, "Type": col_type} for col, col_type in self._columns_types.items()]
+        for location, values in partitions_values.items():
+            partition = existing.get(tuple(values))
+            if partition is None:
+                new_partitions[location] = values
+                continue
+            for key, paths in self._replaced_location(partition['StorageDescriptor']['Location']).items():
+                replaced[key].extend(paths)
+            storage = {**partition['StorageDescriptor'], 'Location': location, 'Columns': columns}
+            updates.append({
+                'PartitionValueList': values,
+                'PartitionInput': {'Values': values, 'StorageDescriptor': storage, 'Parameters': partition.get('Parameters', {})}
+            })
+        # each partition switches atomically, glue takes up to 100 partition updates per call
+        for i in range(0, len(updates), 100):
+            response = glue.batch_update_partition(
+                DatabaseName=self.target_database, TableName=self.target_table, Entries=updates[i:i + 100]
+            )
+            if response.get('Errors'):
+                raise RuntimeError(f"Partition updates failed: {response['Errors']}")
+        if new_partitions:
+            wr.catalog.add_parquet_partitions(
+                database=self.target_database,
+                table=self.target_table,
+                partitions_values=new_partitions,
+                compression=self._layout["compression"],
+                columns_types=self._columns_types
+            )
+        LOGGER.info(f"Published {self.version}: {len(updates)} partitions switched, {len(new_partitions)} added")
+        return replaced
+
+    def _expire_versions(self):
+        """Deletes replaced versions whose retention has passed, runs in the background of the next run"""
+        try:
+            state = self.state_store.get(self._state_key("versions")) or {"pending": []}
+            now = datetime.now(timezone.utc)
+            keep = []
+            for entry in state["pending"]:
+                if datetime.fromisoformat(entry["expire_after"]) > now:
+                    keep.append(entry)
+                    continue
+                LOGGER.info(f"Deleting files replaced by {entry['version']}")
+                if entry["paths"]:
+                    wr.s3.delete_objects(path=entry["paths"])
+                for prefix in entry["prefixes"]:
+                    wr.s3.delete_objects(path=prefix)
+            state["pending"] = keep
+            self.state_store.put(self._state_key("versions"), state)
+        except Exception as exc:
+            LOGGER.warning(f"Could not expire replaced versions: {exc}")
+
+    def _schedule_expiry(self, replaced: Dict[str, List[str]]):
+        if not replaced["paths"] and not replaced["prefixes"]:
+            return
+        state = self.state_store.get(self._state_key("versions")) or {"pending": []}
+        state["pending"].append({
+            "version": self.version,
+            "expire_after": (datetime.now(timezone.utc) + timedelta(hours=self.version_retention_hours)).isoformat(),
+            **replaced
+        })
+        self.state_store.put(self._state_key("versions"), state)
+
+    def _publish(self, write_result: Dict[str, Any]):
+        """Audits this run's version and switches the catalog to it"""
+        with self.metrics.stage("audit") as stats:
+            try:
+                stats["rows"] += self._audit(write_result["paths"])
+            except ValueError:
+                # nothing references the rejected version, it expires like a replaced one
+                self._schedule_expiry({"paths": [], "prefixes": [f"{self.output_path}/"]})
+                raise
+        with self.metrics.stage("publish"):
+            replaced = self._swap_locations(write_result["partitions_values"])
+        self._schedule_expiry(replaced)
+
+    def process_query(self, raise_errors: bool = False) -> Optional[str]:
+        # writers, partition registration, audits and version expiry run in threads
+        load_lazy_modules()
+        self.metrics = self._new_metrics()
+        self._new_version()
+        self._writers = []
+        self._run_id = uuid.uuid4().hex
+        status = "failed"
+        expiry = None
+        self._save_run_stats("running")
         try:
             LOGGER.info(f"Materialize Athena Query request with arguments:\n"
             f"\tSQL_QUERY_PATH ::: {self.sql_query_path}\n"
@@ -70,57 +1488,135 @@ class MaterializeAthenaQuery:
             f"\tSTG_ATHENA_BUCKET ::: {self.stg_athena_bucket}\n"
             f"\tPARTITION_COLS ::: {str(self.partition_cols)}\n"
             f"\tQUERY_PARAMS ::: {str(self.query_params)}\n"
+            f"\tENGINE ::: {self.engine}\n"
+            f"\tDTYPES ::: {str(self.dtypes)}\n"
+            f"\tPUBLISH_MODE ::: {self.publish_mode}\n"
+            f"\tSHARD ::: {self.shard_index + 1} of {self.shard_count}\n"
             f"\tSAVEMODE ::: {self.savemode}" )
 
-            sql_query = get_query(self.sql_query_path,self.query_params)
+            query_params = self.query_params
+            if self.watermark_column:
+                if self.savemode == "append" and "watermark_op" not in get_query_variables(self.sql_query_path):
+                    raise ValueError(f"{self.sql_query_path} appends an incremental slice, it has to compare with {{{{ watermark_op }}}} "
+                                     "so the rows at the watermark aren't appended again")
+                watermark_op = ">" if self.savemode == "append" else ">="
+                query_params = {**query_params, "watermark": self._get_watermark(), "watermark_op": watermark_op}
+            if self.sharding or self.shard_count > 1:
+                shard_params = get_shard_params(self.sharding, self.shard_index, self.shard_count, self.engine)
+                query_params = {**query_params, **shard_params}
+            with self.metrics.stage("render"):
+                sql_query = get_query(self.sql_query_path,query_params)
+            if self.shard_count > 1 and shard_params["shard_filter"] not in sql_query:
+                raise ValueError(f"{self.sql_query_path} doesn't use {{{{ shard_filter }}}}, every shard would write the whole result")
+
+            if self.use_cache:
+                with self.metrics.stage("cache_check"):
+                    cache_key = self._get_cache_key(sql_query)
+                    cached = self.state_store.get(self._state_key("cache"))
+                if cached and cached["cache_key"] == cache_key and not self.force_refresh:
+                    LOGGER.info(f"*****CACHE HIT*****\n\tquery and sources unchanged since {cached['completed_at']}, skipping")
+                    status = "cached"
+                    return
 
-            wr.config.botocore_config = botocore.config.Config(
+            from botocore.config import Config
+            wr.config.botocore_config = Config(
                 retries={"max_attempts": 5},
                 connect_timeout=10,
                 max_pool_connections=10,
                 read_timeout=900 # 15 mins read timeout
             )
 
-            # run query and return as dataframe
-            df = wr.athena.read_sql_query(
-                sql=sql_query,
-                database=self.target_database, 
-                ctas_approach=False, # see different approaches here https://aws-data-wrangler.readthedocs.io/en/stable/stubs/awswrangler.athena.read_sql_query.html
-                s3_output=f"s3://{self.stg_athena_bucket}/{self.target_table}"
-            )
-
-            LOGGER.info(
-                '*****Query Stats*****\n%s',
-                json.dumps(df.query_metadata["Statistics"], sort_keys=True, indent=2),
-            )
+            if self.preflight:
+                with self.metrics.stage("preflight"):
+                    self._preflight(sql_query)
 
-            s3_dataset_output = f"s3://{self.target_bucket}/{self.target_database}/{self.target_table}"
-            LOGGER.info(f'*****OUTPUT S3 TARGET*****\n\t {s3_dataset_output}')
+            self._start_checkpoint(sql_query)
+            stages = self._checkpoint["stages"]
+            self._writers = self._target_writers()
+            LOGGER.info(f'*****OUTPUT S3 TARGET*****\n\t {self.output_path}')
+            # every shard but the one that publishes the version only writes its files, see _collect_shards
+            published = True
+            if "committed" in stages:
+                published = stages["committed"].get("published", True)
+                LOGGER.info("Output was committed by an earlier attempt, finishing the run")
+            else:
+                if self.publish_mode == "versioned" and self.shard_count == 1:
+                    expiry = threading.Thread(target=self._expire_versions, daemon=True)
+                    expiry.start()
+                if self.shard_count > 1 and "written" not in stages:
+                    # a shard's files are only known once it's written them all, a retry writes them again
+                    for stage in [stage for stage in stages if stage.startswith("chunks")]:
+                        stages.pop(stage)
+                    for writer in [self] + self._writers:
+                        writer._clear_shard_files()
 
-            # write the dataframe to the destination
-            write_result = wr.s3.to_parquet(
-                df=df,
-                path=s3_dataset_output,
-                dataset=True,
-                database=self.target_database,
-                table=self.target_table,
-                mode=self.savemode,
-                partition_cols=self.partition_cols,
-                schema_evolution=True,
-                index=False,
-                description=self.table_description
-                # dtype=self.dtypes
-            )
-            LOGGER.info(
-                '*****RESULT*****\n%s',
-                json.dumps(write_result, sort_keys=True, indent=2),
-            )
+                if "written" in stages:
+                    write_result = stages["written"]["write_result"]
+                    self._restore_types(stages["written"]["types"])
+                    for writer, written in zip(self._writers, stages["written"]["targets"]):
+                        writer._target_result = written["write_result"]
+                        writer._restore_types(written["types"])
+                    LOGGER.info("Output was written by an earlier attempt, reusing its files")
+                else:
+                    if self.engine == "unload":
+                        write_result = self._unload(sql_query)
+                    elif self.engine == "duckdb":
+                        write_result = self._run_local(sql_query)
+                    else:
+                        write_result = self._read_and_write(sql_query)
+                    self._save_checkpoint("written", write_result=write_result, types=self._written_types(), targets=[
+                        {"write_result": writer._target_result, "types": writer._written_types()} for writer in self._writers
+                    ])
+                LOGGER.info(
+                    '*****RESULT*****\n%s',
+                    json.dumps(write_result, sort_keys=True, indent=2),
+                )
+                if self.shard_count > 1:
+                    write_result = self._collect_shards(write_result)
+                    published = write_result is not None
+                    if published:
+                        self._expire_versions()
+                if self.publish_mode == "versioned":
+                    if self.shard_count == 1:
+                        # expiry shares the versions state with publishing
+                        expiry.join()
+                    if published:
+                        self._publish(write_result)
+                        for writer in self._writers:
+                            writer._expire_versions()
+                            writer._publish(writer._target_result)
+                elif self.engine != "unload":
+                    for writer, result in [(self, write_result)] + [(writer, writer._target_result) for writer in self._writers]:
+                        if writer.partition_cols:
+                            writer._commit_catalog(result)
+                self._save_checkpoint("committed", published=published)
+                if self.shard_count > 1 and published:
+                    self._clear_shards()
+            if self.watermark_column and published:
+                with self.metrics.stage("watermark"):
+                    self._save_watermark()
+            if self.use_cache:
+                self.state_store.put(self._state_key("cache"), {
+                    "cache_key": cache_key,
+                    "completed_at": datetime.now(timezone.utc).isoformat()
+                })
+            self._clear_checkpoint()
+            status = "succeeded"
         except Exception as exc:
             LOGGER.exception(exc)
+            if raise_errors:
+                raise
+        finally:
+            # targets report their writes under their own table
+            for writer in [self] + self._writers:
+                writer.metrics.properties["status"] = status
+                writer.metrics.emit()
+            self._save_run_stats(status)
 
 def main(argv):
-    if len(argv)!=7:
-        LOGGER.info("Syntax: python run_athena_query.py <<sql_query_path>> <<target_bucket>> <<target_database>> <<target_table>> <<target_description>> <<stg_athena_bucket>>")
+    if len(argv) not in (7, 8):
+        LOGGER.info("Syntax: python run_athena_query.py <<sql_query_path>> <<target_bucket>> <<target_database>> <<target_table>> <<target_description>> <<stg_athena_bucket>> [<<job_options_json>>]")
+        sys.exit(2)
     
     LOGGER.info(f"Received {len(argv)} arguments:\n"
         f"\tSQL Query Path ::: {argv[1]}\n"
@@ -128,22 +1624,32 @@ def main(argv):
         f"\tTarget Database ::: {argv[3]}\n"
         f"\tTarget Table ::: {argv[4]}\n"
         f"\tTarget Description ::: {argv[5]}\n"
-        f"\tSTG/tmp Athena Results bucket ::: {argv[6]}" )
+        f"\tSTG/tmp Athena Results bucket ::: {argv[6]}\n"
+        f"\tJob Options ::: {argv[7] if len(argv) == 8 else '{}'}" )
+    # optional json object with any other MaterializeAthenaQuery arguments, eg '{"chunksize": 500000}'
+    job_options = json.loads(argv[7]) if len(argv) == 8 else {}
+    if "AWS_BATCH_JOB_ARRAY_INDEX" in os.environ:
+        # a child of an array job materializes one shard, children's job ids are <array job id>:<index>
+        job_options = {
+            "shard_index": int(os.environ["AWS_BATCH_JOB_ARRAY_INDEX"]),
+            "shard_count": int(os.environ.get(SHARD_COUNT_ENV, 1)),
+            "shard_run_id": os.environ["AWS_BATCH_JOB_ID"].split(":")[0],
+            **job_options
+        }
     req = MaterializeAthenaQuery(sql_query_path=argv[1],
         target_bucket=argv[2],
         target_database=argv[3],
         target_table=argv[4],
         table_description=argv[5],
-        stg_athena_bucket=argv[6]
+        stg_athena_bucket=argv[6],
+        **job_options
     )
 
-    # req = MaterializeAthenaQuery(sql_query_path="some_project/sample-nyc-covid.sql",
-    # target_bucket="ryagomes-qs-source",
-    # target_database="processed_covid",
-    # target_table="nyc_covid_data",
-    # table_description="Processed covid data for NYC",
-    # stg_athena_bucket="ryagomes-covid-test")
-    req.process_query()
+    try:
+        req.process_query(raise_errors=True)
+    except Exception:
+        # already logged, a non-zero exit is what makes Batch retry the job
+        sys.exit(1)
 
 
 if __name__ == '__main__':
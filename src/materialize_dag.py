@@ -0,0 +1,146 @@
+"""Runs a manifest of MaterializeAthenaQuery jobs as a dependency graph in one container
+
+Independent jobs run concurrently up to max_concurrency (keep it within the account's Athena
+concurrent query limit) and a job starts as soon as every job it depends on has succeeded.
+Jobs downstream of a failure are skipped.
+
+Manifest format:
+{
+    "max_concurrency": 4,
+    "defaults": {"target_bucket": "...", "stg_athena_bucket": "..."},
+    "jobs": {
+        "<job name>": {
+            "sql_query_path": "some_project/some-sql-file.sql",
+            "target_database": "...",
+            "target_table": "...",
+            "table_description": "...",
+            "depends_on": ["<job name>"]
+        }
+    }
+}
+Each job takes any MaterializeAthenaQuery argument, with "defaults" applied to every job. When
+"depends_on" is left out it's inferred: a job depends on the jobs whose target tables its query reads.
+"""
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from typing import Dict, List, Set
+import json
+import os
+import sys
+
+from materialize_athena_query import LOGGER, SQL_SCRIPTS_PATH, MaterializeAthenaQuery, load_lazy_modules, get_source_tables, render_query
+
+
+@dataclass
+class MaterializeDag:
+    """MaterializeDag runs MaterializeAthenaQuery jobs in dependency order
+    Args:
+        jobs (Dict[str, MaterializeAthenaQuery]): jobs by name
+        depends_on (Dict[str, List[str]], optional): names of the jobs each job waits for, inferred when a job is missing
+        max_concurrency (int, optional): max number of jobs (and so Athena queries) running at once
+    """
+    jobs: Dict[str, MaterializeAthenaQuery]
+    depends_on: Dict[str, List[str]] = field(default_factory=dict)
+    max_concurrency: int = 4
+
+    def __post_init__(self):
+        targets = {f"{job.target_database}.{job.target_table}": name for name, job in self.jobs.items()}
+        for name, job in self.jobs.items():
+            if name not in self.depends_on:
+                self.depends_on[name] = self._infer_dependencies(name, job, targets)
+            unknown = set(self.depends_on[name]) - set(self.jobs)
+            if unknown:
+                raise ValueError(f"Job [{name}] depends on unknown jobs {sorted(unknown)}")
+        self._check_acyclic()
+        LOGGER.info(f"*****JOB GRAPH*****\n{json.dumps(self.depends_on, sort_keys=True, indent=2)}")
+
+    @classmethod
+    def from_manifest(cls, manifest_path: str) -> "MaterializeDag":
+        if not os.path.isabs(manifest_path):
+            manifest_path = os.path.join(SQL_SCRIPTS_PATH, manifest_path)
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+        jobs, depends_on = {}, {}
+        for name, spec in manifest["jobs"].items():
+            spec = {**manifest.get("defaults", {}), **spec}
+            if "depends_on" in spec:
+                depends_on[name] = spec.pop("depends_on")
+            jobs[name] = MaterializeAthenaQuery(**spec)
+        return cls(jobs=jobs, depends_on=depends_on, max_concurrency=manifest.get("max_concurrency", 4))
+
+    @staticmethod
+    def _infer_dependencies(name: str, job: MaterializeAthenaQuery, targets: Dict[str, str]) -> List[str]:
+        from jinja2 import UndefinedError
+
+        # params set at run time (watermark, shard and backfill params) render empty rather than as a made up value,
+        # which could turn a literal or a table name into different SQL
+        try:
+            query = render_query(job.sql_query_path, job.query_params, strict=False)
+        except UndefinedError as e:
+            raise ValueError(f"Job [{name}] query can't be rendered without its run time params ({e}), set its depends_on") from e
+        sources = get_source_tables(query, job.target_database)
+        return [targets[table] for table in sources if table in targets and targets[table] != name]
+
+    def _check_acyclic(self):
+        visiting, visited = set(), set()
+
+        def visit(name: str, path: List[str]):
+            if name in visiting:
+                raise ValueError(f"Job dependencies have a cycle: {' -> '.join(path + [name])}")
+            if name in visited:
+                return
+            visiting.add(name)
+            for dep in self.depends_on[name]:
+                visit(dep, path + [name])
+            visiting.remove(name)
+            visited.add(name)
+
+        for name in self.jobs:
+            visit(name, [])
+
+    def run(self) -> Dict[str, str]:
+        """Runs every job, returns the final status of each one: succeeded, failed or skipped"""
+        status: Dict[str, str] = {}
+        pending: Set[str] = set(self.jobs)
+        running: Dict[Future, str] = {}
+
+        # jobs first touch awswrangler and boto3 in the pool's threads
+        load_lazy_modules()
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            while pending or running:
+                for name in sorted(pending):
+                    deps = self.depends_on[name]
+                    if any(status.get(dep) in ("failed", "skipped") for dep in deps):
+                        LOGGER.warning(f"Skipping [{name}], an upstream job did not succeed")
+                        status[name] = "skipped"
+                        pending.remove(name)
+                    elif all(status.get(dep) == "succeeded" for dep in deps):
+                        LOGGER.info(f"Starting [{name}]")
+                        running[pool.submit(self.jobs[name].process_query, raise_errors=True)] = name
+                        pending.remove(name)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    status[name] = "failed" if future.exception() else "succeeded"
+                    LOGGER.info(f"Finished [{name}] ::: {status[name]}")
+
+        LOGGER.info(f"*****DAG RESULT*****\n{json.dumps(status, sort_keys=True, indent=2)}")
+        return status
+
+
+def main(argv):
+    if len(argv) not in (2, 3):
+        LOGGER.info("Syntax: python materialize_dag.py <<manifest_path>> [<<max_concurrency>>]")
+        sys.exit(2)
+    dag = MaterializeDag.from_manifest(argv[1])
+    if len(argv) == 3:
+        dag.max_concurrency = int(argv[2])
+    status = dag.run()
+    if any(s != "succeeded" for s in status.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
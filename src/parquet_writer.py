@@ -0,0 +1,191 @@
+"""Parallel Parquet dataset writer with control over file and row group sizes
+
+wr.s3.to_parquet writes each partition of a frame one after another, with one file per partition and
+pyarrow's default row groups. ParquetWriter splits every partition into files of about target_file_mb,
+encodes and uploads them concurrently, then registers the table and partitions in Glue in one go. The
+dataset layout and catalog entries are the same as wr.s3.to_parquet's, so tables can switch between them.
+
+Rows can also be sorted by the columns downstream queries filter on before they're split into files and row
+groups. Each row group then holds a narrow range of those columns, so the min/max statistics in the footer
+let Athena skip most row groups of a filtered query instead of reading every one.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Any, List, Optional, Tuple
+import io
+import logging
+import re
+import uuid
+
+import awswrangler as wr
+import boto3
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+LOGGER = logging.getLogger()
+
+# arrow types for declared column types, undeclared columns keep the type pyarrow infers from the frame
+ATHENA_TO_PYARROW_TYPES = {
+    "string": pa.string(), "varchar": pa.string(), "char": pa.string(),
+    "tinyint": pa.int8(), "smallint": pa.int16(), "int": pa.int32(), "integer": pa.int32(), "bigint": pa.int64(),
+    "float": pa.float32(), "real": pa.float32(), "double": pa.float64(), "boolean": pa.bool_(),
+    "date": pa.date32(), "timestamp": pa.timestamp("ns"),
+}
+DECIMAL_PATTERN = re.compile(r"decimal\((\d+),\s*(\d+)\)")
+# rows encoded to estimate the compressed size of a row
+SAMPLE_ROWS = 10000
+
+
+def athena_to_pyarrow_type(athena_type: str) -> pa.DataType:
+    decimal = DECIMAL_PATTERN.fullmatch(athena_type)
+    if decimal:
+        return pa.decimal128(int(decimal.group(1)), int(decimal.group(2)))
+    return ATHENA_TO_PYARROW_TYPES[athena_type]
+
+
+@dataclass
+class ParquetWriter:
+    """ParquetWriter writes a frame to a Glue registered Parquet dataset
+    Args:
+        path (str): s3 prefix of the dataset
+        database (str): glue db of the table, None only writes the files
+        table (str): table to register the dataset as
+        partition_cols (List[str], optional): columns to partition the dataset by
+        description (str, optional): table description
+        dtype (Dict[str, str], optional): catalog types of columns, others are inferred from the frame
+        schema_evolution (bool, optional): update the table's columns from the frame when the table already exists
+        target_file_mb (int, optional): files are split to about this size, estimated from an encoded sample of rows
+        row_group_rows (int, optional): rows per row group, defaults to pyarrow's (the whole file up to 1M rows)
+        compression (str, optional): parquet codec, eg snappy, gzip or zstd
+        sort_by (List[str], optional): columns rows are sorted by within each partition, eg ["reporting_date", "fips"]
+        dictionary_columns (List[str], optional): the only columns dictionary encoded, defaults to all of them. Low
+            cardinality columns shrink the most, high cardinality ones (ids, measures) are often smaller without it
+        max_workers (int, optional): files encoded and uploaded at once
+        filename_prefix (str, optional): prefix of the written file names, like wr.s3.to_parquet's
+    """
+    path: str
+    database: Optional[str]
+    table: str
+    partition_cols: List[str] = field(default_factory=list)
+    description: Optional[str] = None
+    dtype: Dict[str, str] = field(default_factory=dict)
+    schema_evolution: bool = True
+    target_file_mb: int = 128
+    row_group_rows: Optional[int] = None
+    compression: str = "snappy"
+    sort_by: List[str] = field(default_factory=list)
+    dictionary_columns: Optional[List[str]] = None
+    max_workers: int = 8
+    filename_prefix: str = ""
+
+    def __post_init__(self):
+        self.path = self.path.rstrip("/") + "/"
+        # one client shared by the upload threads, follows awswrangler's endpoint for local stand-ins
+        self.s3 = boto3.client("s3", endpoint_url=getattr(wr.config, "s3_endpoint_url", None))
+
+    def _encode(self, table: pa.Table) -> bytes:
+        buffer = io.BytesIO()
+        pq.write_table(
+            table,
+            buffer,
+            row_group_size=self.row_group_rows,
+            compression=self.compression,
+            use_dictionary=self.dictionary_columns if self.dictionary_columns is not None else True,
+            write_statistics=True,
+            # athena reads timestamps as millis, not the nanos pandas holds them in
+            coerce_timestamps="ms",
+            allow_truncated_timestamps=True
+        )
+        return buffer.getvalue()
+
+    def _rows_per_file(self, sample: pa.Table) -> int:
+        bytes_per_row = len(self._encode(sample)) / max(sample.num_rows, 1)
+        return max(1, int(self.target_file_mb * 1024 ** 2 / bytes_per_row))
+
+    def _write_partition(self, rows: pd.DataFrame, prefix: str, schema: pa.Schema, rows_per_file: int, file_id: str) -> List[str]:
+        sort_by = [col for col in self.sort_by if col in rows.columns]
+        if sort_by:
+            rows = rows.sort_values(sort_by, kind="stable")
+        table = pa.Table.from_pandas(rows, schema=schema, preserve_index=False)
+        bucket, key_prefix = prefix[len("s3://"):].split("/", 1)
+        paths = []
+        for offset in range(0, max(table.num_rows, 1), rows_per_file):
+            key = f"{key_prefix}{self.filename_prefix}{file_id}_{offset // rows_per_file:05d}.{self.compression}.parquet"
+            self.s3.put_object(Bucket=bucket, Key=key, Body=self._encode(table.slice(offset, rows_per_file)))
+            paths.append(f"s3://{bucket}/{key}")
+        return paths
+
+    def _split(self, df: pd.DataFrame) -> List[Tuple[str, List[str], pd.DataFrame]]:
+        """Splits the frame into (prefix, partition values, rows) for each partition"""
+        if not self.partition_cols:
+            return [(self.path, [], df)]
+        partitions = []
+        for keys, rows in df.groupby(self.partition_cols, observed=True, sort=False):
+            values = [str(key) for key in (keys if isinstance(keys, tuple) else (keys,))]
+            prefix = self.path + "/".join(f"{col}={value}" for col, value in zip(self.partition_cols, values)) + "/"
+            partitions.append((prefix, values, rows.drop(columns=self.partition_cols)))
+        return partitions
+
+    def write(self, df: pd.DataFrame, mode: str) -> Dict[str, Any]:
+        """Writes the frame with "overwrite", "overwrite_partitions" or "append", like wr.s3.to_parquet.
+        Returns the written paths and partition values in the same shape as wr.s3.to_parquet"""
+        if df.empty:
+            raise wr.exceptions.EmptyDataFrame("DataFrame cannot be empty.")
+        missing = set(self.sort_by + (self.dictionary_columns or [])) - set(df.columns)
+        if missing:
+            raise ValueError(f"sort_by and dictionary_columns have columns that aren't in the frame: {sorted(missing)}")
+        columns_types, partitions_types = wr.catalog.extract_athena_types(
+            df=df, index=False, partition_cols=self.partition_cols, dtype=self.dtype
+        )
+        # one schema for the whole frame so every file has the same column types, whatever rows it got
+        schema = pa.Schema.from_pandas(df.drop(columns=self.partition_cols), preserve_index=False).remove_metadata()
+        for col, col_type in self.dtype.items():
+            if col in columns_types:
+                schema = schema.set(schema.get_field_index(col), pa.field(col, athena_to_pyarrow_type(col_type)))
+
+        if mode == "overwrite_partitions" and not self.partition_cols:
+            # like awswrangler, overwriting the partitions of an unpartitioned dataset overwrites all of it
+            mode = "overwrite"
+        partitions = self._split(df)
+        if mode == "overwrite":
+            wr.s3.delete_objects(path=self.path)
+        elif mode == "overwrite_partitions":
+            # one listing of the dataset instead of one per partition
+            prefixes = tuple(prefix for prefix, _, _ in partitions)
+            wr.s3.delete_objects(path=[path for path in wr.s3.list_objects(path=self.path) if path.startswith(prefixes)])
+
+        sample = pa.Table.from_pandas(df.drop(columns=self.partition_cols).head(SAMPLE_ROWS), schema=schema, preserve_index=False)
+        rows_per_file = self._rows_per_file(sample)
+        file_id = uuid.uuid4().hex
+        # pyarrow releases the GIL while converting and encoding, so threads overlap encoding with uploads
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [
+                pool.submit(self._write_partition, rows, prefix, schema, rows_per_file, file_id)
+                for prefix, _, rows in partitions
+            ]
+            paths = [path for future in futures for path in future.result()]
+        LOGGER.info(f"Wrote {len(paths)} files of up to {rows_per_file} rows to {len(partitions)} partition(s) of {self.path}")
+
+        partitions_values = {prefix: values for prefix, values, _ in partitions if self.partition_cols}
+        if self.database is None:
+            return {"paths": paths, "partitions_values": partitions_values}
+        wr.catalog.create_parquet_table(
+            database=self.database,
+            table=self.table,
+            path=self.path,
+            columns_types=columns_types,
+            partitions_types=partitions_types,
+            compression=self.compression,
+            description=self.description,
+            mode="overwrite" if mode == "overwrite" else "update" if self.schema_evolution else "append"
+        )
+        if partitions_values:
+            # registered in batches of 100, the most a glue BatchCreatePartition call takes
+            wr.catalog.add_parquet_partitions(
+                database=self.database,
+                table=self.table,
+                partitions_values=partitions_values,
+                compression=self.compression
+            )
+        return {"paths": paths, "partitions_values": partitions_values}
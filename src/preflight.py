@@ -0,0 +1,194 @@
+"""Pre-flight checks of a rendered query before it runs
+
+Athena's `EXPLAIN (TYPE IO, FORMAT JSON)` lists every table a query reads with the column constraints
+pushed down into its scan, without scanning anything. A partitioned source table with no constraint on
+any of its partition keys is read in full, eg a date filter applied outside a windowed subquery. The
+scan is estimated from the plan, or when Athena has no statistics (the usual case for Glue tables)
+from the S3 size of the table's partitions that match the constraints.
+
+The analysis itself is pure, so recorded plans can be checked offline:
+
+    python3 preflight.py preflight_fixtures/sample-nyc-covid.json
+"""
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from typing import Dict, Any, List, Optional
+from urllib.parse import urlparse
+import json
+import math
+import sys
+
+from materialize_athena_query import LOGGER
+
+NUMERIC_TYPES = ("tinyint", "smallint", "integer", "bigint", "real", "double", "decimal")
+
+
+@dataclass
+class TableScan:
+    """A table read by a query
+    Args:
+        table (str): "database.table"
+        constraints (Dict[str, Dict]): pushed down domain of each constrained column, as in the IO plan
+        estimated_bytes (float, optional): Athena's estimate of the bytes read, None when it has no statistics
+        partition_keys (List[str]): the table's partition keys, from Glue
+    """
+    table: str
+    constraints: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    estimated_bytes: Optional[float] = None
+    partition_keys: List[str] = field(default_factory=list)
+
+    @property
+    def pruned(self) -> bool:
+        """Whether the scan is limited to some partitions, unpartitioned tables are never pruned"""
+        return any(key in self.constraints for key in self.partition_keys)
+
+
+def parse_io_plan(plan: Dict[str, Any]) -> List[TableScan]:
+    """Reads the tables of an IO plan, both the Athena engine v2 (columnConstraints) and v3 (constraint) shapes"""
+    scans = []
+    for info in plan.get("inputTableColumnInfos", []):
+        schema_table = info["table"]["schemaTable"]
+        constraint = info.get("constraint", {})
+        column_constraints = constraint.get("columnConstraints", info.get("columnConstraints", []))
+        estimate = info.get("estimate", {}).get("outputSizeInBytes")
+        try:
+            estimated_bytes = float(estimate) if estimate is not None else None
+        except ValueError:
+            estimated_bytes = None
+        scans.append(TableScan(
+            table=f"{schema_table['schema']}.{schema_table['table']}",
+            constraints={
+                column["columnName"]: {**column["domain"], "type": column.get("type", column.get("typeSignature", ""))}
+                for column in column_constraints
+            },
+            estimated_bytes=None if estimated_bytes is None or math.isnan(estimated_bytes) else estimated_bytes
+        ))
+    return scans
+
+
+def _parse_value(value: str, col_type: str) -> Any:
+    """A partition value or a domain bound as the column's type, so '2021-05-31' and the timestamp bound
+    '2021-05-31 00:00:00.000' compare as the same instant rather than as strings"""
+    if col_type.startswith(NUMERIC_TYPES):
+        return float(value)
+    if col_type.startswith("timestamp"):
+        # drops the zone of a timestamp with time zone, eg 2021-05-31 00:00:00.000 UTC
+        return datetime.fromisoformat(" ".join(value.split()[:2]))
+    if col_type.startswith("date"):
+        return date.fromisoformat(value.strip()[:10])
+    return value
+
+
+def _compare(value: str, bound: str, col_type: str) -> int:
+    a, b = _parse_value(value, col_type), _parse_value(bound, col_type)
+    return (a > b) - (a < b)
+
+
+def value_in_domain(value: Optional[str], domain: Dict[str, Any]) -> bool:
+    """Whether a partition value satisfies a pushed down column domain"""
+    if value is None or value == "__HIVE_DEFAULT_PARTITION__":
+        return domain.get("nullsAllowed", False)
+    col_type = domain.get("type", "")
+    for value_range in domain.get("ranges", []):
+        low, high = value_range["low"], value_range["high"]
+        if "value" in low:
+            cmp = _compare(value, low["value"], col_type)
+            if cmp < 0 or (cmp == 0 and low["bound"] == "ABOVE"):
+                continue
+        if "value" in high:
+            cmp = _compare(value, high["value"], col_type)
+            if cmp > 0 or (cmp == 0 and high["bound"] == "BELOW"):
+                continue
+        return True
+    return False
+
+
+def matching_partitions(scan: TableScan, partitions: Dict[str, List[str]]) -> Dict[str, List[str]]:
+    """Filters {location: values} partitions down to the ones the scan's constraints can read"""
+    return {
+        location: values for location, values in partitions.items()
+        if all(
+            value_in_domain(value, scan.constraints[key])
+            for key, value in zip(scan.partition_keys, values) if key in scan.constraints
+        )
+    }
+
+
+def analyze(scans: List[TableScan], scan_budget_bytes: Optional[float] = None) -> Dict[str, Any]:
+    """Reports unpruned partitioned tables and whether the estimated scan fits the budget"""
+    estimates = [scan.estimated_bytes for scan in scans]
+    estimated_bytes = sum(estimates) if all(estimate is not None for estimate in estimates) else None
+    problems = [
+        f"{scan.table} is partitioned by {scan.partition_keys} but the query doesn't constrain any of them, every partition is read"
+        for scan in scans if scan.partition_keys and not scan.pruned
+    ]
+    if scan_budget_bytes is not None and estimated_bytes is not None and estimated_bytes > scan_budget_bytes:
+        problems.append(f"estimated scan of {estimated_bytes / 1024 ** 3:.3g} GB is over the budget of {scan_budget_bytes / 1024 ** 3:.3g} GB")
+    return {
+        "tables": [{
+            "table": scan.table,
+            "partition_keys": scan.partition_keys,
+            "constrained_columns": sorted(scan.constraints),
+            "pruned": scan.pruned,
+            "estimated_bytes": scan.estimated_bytes,
+        } for scan in scans],
+        "estimated_bytes": estimated_bytes,
+        "scan_budget_bytes": scan_budget_bytes,
+        "problems": problems,
+    }
+
+
+def prefix_size(location: str) -> int:
+    """Total size of the objects under an S3 prefix"""
+    import boto3
+
+    loc = urlparse(location)
+    paginator = boto3.client('s3').get_paginator('list_objects_v2')
+    return sum(
+        obj['Size']
+        for page in paginator.paginate(Bucket=loc.netloc, Prefix=loc.path.lstrip("/").rstrip("/") + "/")
+        for obj in page.get('Contents', [])
+    )
+
+
+def add_catalog_metadata(scans: List[TableScan], estimate_sizes: bool = False):
+    """Fills in each scan's partition keys from Glue and, when Athena had no estimate, its size from the S3 size
+    of the partitions its constraints can read"""
+    import boto3
+    import awswrangler as wr
+
+    glue = boto3.client('glue')
+    for scan in scans:
+        database, table = scan.table.split(".", 1)
+        try:
+            glue_table = glue.get_table(DatabaseName=database, Name=table)['Table']
+        except glue.exceptions.EntityNotFoundException:
+            continue
+        scan.partition_keys = [key['Name'] for key in glue_table.get('PartitionKeys', [])]
+        if not estimate_sizes or scan.estimated_bytes is not None:
+            continue
+        # projected tables have no partitions in the catalog, the whole table is counted
+        if scan.partition_keys and glue_table.get('Parameters', {}).get('projection.enabled') != "true":
+            partitions = matching_partitions(scan, wr.catalog.get_partitions(database=database, table=table))
+            scan.estimated_bytes = float(sum(prefix_size(location) for location in partitions))
+        else:
+            scan.estimated_bytes = float(prefix_size(glue_table['StorageDescriptor']['Location']))
+
+
+def main(argv):
+    if len(argv) != 2:
+        LOGGER.info("Syntax: python preflight.py <<recorded_plan_json>>")
+        sys.exit(2)
+    # a recorded fixture: {"plan": <EXPLAIN (TYPE IO, FORMAT JSON) output>, "partition_keys": {"db.table": [...]}}
+    with open(argv[1]) as f:
+        fixture = json.load(f)
+    scans = parse_io_plan(fixture["plan"])
+    for scan in scans:
+        scan.partition_keys = fixture.get("partition_keys", {}).get(scan.table, [])
+    report = analyze(scans, fixture.get("scan_budget_bytes"))
+    print(json.dumps(report, sort_keys=True, indent=2))
+    sys.exit(1 if report["problems"] else 0)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,9 @@
+SELECT
+state,
+reporting_date,
+sum(new_cases) as new_cases,
+sum(new_deaths) as new_deaths
+
+FROM "covid-19"."covid_state_data"
+
+group by 1, 2
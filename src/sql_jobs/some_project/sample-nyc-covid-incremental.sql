@@ -0,0 +1,28 @@
+select *
+
+from
+(SELECT
+date_parse("date",'%Y-%m-%d') as reporting_date,
+fips,
+county,
+cases,
+try(cast(cases as int))-coalesce(try(cast(lag(cases,1) OVER(PARTITION BY fips ORDER BY date_parse("date",'%Y-%m-%d') asc) as int)),0) as new_cases,
+try(cast(deaths as int))-coalesce(try(cast(lag(deaths,1) OVER(PARTITION BY fips ORDER BY date_parse("date",'%Y-%m-%d') asc) as int)),0) as new_deaths,
+state
+
+FROM "covid-19"."nytimes_counties"
+
+where state in ('New York','New Jersey','Washington')
+{% if watermark %}
+-- read one extra day so lag() has the previous day for the first day of the slice. The filter is on the raw "date"
+-- column, a constant compared to date_parse("date",...) isn't pushed down to the scan and wouldn't prune partitions
+and "date" >= date_format(cast('{{ watermark }}' as timestamp) - interval '1' day, '%Y-%m-%d')
+{% endif %}
+
+order by 1 asc, 2
+)
+{% if watermark %}
+ where reporting_date {{ watermark_op }} cast('{{ watermark }}' as timestamp)
+{% else %}
+ where reporting_date >= date '2021-06-01'
+{% endif %}
@@ -0,0 +1,163 @@
+"""Pluggable key/value stores for small json job state such as watermarks and result cache entries"""
+import json
+import os
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Dict, Any, Optional
+from urllib.parse import urlparse, parse_qs
+
+
+class StateStore(ABC):
+    """Stores json documents by key, keys are '/' separated paths such as '<db>/<table>/watermark'"""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        pass
+
+    @abstractmethod
+    def put(self, key: str, value: Dict[str, Any]):
+        pass
+
+    @abstractmethod
+    def put_if_absent(self, key: str, value: Dict[str, Any]) -> bool:
+        """Stores the document only if the key doesn't exist yet, atomically. Returns whether it was stored"""
+
+    @abstractmethod
+    def delete(self, key: str):
+        pass
+
+
+@dataclass
+class LocalFileStateStore(StateStore):
+    """Stores each key as a json file under a local directory, handy for local runs and testing"""
+    root: str
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, value: Dict[str, Any]):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename so readers never see a partially written file
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(value, f, sort_keys=True, default=str)
+        os.replace(f"{path}.tmp", path)
+
+    def put_if_absent(self, key: str, value: Dict[str, Any]) -> bool:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            json.dump(value, f, sort_keys=True, default=str)
+        return True
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+@dataclass
+class S3StateStore(StateStore):
+    """Stores each key as a json object under an S3 prefix"""
+    bucket: str
+    prefix: str = ""
+
+    def __post_init__(self):
+        import boto3
+        self.client = boto3.client('s3')
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix.strip('/')}/{key}.json".lstrip("/")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            obj = self.client.get_object(Bucket=self.bucket, Key=self._key(key))
+        except self.client.exceptions.ClientError as exc:
+            if exc.response['Error']['Code'] == 'NoSuchKey':
+                return None
+            raise
+        return json.loads(obj['Body'].read())
+
+    def put(self, key: str, value: Dict[str, Any]):
+        self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=json.dumps(value, sort_keys=True, default=str))
+
+    def put_if_absent(self, key: str, value: Dict[str, Any]) -> bool:
+        # S3 conditional writes, the put fails with 412 when the object exists
+        try:
+            self.client.put_object(
+                Bucket=self.bucket, Key=self._key(key), Body=json.dumps(value, sort_keys=True, default=str), IfNoneMatch="*"
+            )
+        except self.client.exceptions.ClientError as exc:
+            if exc.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                return False
+            raise
+        return True
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+
+@dataclass
+class DynamoDBStateStore(StateStore):
+    """Stores each key as an item in a DynamoDB table with a string hash key named 'key'.
+    endpoint_url can point at DynamoDB Local to run without AWS."""
+    table_name: str
+    endpoint_url: Optional[str] = None
+
+    def __post_init__(self):
+        import boto3
+        self.client = boto3.client('dynamodb', endpoint_url=self.endpoint_url)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        item = self.client.get_item(TableName=self.table_name, Key={"key": {"S": key}}, ConsistentRead=True).get("Item")
+        return json.loads(item["value"]["S"]) if item else None
+
+    def put(self, key: str, value: Dict[str, Any]):
+        self.client.put_item(
+            TableName=self.table_name,
+            Item={"key": {"S": key}, "value": {"S": json.dumps(value, sort_keys=True, default=str)}}
+        )
+
+    def put_if_absent(self, key: str, value: Dict[str, Any]) -> bool:
+        try:
+            self.client.put_item(
+                TableName=self.table_name,
+                Item={"key": {"S": key}, "value": {"S": json.dumps(value, sort_keys=True, default=str)}},
+                ConditionExpression="attribute_not_exists(#k)",
+                ExpressionAttributeNames={"#k": "key"}
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def delete(self, key: str):
+        self.client.delete_item(TableName=self.table_name, Key={"key": {"S": key}})
+
+
+def get_state_store(uri: str) -> StateStore:
+    """Builds a state store from a uri:
+        file:///some/local/dir
+        s3://bucket/some/prefix
+        dynamodb://table_name (optionally ?endpoint_url=http://localhost:8000 for DynamoDB Local)
+    """
+    loc = urlparse(uri)
+    if loc.scheme == "file":
+        return LocalFileStateStore(root=loc.path)
+    if loc.scheme == "s3":
+        return S3StateStore(bucket=loc.netloc, prefix=loc.path)
+    if loc.scheme == "dynamodb":
+        endpoint_url = parse_qs(loc.query).get("endpoint_url", [None])[0]
+        return DynamoDBStateStore(table_name=loc.netloc, endpoint_url=endpoint_url)
+    raise ValueError(f"Unsupported state store uri [{uri}], expected file://, s3:// or dynamodb://")
@@ -0,0 +1,87 @@
+import os
+import socket
+import sys
+
+import pytest
+
+SRC_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, SRC_PATH)
+
+
+@pytest.fixture(scope="session")
+def moto_server():
+    """A local moto S3/Glue server, every boto3 and awswrangler client of the session points at it"""
+    import logging
+    server_module = pytest.importorskip("moto.server")
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = server_module.ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+    server.start()
+    endpoint = f"http://127.0.0.1:{port}"
+    os.environ.update({
+        "AWS_ACCESS_KEY_ID": "testing",
+        "AWS_SECRET_ACCESS_KEY": "testing",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "AWS_ENDPOINT_URL": endpoint,
+        "WR_S3_ENDPOINT_URL": endpoint,
+        "WR_GLUE_ENDPOINT_URL": endpoint,
+    })
+    yield endpoint
+    server.stop()
+
+
+@pytest.fixture
+def fake_athena(moto_server, monkeypatch):
+    """Athena stubbed with DuckDB for jobs of the pandas and unload engines. Statements run over the Glue tables of the
+    moto server, query results are kept for wr.athena.get_query_results and UNLOAD writes its Parquet like Athena
+    does. Yields the statements that ran"""
+    import io
+    import re
+    import uuid
+    import awswrangler as wr
+    import materialize_athena_query as maq
+    from awswrangler._data_types import pyarrow2athena
+    from duckdb_engine import INT_TYPES, DuckDBEngine
+
+    statements, results, columns_types = [], {}, {}
+
+    def run_athena_statement(self, sql, checkpoint=None, **checkpoint_values):
+        statements.append(sql)
+        query_execution_id = uuid.uuid4().hex
+        if checkpoint:
+            self._save_checkpoint(checkpoint, query_execution_id=query_execution_id, **checkpoint_values)
+        engine = DuckDBEngine(default_database=self.target_database)
+        unload = re.match(r"UNLOAD \((.*)\)\nTO '([^']+)'\nWITH \((.*)\)$", sql, re.DOTALL)
+        if unload:
+            select, path, options = unload.groups()
+            partition_cols = re.findall(r"'([^']+)'", options.split("partitioned_by", 1)[1]) if "partitioned_by" in options else []
+            df = engine.query(select)
+            if len(df):
+                wr.s3.to_parquet(df, path=path, dataset=True, partition_cols=partition_cols or None, index=False)
+        else:
+            # column types from the result's schema, the frame of a LIMIT 0 probe has none to infer them from
+            result = engine._arrow_reader(sql, 100000).read_all()
+            columns_types[query_execution_id] = {field.name: pyarrow2athena(field.type) for field in result.schema}
+            results[query_execution_id] = result.to_pandas(types_mapper=INT_TYPES.get)
+            self._result_location = f"s3://{self.stg_athena_bucket}/{self.target_table}/{query_execution_id}.csv"
+            # like Athena, an empty result is a csv with just the header
+            wr.s3.upload(local_file=io.BytesIO(results[query_execution_id].to_csv(index=False).encode()), path=self._result_location)
+        self._log_query_stats({"QueryQueueTimeInMillis": 0, "EngineExecutionTimeInMillis": 0, "DataScannedInBytes": 0})
+        return query_execution_id
+
+    def get_query_results(query_execution_id, categories=None, chunksize=None, **kwargs):
+        df = results[query_execution_id].astype({col: "category" for col in categories or []})
+        if not chunksize:
+            return df.copy()
+        return (df.iloc[start:start + chunksize].reset_index(drop=True) for start in range(0, len(df), chunksize))
+
+    def get_query_columns_types(query_execution_id, **kwargs):
+        return columns_types[query_execution_id]
+
+    monkeypatch.setattr(maq.MaterializeAthenaQuery, "_run_athena_statement", run_athena_statement)
+    monkeypatch.setattr(wr.athena, "get_query_results", get_query_results)
+    monkeypatch.setattr(wr.athena, "get_query_columns_types", get_query_columns_types)
+    yield statements
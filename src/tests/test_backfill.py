@@ -0,0 +1,123 @@
+"""Backfills whose shards run concurrently, checked against a local moto S3/Glue server"""
+import json
+import os
+import uuid
+
+import pytest
+
+DATABASE = "backfill_db"
+OUTPUT_BUCKET = "backfill-output"
+RESULTS_BUCKET = "backfill-results"
+DAYS = ["2021-06-01", "2021-06-02", "2021-06-03", "2021-06-04"]
+ROWS_PER_DAY = 250
+
+
+@pytest.fixture(scope="module")
+def source(moto_server, tmp_path_factory):
+    import boto3
+    import awswrangler as wr
+    import pandas as pd
+
+    for bucket in (OUTPUT_BUCKET, RESULTS_BUCKET):
+        boto3.client("s3").create_bucket(Bucket=bucket)
+    wr.catalog.create_database(DATABASE)
+    path = str(tmp_path_factory.mktemp("source") / "source.csv")
+    pd.DataFrame({
+        "id": range(len(DAYS) * ROWS_PER_DAY),
+        "day": [day for day in DAYS for _ in range(ROWS_PER_DAY)],
+        "cases": [i % 97 for i in range(len(DAYS) * ROWS_PER_DAY)],
+    }).to_csv(path, index=False)
+    return path
+
+
+@pytest.fixture
+def backfill(source, tmp_path, monkeypatch):
+    import materialize_athena_query as maq
+    from backfill import Backfill, get_date_shards
+
+    monkeypatch.setattr(maq, "get_query", lambda sql_script, params=None: (
+        f"SELECT * FROM {DATABASE}.source WHERE day >= '{params['shard_start']}' AND day < '{params['shard_end']}' ORDER BY id"
+    ))
+
+    def make(step_days=1, **options):
+        job = maq.MaterializeAthenaQuery(
+            "stubbed.sql", OUTPUT_BUCKET, DATABASE, f"t_{uuid.uuid4().hex[:8]}", "backfill test", RESULTS_BUCKET,
+            partition_cols=["day"], engine="duckdb", local_tables={f"{DATABASE}.source": source},
+            state_store_uri=f"file://{tmp_path}/state", **options
+        )
+        return Backfill(job=job, shards=get_date_shards(DAYS[0], "2021-06-05", step_days), max_concurrency=4)
+    return make
+
+
+def read_state(tmp_path, job, name):
+    path = os.path.join(tmp_path, "state", job.target_database, job.target_table, f"{name}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def test_backfill_stats(backfill, tmp_path):
+    run = backfill()
+    assert run.run() == []
+    # the concurrent shards don't race on the job's stats history, the backfill records them as one run
+    assert read_state(tmp_path, run.job, "stats") is None
+    runs = read_state(tmp_path, run.job, "backfill_stats")["runs"]
+    assert [(saved["status"], saved["shards"], saved["failed_shards"], saved["result_rows"]) for saved in runs] == [
+        ("succeeded", len(DAYS), 0, len(DAYS) * ROWS_PER_DAY)
+    ]
+
+
+def read_table(job):
+    from duckdb_engine import read_glue_table
+
+    return read_glue_table(job.target_database, job.target_table).sort_values("id").reset_index(drop=True)
+
+
+def test_shards_overwrite_their_partitions(backfill, monkeypatch):
+    import awswrangler as wr
+    import pandas as pd
+    import materialize_athena_query as maq
+    from backfill import Backfill, get_date_shards
+
+    run = backfill()
+    assert run.run() == []
+    first = read_table(run.job)
+    assert first["id"].tolist() == list(range(len(DAYS) * ROWS_PER_DAY))
+    assert sorted(values[0] for values in wr.catalog.get_partitions(DATABASE, run.job.target_table).values()) == DAYS
+
+    # backfilling two days again only rewrites their partitions
+    monkeypatch.setattr(maq, "get_query", lambda sql_script, params=None: (
+        f"SELECT id, day, cases + 1000 AS cases FROM {DATABASE}.source "
+        f"WHERE day >= '{params['shard_start']}' AND day < '{params['shard_end']}' ORDER BY id"
+    ))
+    assert Backfill(job=run.job, shards=get_date_shards(DAYS[1], DAYS[3], 1)).run() == []
+    df = read_table(run.job)
+    rewritten = df["day"].astype(str).isin(DAYS[1:3])
+    assert len(df) == len(first) and rewritten.sum() == 2 * ROWS_PER_DAY
+    assert (df[rewritten]["cases"] >= 1000).all()
+    pd.testing.assert_frame_equal(df[~rewritten], first[~rewritten])
+
+
+def test_failed_shards_are_retried(backfill, tmp_path, monkeypatch):
+    from collections import Counter
+    import materialize_athena_query as maq
+
+    attempts = Counter()
+    run = backfill()
+    get_query = maq.get_query
+
+    def flaky_get_query(sql_script, params=None):
+        # the third day fails once, the last one every time
+        day = params["shard_start"]
+        attempts[day] += 1
+        if day == DAYS[3] or (day == DAYS[2] and attempts[day] == 1):
+            raise RuntimeError(f"shard {day} failed")
+        return get_query(sql_script, params)
+    monkeypatch.setattr(maq, "get_query", flaky_get_query)
+    run.max_attempts = 2
+    assert run.run() == [{"shard_start": DAYS[3], "shard_end": "2021-06-05"}]
+    assert attempts == {DAYS[0]: 1, DAYS[1]: 1, DAYS[2]: 2, DAYS[3]: 2}
+    assert sorted(read_table(run.job)["day"].astype(str).unique()) == DAYS[:3]
+    saved = read_state(tmp_path, run.job, "backfill_stats")["runs"][-1]
+    assert (saved["status"], saved["failed_shards"]) == ("failed", 1)
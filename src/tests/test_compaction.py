@@ -0,0 +1,87 @@
+"""compact_small_files against a local moto S3/Glue server, the Athena scan timing is read from the catalog instead"""
+import uuid
+
+import pytest
+
+DATABASE = "compaction_db"
+BUCKET = "compaction-data"
+DAYS = ["2021-06-01", "2021-06-02"]
+WRITES = 4
+ROWS_PER_WRITE = 50
+
+
+@pytest.fixture
+def table(moto_server, monkeypatch):
+    """A table partitioned by day that WRITES appends left one small file per partition each"""
+    import boto3
+    import awswrangler as wr
+    import pandas as pd
+    from compact_small_files import CompactSmallFiles
+    from duckdb_engine import read_glue_table
+
+    boto3.client("s3").create_bucket(Bucket=BUCKET)
+    if DATABASE not in wr.catalog.databases()["Database"].tolist():
+        wr.catalog.create_database(DATABASE)
+    monkeypatch.setattr(CompactSmallFiles, "_time_scan", lambda self: {"rows": len(read_glue_table(self.database, self.table))})
+
+    name = f"t_{uuid.uuid4().hex[:8]}"
+    for write in range(WRITES):
+        ids = range(write * ROWS_PER_WRITE, (write + 1) * ROWS_PER_WRITE)
+        wr.s3.to_parquet(pd.DataFrame({"id": ids, "day": [DAYS[i % len(DAYS)] for i in ids]}),
+                         path=f"s3://{BUCKET}/{name}/", dataset=True, mode="append", partition_cols=["day"],
+                         database=DATABASE, table=name)
+    return name
+
+
+def partition_locations(table):
+    import awswrangler as wr
+
+    return {values[0]: location for location, values in wr.catalog.get_partitions(database=DATABASE, table=table).items()}
+
+
+def compaction(table, tmp_path, **options):
+    from compact_small_files import CompactSmallFiles
+
+    return CompactSmallFiles(DATABASE, table, BUCKET, state_store_uri=f"file://{tmp_path}/state", **options)
+
+
+def test_compaction_versions(table, tmp_path):
+    import awswrangler as wr
+    import pandas as pd
+    from compact_small_files import list_files
+
+    first = compaction(table, tmp_path)
+    # started in the same second, the version's suffix keeps them apart
+    assert first.version != compaction(table, tmp_path).version
+    report = first.run()
+    assert (report["locations_compacted"], report["files_before"], report["files_after"]) == (len(DAYS), len(DAYS) * WRITES, len(DAYS))
+    assert report["scan_before"] == report["scan_after"] == {"rows": WRITES * ROWS_PER_WRITE}
+    for day, location in partition_locations(table).items():
+        assert location == f"s3://{BUCKET}/{table}_compacted/{first.version}/day={day}/"
+        assert len(list_files(location)) == 1
+
+    # a later compaction is built next to the original location, not inside the previous version
+    wr.s3.to_parquet(pd.DataFrame({"id": [-1], "day": [DAYS[0]]}), path=f"{partition_locations(table)[DAYS[0]]}late.parquet")
+    second = compaction(table, tmp_path)
+    assert second.run()["locations_compacted"] == 1
+    assert partition_locations(table)[DAYS[0]] == f"s3://{BUCKET}/{table}_compacted/{second.version}/day={DAYS[0]}/"
+    assert partition_locations(table)[DAYS[1]].startswith(f"s3://{BUCKET}/{table}_compacted/{first.version}/")
+
+
+def test_late_files_caught_up_at_expiry(table, tmp_path):
+    import awswrangler as wr
+    import pandas as pd
+    from compact_small_files import list_files
+    from duckdb_engine import read_glue_table
+
+    old_locations = partition_locations(table)
+    compaction(table, tmp_path, retention_hours=0).run()
+    # a writer that looked up the location before the switch still adds its file to the old one
+    wr.s3.to_parquet(pd.DataFrame({"id": [-1], "day": [DAYS[0]]}), path=f"{old_locations[DAYS[0]]}late.parquet")
+    assert len(read_glue_table(DATABASE, table)) == WRITES * ROWS_PER_WRITE
+
+    # the next run expires the replaced files, the late one is carried over to the current location first
+    compaction(table, tmp_path, retention_hours=0).run()
+    df = read_glue_table(DATABASE, table)
+    assert sorted(df["id"].tolist()) == [-1] + list(range(WRITES * ROWS_PER_WRITE))
+    assert all(list_files(location) == {} for location in old_locations.values())
@@ -0,0 +1,61 @@
+"""MaterializeDag's job graph, inferred from the tables each job's query reads or set with depends_on"""
+import pytest
+
+TEMPLATES = {
+    "counties.sql": "SELECT * FROM raw.nytimes_counties",
+    "states.sql": "SELECT * FROM raw.states",
+    # a comma join of both upstream tables, filtered by a run time param that renders empty when inferring
+    "report.sql": """
+        SELECT c.*, s.name FROM dw.counties c, dw.states s
+        WHERE c.state = s.code {% if watermark %}AND c.date >= '{{ watermark }}'{% endif %}
+    """,
+}
+
+
+@pytest.fixture
+def make_dag(tmp_path, monkeypatch):
+    import materialize_athena_query as maq
+    import materialize_dag
+
+    for name, template in TEMPLATES.items():
+        (tmp_path / name).write_text(template)
+    monkeypatch.setattr(maq, "SQL_SCRIPTS_PATH", str(tmp_path))
+    maq.get_j2_env.cache_clear()
+
+    def make(depends_on=None):
+        jobs = {
+            name: maq.MaterializeAthenaQuery(f"{name}.sql", "bucket", "dw", name, name, "results")
+            for name in ("counties", "states", "report")
+        }
+        return materialize_dag.MaterializeDag(jobs, depends_on=depends_on or {})
+    yield make
+    maq.get_j2_env.cache_clear()
+
+
+def test_inferred_from_comma_join(make_dag):
+    dag = make_dag()
+    assert dag.depends_on == {"counties": [], "states": [], "report": ["counties", "states"]}
+
+
+def test_depends_on_overrides(make_dag):
+    # states is refreshed by another pipeline, report only waits for counties
+    dag = make_dag(depends_on={"report": ["counties"]})
+    assert dag.depends_on == {"counties": [], "states": [], "report": ["counties"]}
+
+
+def test_run_order(make_dag, monkeypatch):
+    import materialize_athena_query as maq
+    import materialize_dag
+
+    finished = []
+    # the stubbed jobs don't touch AWS, and awswrangler loaded here wouldn't see the moto endpoint of later tests
+    monkeypatch.setattr(materialize_dag, "load_lazy_modules", lambda: None)
+    monkeypatch.setattr(maq.MaterializeAthenaQuery, "process_query", lambda self, raise_errors=False: finished.append(self.target_table))
+    status = make_dag().run()
+    assert status == {"counties": "succeeded", "states": "succeeded", "report": "succeeded"}
+    assert finished[-1] == "report"
+
+
+def test_unknown_dependency(make_dag):
+    with pytest.raises(ValueError, match=r"depends on unknown jobs \['missing'\]"):
+        make_dag(depends_on={"report": ["missing"]})
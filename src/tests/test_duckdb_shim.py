@@ -0,0 +1,54 @@
+"""The Presto shim of duckdb_engine: to_duckdb_sql rewrites and PRESTO_MACROS, run in an embedded DuckDB"""
+import pytest
+
+
+@pytest.fixture
+def duckdb_engine(moto_server):
+    # awswrangler reads its endpoints when it's imported, so only after the moto server has set them
+    import duckdb_engine
+
+    return duckdb_engine
+
+
+@pytest.mark.parametrize("sql, expected", [
+    ("SELECT date_parse(d, '%Y-%m-%d %H:%i:%s') FROM t", "SELECT strptime(d, '%Y-%m-%d %H:%M:%S') FROM t"),
+    ("SELECT DATE_FORMAT(ts, '%M %e, %Y') AS day", "SELECT strftime(ts, '%B %-d, %Y') AS day"),
+    # calls nested in the arguments are rewritten with the outer call
+    ("SELECT date_format(date_parse(d, '%Y%m%d'), '%W')", "SELECT strftime(strptime(d, '%Y%m%d'), '%A')"),
+    ("SELECT try(cast(x AS integer)) FROM t", "SELECT try_cast(x AS integer) FROM t"),
+    ("SELECT try(CAST(date_parse(d, '%Y') AS date))", "SELECT try_cast(strptime(d, '%Y') AS date)"),
+    # a format that isn't a literal, or a try that isn't a single cast, is left to DuckDB
+    ("SELECT date_parse(d, fmt) FROM t", "SELECT date_parse(d, fmt) FROM t"),
+    ("SELECT try(x / y) FROM t", "SELECT try(x / y) FROM t"),
+    ("SELECT try(cast(x AS int) + 1)", "SELECT try(cast(x AS int) + 1)"),
+    # quoted parens and commas don't end the call
+    ("SELECT date_format(ts, '%Y,(%c)')", "SELECT strftime(ts, '%Y,(%-m)')"),
+    ("SELECT 'date_parse(' AS label", "SELECT 'date_parse(' AS label"),
+])
+def test_to_duckdb_sql(duckdb_engine, sql, expected):
+    assert duckdb_engine.to_duckdb_sql(sql) == expected
+
+
+def test_shimmed_query_runs(duckdb_engine):
+    from datetime import datetime
+
+    df = duckdb_engine.DuckDBEngine(default_database="shim_db").query("""
+        SELECT
+            date_parse(d, '%Y-%m-%d %H:%i:%s') AS parsed,
+            date_format(date_parse(d, '%Y-%m-%d %H:%i:%s'), '%M %e') AS formatted,
+            try(cast(n AS integer)) AS number,
+            day_of_week(date_parse(d, '%Y-%m-%d %H:%i:%s')) AS weekday,
+            to_unixtime(from_iso8601_timestamp('2021-06-01T00:00:00')) AS epoch,
+            regexp_like(n, '^[0-9]+$') AS numeric,
+            cardinality(ARRAY[1, 2, 3]) AS items
+        FROM (VALUES ('2021-06-01 13:05:09', '42'), ('2021-06-06 00:00:00', 'n/a')) AS t (d, n)
+        ORDER BY d
+    """)
+    assert df["parsed"].tolist() == [datetime(2021, 6, 1, 13, 5, 9), datetime(2021, 6, 6)]
+    assert df["formatted"].tolist() == ["June 1", "June 6"]
+    assert df["number"].tolist()[0] == 42 and df["number"].isna().tolist() == [False, True]
+    # ISO weekdays like Presto, Monday is 1
+    assert df["weekday"].tolist() == [2, 7]
+    assert df["epoch"].tolist() == [1622505600] * 2
+    assert df["numeric"].tolist() == [True, False]
+    assert df["items"].tolist() == [3, 3]
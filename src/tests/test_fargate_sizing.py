@@ -0,0 +1,79 @@
+"""Fargate sizing from a job's run history, see cdk/stacks/helpers/fargate_sizing.py"""
+import os
+import sys
+
+import pytest
+
+HELPERS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))), "cdk", "stacks", "helpers")
+
+
+@pytest.fixture(scope="module")
+def fargate_sizing():
+    # imported on its own, the helpers package needs aws_cdk
+    sys.path.insert(0, HELPERS_PATH)
+    import fargate_sizing
+
+    yield fargate_sizing
+    sys.path.remove(HELPERS_PATH)
+
+
+def run(status="succeeded", peak_rss_mb=None, memory_limit_mb=None):
+    return {"status": status, "peak_rss_mb": peak_rss_mb, "memory_limit_mb": memory_limit_mb}
+
+
+@pytest.mark.parametrize("runs, size", [
+    ([], None),
+    # small jobs shrink below 1 vCPU
+    ([run(peak_rss_mb=250)], ("0.25", "512")),
+    ([run(peak_rss_mb=300), run("failed", peak_rss_mb=600)], ("0.25", "1024")),
+    ([run(peak_rss_mb=2000)], ("0.5", "3072")),
+    ([run(peak_rss_mb=5000)], ("1", "8192")),
+    # killed runs never recorded their peak, only an OOM kill grows memory
+    ([run(peak_rss_mb=250), run("running", peak_rss_mb=100, memory_limit_mb=4096)], ("0.25", "512")),
+    ([run(peak_rss_mb=250), run("killed", peak_rss_mb=100, memory_limit_mb=4096)], ("0.25", "512")),
+    ([run("running", peak_rss_mb=100)], None),
+    ([run(peak_rss_mb=250), run("oom_killed", peak_rss_mb=100, memory_limit_mb=1024)], ("0.25", "2048")),
+    ([run("oom_killed", peak_rss_mb=100)], ("0.5", "4096")),
+])
+def test_size_from_stats(fargate_sizing, runs, size):
+    assert fargate_sizing.size_from_stats(runs) == size
+
+
+def test_min_vcpu(fargate_sizing):
+    assert fargate_sizing.size_from_stats([run(peak_rss_mb=250)], min_vcpu="1") == ("1", "2048")
+
+
+def test_too_large(fargate_sizing):
+    with pytest.raises(ValueError, match="No Fargate size"):
+        fargate_sizing.size_from_stats([run(peak_rss_mb=100000)])
+
+
+def test_resolve_killed_runs(monkeypatch):
+    import materialize_athena_query as maq
+
+    # attempts of the Batch jobs, in epoch milliseconds
+    described = [
+        {"jobId": "oom", "attempts": [
+            {"startedAt": 1000, "stoppedAt": 2000, "container": {"reason": "OutOfMemoryError: Container killed due to memory usage"}},
+            {"startedAt": 3000, "stoppedAt": 4000, "container": {"reason": "Essential container in task exited"}},
+        ]},
+        {"jobId": "in_progress", "attempts": []},
+    ]
+
+    class Batch:
+        def describe_jobs(self, jobs):
+            return {"jobs": [job for job in described if job["jobId"] in jobs]}
+    monkeypatch.setattr(maq.boto3, "client", lambda service: Batch())
+
+    def started(ms):
+        return maq.datetime.fromtimestamp(ms / 1000, maq.timezone.utc).isoformat()
+    runs = [
+        {"status": "running", "batch_job_id": "oom", "started_at": started(1500)},
+        {"status": "running", "batch_job_id": "oom", "started_at": started(3500)},
+        {"status": "running", "batch_job_id": "in_progress", "started_at": started(5000)},
+        {"status": "running", "batch_job_id": "expired", "started_at": started(500)},
+        {"status": "running", "batch_job_id": None, "started_at": started(500)},
+        {"status": "succeeded", "batch_job_id": "oom", "started_at": started(1500)},
+    ]
+    maq.resolve_killed_runs(runs)
+    assert [saved["status"] for saved in runs] == ["oom_killed", "killed", "running", "killed", "running", "succeeded"]
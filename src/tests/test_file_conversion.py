@@ -0,0 +1,190 @@
+"""Conversions that fail part way and are retried, checked against a local moto S3/Glue server"""
+import io
+
+import pytest
+
+DATABASE = "conversion_db"
+INPUT_BUCKET = "conversion-input"
+OUTPUT_BUCKET = "conversion-output"
+ROWS = 2500
+
+
+class Killed(Exception):
+    pass
+
+
+@pytest.fixture(scope="module")
+def lambda_func(moto_server):
+    import boto3
+    import awswrangler as wr
+    from file_conversion_lambda import lambda_func
+
+    for bucket in (INPUT_BUCKET, OUTPUT_BUCKET):
+        boto3.client("s3").create_bucket(Bucket=bucket)
+    wr.catalog.create_database(DATABASE)
+    wr.config.database = DATABASE
+    yield lambda_func
+    wr.config.reset("database")
+
+
+def upload(key, body):
+    import boto3
+
+    boto3.client("s3").put_object(Bucket=INPUT_BUCKET, Key=key, Body=body)
+    return {"s3": {"bucket": {"name": INPUT_BUCKET}, "object": {"key": key}}}
+
+
+def csv_body(start, rows):
+    # the first chunk has no missing cases, so only an explicit dtype parses later chunks as the same type
+    out = io.StringIO()
+    out.write("id,state,cases\n")
+    for i in range(start, start + rows):
+        out.write(f"{i},{'AL' if i % 2 else 'AK'},{'' if i > 1500 and i % 7 == 0 else i % 97}\n")
+    return out.getvalue()
+
+
+def table_rows(table):
+    import awswrangler as wr
+
+    df = wr.s3.read_parquet(path=wr.catalog.get_table_location(database=DATABASE, table=table), dataset=True)
+    return {"n": len(df), "ids": df["id"].nunique(), "cases": str(df["cases"].dtype)}
+
+
+def test_convert_file_retry(lambda_func, monkeypatch):
+    monkeypatch.setattr(lambda_func, "CHUNK_ROWS", 1000)
+    event = {"Records": [upload("s3_inputs/retried.csv", csv_body(0, ROWS))]}
+    monkeypatch.setenv("OUTPUT_BUCKET_NAME", OUTPUT_BUCKET)
+    original = lambda_func.write_parquet
+    calls = {"n": 0}
+
+    def killed(*args, **kwargs):
+        original(*args, **kwargs)
+        calls["n"] += 1
+        if calls["n"] == 2:
+            raise Killed("killed after the second chunk")
+    monkeypatch.setattr(lambda_func, "write_parquet", killed)
+    with pytest.raises(Killed):
+        lambda_func.lambda_handler(event, None)
+    lambda_func.lambda_handler(event, None)
+    assert table_rows("retried") == {"n": ROWS, "ids": ROWS, "cases": "Int64"}
+
+
+def test_queued_batch_retry(lambda_func, monkeypatch):
+    import json
+
+    # every chunk is written as it's read, so the first file is written before the second one fails
+    monkeypatch.setattr(lambda_func, "CHUNK_ROWS", 1000)
+    monkeypatch.setattr(lambda_func, "MAX_BATCH_MB", 0)
+    records = [upload(f"s3_inputs/{i}/queued.csv", csv_body(i * ROWS, ROWS)) for i in range(2)]
+    event = {"Records": [
+        {"eventSource": "aws:sqs", "messageId": str(i), "body": json.dumps({"Records": [record]})} for i, record in enumerate(records)
+    ]}
+    original = lambda_func.read_csv_chunks
+    calls = {"n": 0}
+
+    def killed(*args, **kwargs):
+        calls["n"] += 1
+        if calls["n"] == 2:
+            raise Killed("killed reading the second file")
+        return original(*args, **kwargs)
+    monkeypatch.setattr(lambda_func, "read_csv_chunks", killed)
+    assert lambda_func.handle_queued_batch(event, OUTPUT_BUCKET)["batchItemFailures"] == [{"itemIdentifier": "0"}, {"itemIdentifier": "1"}]
+    assert lambda_func.handle_queued_batch(event, OUTPUT_BUCKET)["batchItemFailures"] == []
+    assert table_rows("queued") == {"n": 2 * ROWS, "ids": 2 * ROWS, "cases": "Int64"}
+    assert lambda_func.wr.s3.list_objects(f"s3://{OUTPUT_BUCKET}/{lambda_func.STAGING_PREFIX}") == []
+
+
+def test_queued_batch_publish_retry(lambda_func, monkeypatch):
+    import json
+
+    # the batch fails once its files are copied into the table, and its uploads come back in separate batches
+    monkeypatch.setattr(lambda_func, "CHUNK_ROWS", 1000)
+    records = [upload(f"s3_inputs/{i}/published.csv", csv_body(i * ROWS, ROWS)) for i in range(2)]
+    messages = [{"eventSource": "aws:sqs", "messageId": str(i), "body": json.dumps({"Records": [record]})} for i, record in enumerate(records)]
+    original = lambda_func.wr.s3.copy_objects
+
+    def killed(*args, **kwargs):
+        original(*args, **kwargs)
+        raise Killed("killed after copying the staged files")
+    monkeypatch.setattr(lambda_func.wr.s3, "copy_objects", killed)
+    assert len(lambda_func.handle_queued_batch({"Records": messages}, OUTPUT_BUCKET)["batchItemFailures"]) == 2
+    monkeypatch.setattr(lambda_func.wr.s3, "copy_objects", original)
+    for message in messages:
+        assert lambda_func.handle_queued_batch({"Records": [message]}, OUTPUT_BUCKET)["batchItemFailures"] == []
+    assert table_rows("published") == {"n": 2 * ROWS, "ids": 2 * ROWS, "cases": "Int64"}
+    assert lambda_func.wr.s3.list_objects(f"s3://{OUTPUT_BUCKET}/{lambda_func.STAGING_PREFIX}") == []
+
+
+def widening_body(start, rows):
+    # cases is an integer column until a fractional value after the first chunk, code until a text value
+    out = io.StringIO()
+    out.write("id,cases,code\n")
+    for i in range(start, start + rows):
+        out.write(f"{i},{'1.5' if i == start + 1800 else i % 97},{'x9' if i == start + 2200 else i % 13}\n")
+    return out.getvalue()
+
+
+def table_types(table):
+    import awswrangler as wr
+
+    return {col: wr.catalog.get_table_types(database=DATABASE, table=table)[col] for col in ("id", "cases", "code")}
+
+
+def test_convert_file_widens_types(lambda_func, monkeypatch):
+    monkeypatch.setattr(lambda_func, "CHUNK_ROWS", 1000)
+    monkeypatch.setenv("OUTPUT_BUCKET_NAME", OUTPUT_BUCKET)
+    lambda_func.lambda_handler({"Records": [upload("s3_inputs/widened.csv", widening_body(0, ROWS))]}, None)
+    assert table_types("widened") == {"id": "bigint", "cases": "double", "code": "string"}
+    assert table_rows("widened") == {"n": ROWS, "ids": ROWS, "cases": "float64"}
+
+
+def test_queued_batch_widens_types(lambda_func, monkeypatch):
+    import json
+
+    monkeypatch.setattr(lambda_func, "CHUNK_ROWS", 1000)
+    monkeypatch.setattr(lambda_func, "MAX_BATCH_MB", 0)
+    records = [upload(f"s3_inputs/{i}/queued_widened.csv", widening_body(i * ROWS, ROWS)) for i in range(2)]
+    event = {"Records": [
+        {"eventSource": "aws:sqs", "messageId": str(i), "body": json.dumps({"Records": [record]})} for i, record in enumerate(records)
+    ]}
+    assert lambda_func.handle_queued_batch(event, OUTPUT_BUCKET)["batchItemFailures"] == []
+    assert table_types("queued_widened") == {"id": "bigint", "cases": "double", "code": "string"}
+    assert table_rows("queued_widened") == {"n": 2 * ROWS, "ids": 2 * ROWS, "cases": "float64"}
+
+
+@pytest.fixture
+def no_database(lambda_func):
+    """No global Glue database (WR_DATABASE), as in the stack, where the crawler catalogs the converted files"""
+    lambda_func.wr.config.reset("database")
+    yield
+    lambda_func.wr.config.database = DATABASE
+
+
+def location_rows(table):
+    import awswrangler as wr
+
+    df = wr.s3.read_parquet(path=f"s3://{OUTPUT_BUCKET}/ingested_csv/{table}/", dataset=True)
+    return {"n": len(df), "ids": df["id"].nunique(), "cases": str(df["cases"].dtype)}
+
+
+def test_convert_file_without_database(lambda_func, no_database, monkeypatch):
+    monkeypatch.setattr(lambda_func, "CHUNK_ROWS", 1000)
+    monkeypatch.setenv("OUTPUT_BUCKET_NAME", OUTPUT_BUCKET)
+    # widened types drop and recreate a new table, which has nothing to drop without a database
+    lambda_func.lambda_handler({"Records": [upload("s3_inputs/uncataloged.csv", widening_body(0, ROWS))]}, None)
+    assert location_rows("uncataloged") == {"n": ROWS, "ids": ROWS, "cases": "float64"}
+    assert not lambda_func.wr.catalog.does_table_exist(database=DATABASE, table="uncataloged")
+
+
+def test_queued_batch_without_database(lambda_func, no_database, monkeypatch):
+    import json
+
+    monkeypatch.setattr(lambda_func, "CHUNK_ROWS", 1000)
+    records = [upload(f"s3_inputs/{i}/queued_uncataloged.csv", csv_body(i * ROWS, ROWS)) for i in range(2)]
+    event = {"Records": [
+        {"eventSource": "aws:sqs", "messageId": str(i), "body": json.dumps({"Records": [record]})} for i, record in enumerate(records)
+    ]}
+    assert lambda_func.handle_queued_batch(event, OUTPUT_BUCKET)["batchItemFailures"] == []
+    assert location_rows("queued_uncataloged") == {"n": 2 * ROWS, "ids": 2 * ROWS, "cases": "Int64"}
+    assert not lambda_func.wr.catalog.does_table_exist(database=DATABASE, table="queued_uncataloged")
+    assert lambda_func.wr.s3.list_objects(f"s3://{OUTPUT_BUCKET}/{lambda_func.STAGING_PREFIX}") == []
@@ -0,0 +1,103 @@
+"""Synth time Glue table lookups, see cdk/stacks/helpers/glue_catalog_cache.py, against a local moto Glue server"""
+import json
+import os
+import sys
+import uuid
+
+import pytest
+
+HELPERS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))), "cdk", "stacks", "helpers")
+TABLES = 120
+
+
+@pytest.fixture
+def cache(moto_server, tmp_path, monkeypatch):
+    # imported on its own, the helpers package needs aws_cdk
+    monkeypatch.syspath_prepend(HELPERS_PATH)
+    monkeypatch.setenv("GLUE_ENDPOINT_URL", moto_server)
+    import glue_catalog_cache
+
+    monkeypatch.setattr(glue_catalog_cache, "CACHE_DIR", str(tmp_path / "glue_catalog_cache"))
+    glue_catalog_cache.get_glue_client.cache_clear()
+    glue_catalog_cache.clear_cache()
+    calls = []
+    glue_catalog_cache.get_glue_client().meta.events.register(
+        "provide-client-params.glue.GetTables", lambda params, **kwargs: calls.append(params["DatabaseName"])
+    )
+    glue_catalog_cache.calls = calls
+    yield glue_catalog_cache
+    glue_catalog_cache.clear_cache()
+    glue_catalog_cache.get_glue_client.cache_clear()
+    sys.modules.pop("glue_catalog_cache")
+
+
+@pytest.fixture
+def database(cache):
+    """A database of TABLES tables, more than fit in one GetTables page"""
+    name = f"db_{uuid.uuid4().hex[:8]}"
+    client = cache.get_glue_client()
+    client.create_database(DatabaseInput={"Name": name})
+    for i in range(TABLES):
+        create_table(cache, name, f"table_{i:03d}")
+    return name
+
+
+def create_table(cache, database, table):
+    cache.get_glue_client().create_table(DatabaseName=database, TableInput={
+        "Name": table, "StorageDescriptor": {"Location": f"s3://data/{database}/{table}/"}
+    })
+
+
+def new_synth(cache):
+    """Drops the in memory copies like a new synth process would, the disk cache stays"""
+    cache._tables.clear()
+    cache._refreshed.clear()
+
+
+def test_tables_fetched_a_database_at_a_time(cache, database):
+    locations = cache.get_table_locations(database)
+    assert locations == {f"table_{i:03d}": f"s3://data/{database}/table_{i:03d}/" for i in range(TABLES)}
+    # one fetch for the whole database, its tables are then looked up in memory
+    assert cache.get_table_location(database, "table_007") == f"s3://data/{database}/table_007/"
+    assert cache.calls == [database]
+
+
+def test_disk_cache_ttl(cache, database):
+    cache.get_table_locations(database)
+    new_synth(cache)
+    # the next synth reads the disk cache instead of calling Glue
+    assert len(cache.get_table_locations(database)) == TABLES
+    assert len(cache.calls) == 1
+
+    # once it's older than the TTL it's fetched again
+    path = os.path.join(cache.CACHE_DIR, f"{database}.json")
+    with open(path) as f:
+        cached = json.load(f)
+    cached["fetched_at"] -= cache.CACHE_TTL_SECONDS + 1
+    with open(path, "w") as f:
+        json.dump(cached, f)
+    new_synth(cache)
+    assert len(cache.get_table_locations(database)) == TABLES
+    assert len(cache.calls) == 2
+
+
+def test_disk_cache_disabled(cache, database, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_TTL_SECONDS", 0)
+    cache.get_table_locations(database)
+    new_synth(cache)
+    cache.get_table_locations(database)
+    assert len(cache.calls) == 2
+    assert not os.path.exists(cache.CACHE_DIR)
+
+
+def test_missing_table_refreshes_once(cache, database):
+    cache.get_table_locations(database)
+    new_synth(cache)
+    # created since the database was cached
+    create_table(cache, database, "created_later")
+    assert cache.get_table_location(database, "created_later") == f"s3://data/{database}/created_later/"
+    assert len(cache.calls) == 2
+    # a table that doesn't exist doesn't refresh the database again in the same synth
+    assert cache.get_table_location(database, "missing") is None
+    assert len(cache.calls) == 2
+    assert cache.get_table_locations("no_such_database") == {}
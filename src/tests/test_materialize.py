@@ -0,0 +1,417 @@
+"""process_query end to end against a local moto S3/Glue server, with Athena stubbed by DuckDB (see fake_athena)
+for the pandas and unload engines"""
+import uuid
+
+import pytest
+
+DATABASE = "materialize_db"
+OUTPUT_BUCKET = "materialize-output"
+RESULTS_BUCKET = "materialize-results"
+STATES = ["AK", "AL", "AZ", "CA", "CO"]
+DAYS = ["2021-06-01", "2021-06-02", "2021-06-03", "2021-06-04"]
+ROWS = 2000
+
+
+@pytest.fixture(scope="module")
+def source(moto_server):
+    """materialize_db.source in the catalog, ROWS rows over DAYS and STATES"""
+    import boto3
+    import awswrangler as wr
+    import pandas as pd
+
+    for bucket in (OUTPUT_BUCKET, RESULTS_BUCKET):
+        boto3.client("s3").create_bucket(Bucket=bucket)
+    wr.catalog.create_database(DATABASE)
+    df = pd.DataFrame({
+        "id": range(ROWS),
+        "state": [STATES[i % len(STATES)] for i in range(ROWS)],
+        "reporting_date": [DAYS[i * len(DAYS) // ROWS] for i in range(ROWS)],
+        "cases": [i % 97 for i in range(ROWS)],
+        "rate": [i / 7 for i in range(ROWS)],
+    })
+    wr.s3.to_parquet(df, path=f"s3://{RESULTS_BUCKET}/source/", dataset=True, database=DATABASE, table="source")
+    return df
+
+
+@pytest.fixture
+def job(source, tmp_path, monkeypatch):
+    """Builds a job for a query template, its table gets a unique name"""
+    import materialize_athena_query as maq
+
+    monkeypatch.setattr(maq, "SQL_SCRIPTS_PATH", str(tmp_path))
+    maq.get_j2_env.cache_clear()
+
+    def make(sql=f"SELECT * FROM {DATABASE}.source", **options):
+        table = f"t_{uuid.uuid4().hex[:8]}"
+        (tmp_path / f"{table}.sql").write_text(sql)
+        options = {"state_store_uri": f"file://{tmp_path}/state", **options}
+        return maq.MaterializeAthenaQuery(f"{table}.sql", OUTPUT_BUCKET, DATABASE, table, "materialize test", RESULTS_BUCKET, **options)
+    yield make
+    maq.get_j2_env.cache_clear()
+
+
+def read_table(table):
+    """The table's rows by id, read through its catalog entry like Athena would"""
+    from duckdb_engine import read_glue_table
+
+    return read_glue_table(DATABASE, table).sort_values("id").reset_index(drop=True)
+
+
+def table_partitions(table):
+    import awswrangler as wr
+
+    return sorted(tuple(values) for values in wr.catalog.get_partitions(database=DATABASE, table=table).values())
+
+
+@pytest.mark.parametrize("engine", ["pandas", "duckdb"])
+@pytest.mark.parametrize("partition_cols", [[], ["state"]])
+def test_chunked_matches_full_frame(fake_athena, job, engine, partition_cols):
+    import awswrangler as wr
+    import pandas as pd
+
+    full = job(engine=engine, partition_cols=partition_cols)
+    full.process_query(raise_errors=True)
+    # batches don't line up with the partitions, so later batches append to partitions earlier ones created
+    chunked = job(engine=engine, partition_cols=partition_cols, chunksize=300)
+    chunked.process_query(raise_errors=True)
+
+    assert len(wr.s3.list_objects(f"{chunked.s3_dataset_output}/")) > len(wr.s3.list_objects(f"{full.s3_dataset_output}/"))
+    pd.testing.assert_frame_equal(read_table(chunked.target_table), read_table(full.target_table))
+    assert read_table(chunked.target_table)["id"].tolist() == list(range(ROWS))
+    assert table_partitions(chunked.target_table) == table_partitions(full.target_table)
+    assert (wr.catalog.get_table_types(database=DATABASE, table=chunked.target_table)
+            == wr.catalog.get_table_types(database=DATABASE, table=full.target_table))
+
+
+@pytest.mark.parametrize("partition_cols", [[], ["state"]])
+def test_unload_matches_pandas(fake_athena, job, partition_cols):
+    import pandas as pd
+
+    unload = job(engine="unload", partition_cols=partition_cols)
+    unload.process_query(raise_errors=True)
+    pandas = job(engine="pandas", partition_cols=partition_cols)
+    pandas.process_query(raise_errors=True)
+
+    # a LIMIT 0 probe for the column types, then the UNLOAD, nothing is read into the container
+    assert [statement.split()[0] for statement in fake_athena[:2]] == ["SELECT", "UNLOAD"]
+    assert "download_parse" not in unload.metrics.stages
+    columns = list(read_table(pandas.target_table).columns)
+    pd.testing.assert_frame_equal(read_table(unload.target_table)[columns], read_table(pandas.target_table), check_dtype=False)
+    assert table_partitions(unload.target_table) == table_partitions(pandas.target_table)
+
+
+def test_unload_overwrites_partitions(fake_athena, job, tmp_path):
+    import awswrangler as wr
+
+    table = job(engine="unload", partition_cols=["state"])
+    table.process_query(raise_errors=True)
+    # a second run of the same table that only produces two states replaces just those partitions
+    (tmp_path / table.sql_query_path).write_text(f"SELECT * FROM {DATABASE}.source WHERE state IN ('AK', 'AL') AND cases < 10")
+    table.process_query(raise_errors=True)
+
+    df = read_table(table.target_table)
+    assert sorted(df["state"].unique()) == STATES
+    assert df[df["state"].isin(["AK", "AL"])]["cases"].max() < 10
+    assert len(df[~df["state"].isin(["AK", "AL"])]) == len([i for i in range(ROWS) if STATES[i % len(STATES)] not in ("AK", "AL")])
+    # the staging prefix the partitions were unloaded to is emptied once they're copied
+    assert wr.s3.list_objects(f"s3://{RESULTS_BUCKET}/{table.target_table}/unload/") == []
+
+
+INCREMENTAL_SQL = (f"SELECT id, state, reporting_date, cases{{}} AS cases, rate FROM {DATABASE}.source WHERE reporting_date <= '{{}}'"
+                   "{{% if watermark %}} AND reporting_date {{{{ watermark_op }}}} '{{{{ watermark }}}}'{{% endif %}}")
+
+
+def test_watermark_lookback(job, tmp_path):
+    import pandas as pd
+
+    table = job(engine="duckdb", watermark_column="reporting_date", lookback_days=1, partition_cols=["reporting_date"])
+    table.process_query(raise_errors=True)
+    first = read_table(table.target_table)
+    assert table.state_store.get(table._state_key("watermark"))["watermark"] == DAYS[-1]
+
+    # as if the first run had stopped at DAYS[2], the rerun marks its cases so the partitions it rewrote show
+    table.state_store.put(table._state_key("watermark"), {"watermark": DAYS[2]})
+    (tmp_path / table.sql_query_path).write_text(INCREMENTAL_SQL.format(" + 1000", DAYS[-1]))
+    table.process_query(raise_errors=True)
+
+    df = read_table(table.target_table)
+    assert len(df) == ROWS
+    # the watermark moved back a day, so DAYS[1] is rewritten along with the new days and DAYS[0] is kept
+    rewritten = df["reporting_date"] >= DAYS[1]
+    assert (df[rewritten]["cases"] >= 1000).all()
+    pd.testing.assert_frame_equal(df[~rewritten], first[~rewritten])
+    assert table.state_store.get(table._state_key("watermark"))["watermark"] == DAYS[-1]
+
+
+def test_watermark_append(job, tmp_path):
+    table = job(engine="duckdb", watermark_column="reporting_date")
+    (tmp_path / table.sql_query_path).write_text(INCREMENTAL_SQL.format("", DAYS[1]))
+    table.process_query(raise_errors=True)
+    assert table.state_store.get(table._state_key("watermark"))["watermark"] == DAYS[1]
+
+    (tmp_path / table.sql_query_path).write_text(INCREMENTAL_SQL.format("", DAYS[-1]))
+    table.process_query(raise_errors=True)
+
+    # the appended slice starts after the watermark, the rows at it aren't added twice
+    df = read_table(table.target_table)
+    assert df["id"].tolist() == list(range(ROWS))
+
+
+@pytest.mark.parametrize("engine", ["pandas", "duckdb", "unload"])
+def test_dtype_overrides(fake_athena, job, engine, monkeypatch):
+    import awswrangler as wr
+    import pandas as pd
+    import materialize_athena_query as maq
+
+    frame_dtypes = []
+    compact_frame = maq.MaterializeAthenaQuery._compact_frame
+
+    def record_dtypes(self, df):
+        df = compact_frame(self, df)
+        frame_dtypes.append({col: str(dtype) for col, dtype in df.dtypes.items()})
+        return df
+    monkeypatch.setattr(maq.MaterializeAthenaQuery, "_compact_frame", record_dtypes)
+
+    table = job(engine=engine, partition_cols=["state"], dtypes={"cases": "smallint", "rate": "float"},
+                categorical_cols=["state"], arrow_strings=True, downcast_ints=True)
+    table.process_query(raise_errors=True)
+    plain = job(engine=engine, partition_cols=["state"])
+    plain.process_query(raise_errors=True)
+
+    # declared columns take their declared types, downcast ones keep the result's
+    assert wr.catalog.get_table_types(database=DATABASE, table=table.target_table) == {
+        **wr.catalog.get_table_types(database=DATABASE, table=plain.target_table), "cases": "smallint", "rate": "float"
+    }
+    assert wr.catalog.get_table_types(database=DATABASE, table=table.target_table)["id"] == "bigint"
+    columns = list(read_table(plain.target_table).columns)
+    pd.testing.assert_frame_equal(read_table(table.target_table)[columns], read_table(plain.target_table),
+                                  check_dtype=False, atol=1e-4)
+    if engine != "unload":
+        # held compactly in memory while it's written, nullable or not depending on the engine
+        assert {col: dtype.lower() for col, dtype in frame_dtypes[0].items()} == {
+            "id": "int16", "state": "category", "reporting_date": "string", "cases": "int8", "rate": "float64"
+        }
+
+
+def table_locations(table):
+    """The table's location, or its partitions' locations when it's partitioned"""
+    import awswrangler as wr
+
+    return list(wr.catalog.get_partitions(database=DATABASE, table=table)) or [wr.catalog.get_table_location(DATABASE, table)]
+
+
+@pytest.mark.parametrize("partition_cols", [[], ["state"]])
+def test_versioned_publish(job, tmp_path, partition_cols):
+    import awswrangler as wr
+
+    table = job(engine="duckdb", partition_cols=partition_cols, publish_mode="versioned", version_retention_hours=0)
+    table.process_query(raise_errors=True)
+    first = table.version
+    assert all(location.startswith(f"{table.s3_dataset_output}/{first}/") for location in table_locations(table.target_table))
+
+    (tmp_path / table.sql_query_path).write_text(f"SELECT id, state, reporting_date, cases + 1000 AS cases, rate FROM {DATABASE}.source")
+    table.process_query(raise_errors=True)
+    assert all(location.startswith(f"{table.s3_dataset_output}/{table.version}/") for location in table_locations(table.target_table))
+    assert (read_table(table.target_table)["cases"] >= 1000).all() and len(read_table(table.target_table)) == ROWS
+    # the replaced version is kept for queries still reading it until the next run expires it
+    assert wr.s3.list_objects(f"{table.s3_dataset_output}/{first}/")
+    table.process_query(raise_errors=True)
+    assert wr.s3.list_objects(f"{table.s3_dataset_output}/{first}/") == []
+
+
+def test_audit_rolls_back(job, tmp_path):
+    import pandas as pd
+    import awswrangler as wr
+
+    table = job(engine="duckdb", partition_cols=["state"], publish_mode="versioned",
+                audit={"min_rows": ROWS, "not_null": ["cases", "state"]})
+    table.process_query(raise_errors=True)
+    published, locations = read_table(table.target_table), table_locations(table.target_table)
+
+    (tmp_path / table.sql_query_path).write_text(
+        f"SELECT id, state, reporting_date, CASE WHEN id % 10 = 0 THEN NULL ELSE cases END AS cases, rate FROM {DATABASE}.source"
+    )
+    with pytest.raises(ValueError, match=r"200 nulls in \[cases\]"):
+        table.process_query(raise_errors=True)
+    # readers still see the last published version, the rejected one expires like a replaced one
+    assert table_locations(table.target_table) == locations
+    pd.testing.assert_frame_equal(read_table(table.target_table), published)
+    pending = table.state_store.get(table._state_key("versions"))["pending"]
+    assert pending[-1]["prefixes"] == [f"{table.output_path}/"] and wr.s3.list_objects(f"{table.output_path}/")
+
+    (tmp_path / table.sql_query_path).write_text(f"SELECT * FROM {DATABASE}.source WHERE id < 10")
+    with pytest.raises(ValueError, match=f"10 rows, expected at least {ROWS}"):
+        table.process_query(raise_errors=True)
+    assert table_locations(table.target_table) == locations
+
+
+def parquet_footers(path):
+    import io
+    import awswrangler as wr
+    import boto3
+    import pyarrow.parquet as pq
+
+    s3 = boto3.client("s3")
+    footers = []
+    for file_path in wr.s3.list_objects(path):
+        bucket, key = file_path[len("s3://"):].split("/", 1)
+        footers.append(pq.ParquetFile(io.BytesIO(s3.get_object(Bucket=bucket, Key=key)["Body"].read())).metadata)
+    return footers
+
+
+@pytest.mark.parametrize("engine", ["pandas", "duckdb"])
+def test_layout(fake_athena, job, engine):
+    import awswrangler as wr
+
+    layout = {"sort_by": ["reporting_date", "id"], "compression": "zstd", "dictionary_columns": ["reporting_date"], "row_group_rows": 100}
+    table = job(engine=engine, partition_cols=["state"], layout=layout)
+    table.process_query(raise_errors=True)
+
+    assert read_table(table.target_table)["id"].tolist() == list(range(ROWS))
+    assert wr.catalog.get_table_parameters(DATABASE, table.target_table)["compressionType"] == "zstd"
+    for footer in parquet_footers(f"{table.s3_dataset_output}/"):
+        assert footer.num_row_groups == -(-footer.num_rows // 100)
+        columns = footer.schema.names
+        for i in range(footer.num_row_groups):
+            row_group = footer.row_group(i)
+            assert {row_group.column(j).compression for j in range(row_group.num_columns)} == {"ZSTD"}
+            encodings = {columns[j]: row_group.column(j).encodings for j in range(row_group.num_columns)}
+            assert any("DICTIONARY" in encoding for encoding in encodings["reporting_date"])
+            assert not any("DICTIONARY" in encoding for encoding in encodings["id"])
+        # sorted within the partition, so row groups cover consecutive ranges of the sort key
+        ids = [(footer.row_group(i).column(columns.index("id")).statistics.min,
+                footer.row_group(i).column(columns.index("id")).statistics.max) for i in range(footer.num_row_groups)]
+        assert all(previous[1] < current[0] for previous, current in zip(ids, ids[1:]))
+
+
+def test_unload_layout(fake_athena, job):
+    table = job(engine="unload", partition_cols=["state"], layout={"sort_by": ["reporting_date", "id"], "compression": "zstd"})
+    table.process_query(raise_errors=True)
+
+    unload = next(statement for statement in fake_athena if statement.startswith("UNLOAD"))
+    assert 'ORDER BY "reporting_date", "id")' in unload and "compression = 'ZSTD'" in unload
+    with pytest.raises(ValueError, match="row_groups"):
+        job(layout={"row_groups": 10})
+
+
+def test_projection_parameters():
+    import materialize_athena_query as maq
+
+    projection = {"reporting_date": {"type": "date", "range": "2021-06-01,NOW"}, "state": {"type": "enum", "values": STATES}}
+    assert maq.get_projection_parameters(projection, ["reporting_date", "state"], "s3://bucket/table/") == {
+        "projection.enabled": "true",
+        "projection.reporting_date.type": "date",
+        "projection.reporting_date.range": "2021-06-01,NOW",
+        "projection.reporting_date.format": "yyyy-MM-dd",
+        "projection.reporting_date.interval": "1",
+        "projection.reporting_date.interval.unit": "DAYS",
+        "projection.state.type": "enum",
+        "projection.state.values": ",".join(STATES),
+        "storage.location.template": "s3://bucket/table/reporting_date=${reporting_date}/state=${state}",
+    }
+    with pytest.raises(ValueError, match="exactly the partition columns"):
+        maq.get_projection_parameters(projection, ["state"], "s3://bucket/table/")
+    with pytest.raises(ValueError, match="needs its range"):
+        maq.get_projection_parameters({"state": {"type": "integer"}}, ["state"], "s3://bucket/table/")
+    with pytest.raises(ValueError, match="Unknown projection type"):
+        maq.get_projection_parameters({"state": {"type": "list"}}, ["state"], "s3://bucket/table/")
+
+
+@pytest.mark.parametrize("engine", ["duckdb", "unload"])
+def test_projected_partitions(fake_athena, job, engine, caplog):
+    import awswrangler as wr
+
+    projection = {"reporting_date": {"type": "date", "range": f"{DAYS[0]},NOW"}, "state": {"type": "enum", "values": STATES[:-1]}}
+    table = job(engine=engine, partition_cols=["reporting_date", "state"], partition_projection=projection)
+    table.process_query(raise_errors=True)
+
+    parameters = wr.catalog.get_table_parameters(DATABASE, table.target_table)
+    assert parameters["projection.enabled"] == "true" and parameters["projection.state.values"] == ",".join(STATES[:-1])
+    assert parameters["storage.location.template"] == f"{table.s3_dataset_output}/reporting_date=${{reporting_date}}/state=${{state}}"
+    # Athena finds the partitions from the projection, none are registered
+    assert wr.catalog.get_partitions(database=DATABASE, table=table.target_table) == {}
+    if engine != "unload":
+        assert f"state={STATES[-1]}" in caplog.text and "aren't visible to Athena" in caplog.text
+
+
+@pytest.mark.parametrize("chunksize", [None, 300])
+def test_bulk_partition_registration(job, monkeypatch, chunksize):
+    import awswrangler as wr
+    import materialize_athena_query as maq
+
+    # small batches, so a few partitions take several
+    monkeypatch.setattr(maq, "PARTITION_BATCH_SIZE", 10)
+    batches = []
+    add_parquet_partitions = wr.catalog.add_parquet_partitions
+    monkeypatch.setattr(wr.catalog, "add_parquet_partitions", lambda partitions_values, **kwargs: (
+        batches.append(len(partitions_values)), add_parquet_partitions(partitions_values=partitions_values, **kwargs)
+    )[1])
+    table = job(sql=f"SELECT *, id % 25 AS bucket FROM {DATABASE}.source", engine="duckdb", partition_cols=["bucket"], chunksize=chunksize)
+    table.process_query(raise_errors=True)
+
+    # once every file is written, in batches of at most PARTITION_BATCH_SIZE, not once per write
+    assert sorted(batches) == [5, 10, 10]
+    assert len(wr.catalog.get_partitions(database=DATABASE, table=table.target_table)) == 25
+    assert read_table(table.target_table)["id"].tolist() == list(range(ROWS))
+
+
+SHARDED_SQL = f"SELECT * FROM {DATABASE}.source WHERE {{{{ shard_filter }}}}"
+
+
+def shard_jobs(job, shard_count=3, **options):
+    """A job for each shard of one run"""
+    from dataclasses import replace
+
+    first = job(sql=SHARDED_SQL, engine="duckdb", partition_cols=["state"], publish_mode="versioned", sharding={"key": "id"},
+                shard_count=shard_count, shard_run_id="run-1", **options)
+    return [first] + [replace(first, shard_index=i) for i in range(1, shard_count)]
+
+
+def test_shards_publish_once(job):
+    import awswrangler as wr
+
+    shards = shard_jobs(job)
+    for shard in shards[:-1]:
+        shard.process_query(raise_errors=True)
+        # written to the run's version, nothing is published until every shard has written
+        assert not wr.catalog.does_table_exist(database=DATABASE, table=shard.target_table)
+    shards[-1].process_query(raise_errors=True)
+
+    assert read_table(shards[0].target_table)["id"].tolist() == list(range(ROWS))
+    assert all(location.startswith(f"{shards[0].s3_dataset_output}/v_run-1/") for location in table_locations(shards[0].target_table))
+    # each shard keeps its own stats history, the shards of a run finish together and would overwrite each other's
+    for i, shard in enumerate(shards):
+        runs = shard.state_store.get(shard._state_key(f"stats/shard-{i:05d}"))["runs"]
+        assert [run["status"] for run in runs] == ["succeeded"] and runs[0]["result_rows"] > 0
+    assert sum(shard.state_store.get(shard._state_key(f"stats/shard-{i:05d}"))["runs"][0]["result_rows"]
+               for i, shard in enumerate(shards)) == ROWS
+    assert shards[0].state_store.get(shards[0]._state_key("stats")) is None
+
+    # a published run's shards can't be written again
+    with pytest.raises(ValueError, match="already published"):
+        shards[1].process_query(raise_errors=True)
+
+
+def test_shard_retry_replaces_its_files(job):
+    shards = shard_jobs(job)
+    shards[0].process_query(raise_errors=True)
+    # a retried shard's earlier files are deleted, the rows it writes again aren't doubled
+    shards[0].process_query(raise_errors=True)
+    for shard in shards[1:]:
+        shard.process_query(raise_errors=True)
+    assert read_table(shards[0].target_table)["id"].tolist() == list(range(ROWS))
+
+
+def test_range_shard_params():
+    import materialize_athena_query as maq
+
+    params = [maq.get_shard_params({"key": "reporting_date", "start": "2021-06-01", "end": "2021-06-11"}, i, 3) for i in range(3)]
+    assert [(shard["shard_start"], shard["shard_end"]) for shard in params] == [
+        ("2021-06-01", "2021-06-04"), ("2021-06-04", "2021-06-07"), ("2021-06-07", "2021-06-11")
+    ]
+    # NULL keys go to the first shard
+    assert params[0]["shard_filter"] == ("(\"reporting_date\" >= DATE '2021-06-01' AND \"reporting_date\" < DATE '2021-06-04'"
+                                         " OR \"reporting_date\" IS NULL)")
+    assert "IS NULL" not in params[1]["shard_filter"]
+    assert [(shard["shard_start"], shard["shard_end"]) for shard in
+            (maq.get_shard_params({"key": "id", "start": 0, "end": 10}, i, 4) for i in range(4))] == [(0, 2), (2, 5), (5, 7), (7, 10)]
@@ -0,0 +1,117 @@
+"""ParquetWriter against a local moto S3/Glue server"""
+import uuid
+
+import pytest
+
+DATABASE = "writer_db"
+BUCKET = "writer-data"
+STATES = ["AK", "AL", "AZ"]
+ROWS = 30000
+
+
+@pytest.fixture
+def frame(moto_server):
+    import boto3
+    import awswrangler as wr
+    import numpy as np
+    import pandas as pd
+
+    boto3.client("s3").create_bucket(Bucket=BUCKET)
+    if DATABASE not in wr.catalog.databases()["Database"].tolist():
+        wr.catalog.create_database(DATABASE)
+    rng = np.random.default_rng(7)
+    return pd.DataFrame({
+        "id": rng.permutation(ROWS),
+        "state": [STATES[i % len(STATES)] for i in range(ROWS)],
+        "reporting_date": pd.to_datetime("2021-06-01") + pd.to_timedelta(rng.integers(0, 60, ROWS), unit="D"),
+        "cases": rng.integers(0, 1000, ROWS),
+    })
+
+
+def writer(**options):
+    from parquet_writer import ParquetWriter
+
+    table = f"t_{uuid.uuid4().hex[:8]}"
+    return ParquetWriter(path=f"s3://{BUCKET}/{table}/", database=DATABASE, table=table, **options)
+
+
+def parquet_files(path):
+    """The written files' footers by path"""
+    import io
+    import awswrangler as wr
+    import boto3
+    import pyarrow.parquet as pq
+
+    s3 = boto3.client("s3")
+    footers = {}
+    for file_path in wr.s3.list_objects(path):
+        bucket, key = file_path[len("s3://"):].split("/", 1)
+        footers[file_path] = pq.ParquetFile(io.BytesIO(s3.get_object(Bucket=bucket, Key=key)["Body"].read())).metadata
+    return footers
+
+
+def test_files_split_to_target_size(frame):
+    import awswrangler as wr
+    import pandas as pd
+
+    split = writer(partition_cols=["state"], target_file_mb=0.02)
+    result = split.write(frame, "overwrite")
+    whole = writer(partition_cols=["state"])
+    whole.write(frame, "overwrite")
+
+    assert len(parquet_files(whole.path)) == len(STATES)
+    files = parquet_files(split.path)
+    assert len(files) > 2 * len(STATES) and sorted(files) == sorted(result["paths"])
+    # sized from the encoded sample, so about the target
+    assert max(wr.s3.size_objects(list(files)).values()) < 1.5 * 0.02 * 1024 ** 2
+    # every file of a partition has the same number of rows but the last one, which takes the remainder
+    for state in STATES:
+        rows = [footer.num_rows for path, footer in sorted(files.items()) if f"state={state}/" in path]
+        assert len(set(rows[:-1])) == 1 and rows[-1] <= rows[0]
+    df = wr.s3.read_parquet(split.path, dataset=True).sort_values("id").reset_index(drop=True)
+    expected = frame.sort_values("id").reset_index(drop=True)
+    pd.testing.assert_frame_equal(df[expected.columns], expected, check_dtype=False, check_categorical=False)
+    # registered like the single file dataset
+    assert (wr.catalog.get_table_types(database=DATABASE, table=split.table)
+            == wr.catalog.get_table_types(database=DATABASE, table=whole.table))
+    assert (sorted(wr.catalog.get_partitions(database=DATABASE, table=split.table).values())
+            == [[state] for state in STATES])
+
+
+def test_sorted_row_groups(frame):
+    split = writer(partition_cols=["state"], sort_by=["reporting_date", "id"], row_group_rows=1000)
+    split.write(frame, "overwrite")
+
+    for footer in parquet_files(split.path).values():
+        column = footer.schema.names.index("reporting_date")
+        ranges = [(footer.row_group(i).column(column).statistics.min, footer.row_group(i).column(column).statistics.max)
+                  for i in range(footer.num_row_groups)]
+        assert footer.num_row_groups == -(-footer.num_rows // 1000)
+        # sorted, so each row group covers a range that starts where the previous one ended
+        assert all(previous[1] <= current[0] for previous, current in zip(ranges, ranges[1:]))
+
+
+def test_dictionary_columns(frame):
+    encoded = writer(dictionary_columns=["state"])
+    encoded.write(frame, "overwrite")
+
+    for footer in parquet_files(encoded.path).values():
+        row_group = footer.row_group(0)
+        encodings = {row_group.column(i).path_in_schema: row_group.column(i).encodings for i in range(row_group.num_columns)}
+        assert any("DICTIONARY" in encoding for encoding in encodings["state"])
+        assert not any("DICTIONARY" in encoding for encoding in encodings["id"])
+
+    with pytest.raises(ValueError, match="county"):
+        writer(dictionary_columns=["county"]).write(frame, "overwrite")
+
+
+def test_overwrite_partitions(frame):
+    import awswrangler as wr
+
+    split = writer(partition_cols=["state"], target_file_mb=0.02)
+    split.write(frame, "overwrite")
+    kept = [path for path in wr.s3.list_objects(split.path) if "state=AK/" not in path]
+    split.write(frame[frame["state"] == "AK"].head(10), "overwrite_partitions")
+
+    assert wr.s3.list_objects(f"{split.path}state=AK/") and len(wr.s3.list_objects(f"{split.path}state=AK/")) == 1
+    assert sorted(path for path in wr.s3.list_objects(split.path) if "state=AK/" not in path) == sorted(kept)
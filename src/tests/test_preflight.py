@@ -0,0 +1,70 @@
+"""The EXPLAIN IO plans in preflight_fixtures, checked offline. The fixtures are synthetic, written in the shape of
+Athena's output, see their notes"""
+import json
+import os
+
+import pytest
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "preflight_fixtures")
+
+
+def load_scans(name):
+    import preflight
+
+    with open(os.path.join(FIXTURES_PATH, name)) as f:
+        fixture = json.load(f)
+    scans = preflight.parse_io_plan(fixture["plan"])
+    for scan in scans:
+        scan.partition_keys = fixture.get("partition_keys", {}).get(scan.table, [])
+    return scans, fixture.get("scan_budget_bytes")
+
+
+@pytest.mark.parametrize("name, problems", [
+    # the reporting_date filter is outside the windowed subquery, only the state filter reaches the scan
+    ("sample-nyc-covid.json", [
+        "covid-19.nytimes_counties is partitioned by ['date'] but the query doesn't constrain any of them, every partition is read"
+    ]),
+    # the watermark filter on the raw date column is inside the subquery, so the date partitions are pruned
+    ("sample-nyc-covid-incremental.json", []),
+])
+def test_fixture_problems(name, problems):
+    import preflight
+
+    scans, budget = load_scans(name)
+    assert preflight.analyze(scans, budget)["problems"] == problems
+
+
+def test_pruned_partitions():
+    import preflight
+
+    scans, _ = load_scans("sample-nyc-covid-incremental.json")
+    partitions = {f"s3://bucket/nytimes_counties/date={day}/": [day] for day in ("2021-05-30", "2021-05-31", "2021-06-01")}
+    assert list(preflight.matching_partitions(scans[0], partitions).values()) == [["2021-05-31"], ["2021-06-01"]]
+
+
+def test_over_budget():
+    import preflight
+
+    scans, _ = load_scans("sample-nyc-covid-incremental.json")
+    assert preflight.analyze(scans, 1024)["problems"] == ["estimated scan of 0.00215 GB is over the budget of 9.54e-07 GB"]
+
+
+DAYS = ["2021-05-30", "2021-05-31", "2021-06-01"]
+
+
+@pytest.mark.parametrize("col_type, low, values, matching", [
+    # a timestamp bound against date partition values, as strings '2021-05-31' < '2021-05-31 00:00:00.000'
+    ("timestamp(3)", "2021-05-31 00:00:00.000", DAYS, ["2021-05-31", "2021-06-01"]),
+    ("timestamp(3) with time zone", "2021-05-31 00:00:00.000 UTC", DAYS, ["2021-05-31", "2021-06-01"]),
+    ("date", "2021-05-31", DAYS, ["2021-05-31", "2021-06-01"]),
+    # as strings '10' < '9'
+    ("integer", "9", ["8", "10"], ["10"]),
+])
+def test_typed_bounds(col_type, low, values, matching):
+    import preflight
+
+    scan = preflight.TableScan(table="db.t", partition_keys=["p"], constraints={"p": {
+        "type": col_type, "nullsAllowed": False, "ranges": [{"low": {"value": low, "bound": "EXACTLY"}, "high": {"bound": "BELOW"}}]
+    }})
+    partitions = {f"s3://bucket/t/p={value}/": [value] for value in values}
+    assert [value for value, in preflight.matching_partitions(scan, partitions).values()] == matching
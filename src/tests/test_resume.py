@@ -0,0 +1,138 @@
+"""Runs that are killed between stages and retried, checked against a local moto S3/Glue server.
+
+Each test makes a write fail once, after its files were uploaded but before the attempt recorded
+its progress, retries the job with the same checkpoint, and checks the table has every source row once.
+"""
+import uuid
+
+import pytest
+
+DATABASE = "resume_db"
+OUTPUT_BUCKET = "resume-output"
+RESULTS_BUCKET = "resume-results"
+ROWS = 3000
+CHUNKSIZE = 1000
+
+
+class Killed(Exception):
+    pass
+
+
+@pytest.fixture(scope="module")
+def source(moto_server, tmp_path_factory):
+    import boto3
+    import awswrangler as wr
+    import pandas as pd
+
+    for bucket in (OUTPUT_BUCKET, RESULTS_BUCKET):
+        boto3.client("s3").create_bucket(Bucket=bucket)
+    wr.catalog.create_database(DATABASE)
+    # the first batch only has two states, so later batches both add partitions and append to written ones
+    states = ["AL", "AK"] * (CHUNKSIZE // 2) + ["AL", "AK", "AZ", "CA", "CO"] * ((ROWS - CHUNKSIZE) // 5)
+    path = str(tmp_path_factory.mktemp("source") / "source.csv")
+    pd.DataFrame({"id": range(ROWS), "state": states, "cases": [i % 97 for i in range(ROWS)]}).to_csv(path, index=False)
+    return path
+
+
+@pytest.fixture
+def job(source, tmp_path, monkeypatch):
+    import materialize_athena_query as maq
+
+    monkeypatch.setattr(maq, "get_query", lambda sql_script, params=None: f"SELECT * FROM {DATABASE}.source ORDER BY id")
+    monkeypatch.setattr(maq, "get_query_variables", lambda sql_script: {"watermark", "watermark_op"})
+    table = f"t_{uuid.uuid4().hex[:8]}"
+
+    def make(**options):
+        options = {
+            "engine": "duckdb",
+            "local_tables": {f"{DATABASE}.source": source},
+            "chunksize": CHUNKSIZE,
+            "state_store_uri": f"file://{tmp_path}/state",
+            "checkpoint": True,
+            **options,
+        }
+        return maq.MaterializeAthenaQuery("stubbed.sql", OUTPUT_BUCKET, DATABASE, table, "resume test", RESULTS_BUCKET, **options)
+    return make
+
+
+def kill_once(monkeypatch, method, after_calls):
+    """Makes the job's method raise once, after it ran after_calls times in the attempt"""
+    import materialize_athena_query as maq
+
+    original = getattr(maq.MaterializeAthenaQuery, method)
+    calls = {"n": 0, "killed": False}
+
+    def killed(self, *args, **kwargs):
+        result = original(self, *args, **kwargs)
+        calls["n"] += 1
+        if calls["n"] == after_calls and not calls["killed"]:
+            calls["killed"] = True
+            raise Killed(f"killed after {method} call {after_calls}")
+        return result
+    monkeypatch.setattr(maq.MaterializeAthenaQuery, method, killed)
+
+
+def table_rows(table):
+    from duckdb_engine import DuckDBEngine
+
+    return DuckDBEngine(default_database=DATABASE).query(
+        f"SELECT count(*) AS n, count(DISTINCT id) AS ids FROM {table}"
+    ).to_dict("records")[0]
+
+
+def run_twice(make):
+    with pytest.raises(Killed):
+        make().process_query(raise_errors=True)
+    retry = make()
+    retry.process_query(raise_errors=True)
+    return table_rows(retry.target_table)
+
+
+@pytest.mark.parametrize("after_calls", [1, 2, 3])
+def test_partitioned_batches_resume(job, monkeypatch, after_calls):
+    # batch 1 is written as two frames, new partitions with the savemode and already written ones appended.
+    # Killing after the second write fails in the middle of it
+    kill_once(monkeypatch, "_write_frame", after_calls)
+    rows = run_twice(lambda: job(partition_cols=["state"]))
+    assert rows == {"n": ROWS, "ids": ROWS}
+
+
+@pytest.mark.parametrize("after_calls", [1, 2])
+def test_appended_batches_resume(job, monkeypatch, after_calls):
+    # incremental jobs without partitions append every batch, the first one included
+    kill_once(monkeypatch, "_write_frame", after_calls)
+    rows = run_twice(lambda: job(watermark_column="id"))
+    assert rows == {"n": ROWS, "ids": ROWS}
+
+
+@pytest.mark.parametrize("stage", ["_write_chunks", "_publish"])
+def test_versioned_resume(job, monkeypatch, stage):
+    kill_once(monkeypatch, stage, 1)
+    rows = run_twice(lambda: job(partition_cols=["state"], publish_mode="versioned"))
+    assert rows == {"n": ROWS, "ids": ROWS}
+
+
+
+def test_target_batches_resume(job, monkeypatch):
+    import materialize_athena_query as maq
+
+    # the target's writer fails on its second batch, the job's own writer finishes all of them
+    original = maq.MaterializeAthenaQuery._write_frame
+    calls = {"n": 0}
+
+    def killed(self, *args, **kwargs):
+        result = original(self, *args, **kwargs)
+        if self._target is not None:
+            calls["n"] += 1
+            if calls["n"] == 2:
+                raise Killed("killed after the target's second batch")
+        return result
+    monkeypatch.setattr(maq.MaterializeAthenaQuery, "_write_frame", killed)
+
+    target = f"t_{uuid.uuid4().hex[:8]}"
+    make = lambda: job(watermark_column="id", targets=[{"target_table": target, "columns": ["id", "state"]}])
+    # like the job, the unpartitioned target of an incremental job appends its slice
+    assert [writer.savemode for writer in make()._target_writers()] == ["append"]
+    rows = run_twice(make)
+    assert rows == {"n": ROWS, "ids": ROWS}
+    assert table_rows(target) == {"n": ROWS, "ids": ROWS}
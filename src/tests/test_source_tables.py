@@ -0,0 +1,42 @@
+"""get_source_tables, the tables a query reads as used by the DAG and the Glue fingerprint"""
+import pytest
+
+
+@pytest.mark.parametrize("query, tables", [
+    ('SELECT * FROM "db"."a" x, "db"."b" y', ["db.a", "db.b"]),
+    ("select * from a, b as bb, c", ["dflt.a", "dflt.b", "dflt.c"]),
+    ('select * from "covid-19".nytimes_counties c join covid-19.states s on c.state = s.name', [
+        "covid-19.nytimes_counties", "covid-19.states"
+    ]),
+    ("select * from awsdatacatalog.db.t", ["db.t"]),
+    ("SELECT * FROM (a JOIN b ON a.x = b.x) LEFT JOIN c ON a.y = c.y", ["dflt.a", "dflt.b", "dflt.c"]),
+    ("select * from (select * from a where x in (select x from b)) t, c", ["dflt.a", "dflt.b", "dflt.c"]),
+])
+def test_relations(query, tables):
+    from materialize_athena_query import get_source_tables
+
+    assert get_source_tables(query, "dflt") == tables
+
+
+@pytest.mark.parametrize("query, tables", [
+    ("SELECT x FROM t CROSS JOIN UNNEST(arr) AS u(x)", ["dflt.t"]),
+    ("SELECT * FROM t, UNNEST(t.arr) WITH ORDINALITY AS u(x, i)", ["dflt.t"]),
+    ("SELECT * FROM (VALUES (1), (2)) AS v(x), t", ["dflt.t"]),
+    ("SELECT * FROM a, LATERAL (SELECT * FROM b WHERE b.x = a.x) l", ["dflt.a", "dflt.b"]),
+    ("select extract(year from d), substring(s from 1 for 2), trim(both ' ' from s) from t", ["dflt.t"]),
+    ("select 'from fake' from t -- from commented\n/* join also_commented */", ["dflt.t"]),
+])
+def test_skipped(query, tables):
+    from materialize_athena_query import get_source_tables
+
+    assert get_source_tables(query, "dflt") == tables
+
+
+def test_ctes():
+    from materialize_athena_query import get_source_tables
+
+    query = """
+    WITH RECURSIVE recent (d) AS (SELECT "date" FROM db.counties), "other" AS (SELECT * FROM recent, db.states)
+    SELECT * FROM recent r JOIN other o ON r.d = o.d, db.fips
+    """
+    assert get_source_tables(query, "dflt") == ["db.counties", "db.states", "db.fips"]